@@ -2,7 +2,12 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import User
 from django.utils.html import format_html
-from .models import City, Category, Advertisement, AdvertisementImage, Favorite, SMSVerification, UserLastCode
+from .models import (
+    City, Category, Advertisement, AdvertisementImage, BackgroundTask, Favorite, ImageUpload, MediaBlob,
+    SMSOutbox, SMSVerification, UserLastCode
+)
+from . import counters
+from .category_tree import get_tree
 
 
 @admin.register(City)
@@ -14,7 +19,7 @@ class CityAdmin(admin.ModelAdmin):
     readonly_fields = ['created_at']
 
     def advertisements_count(self, obj):
-        return obj.advertisements.filter(status='active').count()
+        return counters.city_count(obj.pk)
     advertisements_count.short_description = 'Количество объявлений'
 
 
@@ -41,11 +46,11 @@ class CategoryAdmin(admin.ModelAdmin):
     )
 
     def advertisements_count(self, obj):
-        return obj.advertisements.filter(status='active').count()
+        return counters.category_count(obj.pk)
     advertisements_count.short_description = 'Количество объявлений'
 
     def children_count(self, obj):
-        return obj.children.count()
+        return len(get_tree().children(obj.pk))
     children_count.short_description = 'Подкатегории'
 
     def level(self, obj):
@@ -107,8 +112,8 @@ class AdvertisementAdmin(admin.ModelAdmin):
 
 @admin.register(AdvertisementImage)
 class AdvertisementImageAdmin(admin.ModelAdmin):
-    list_display = ['advertisement', 'image_preview', 'is_primary', 'created_at']
-    list_filter = ['is_primary', 'created_at']
+    list_display = ['advertisement', 'image_preview', 'is_primary', 'status', 'created_at']
+    list_filter = ['is_primary', 'status', 'created_at']
     search_fields = ['advertisement__title', 'caption']
     readonly_fields = ['created_at']
 
@@ -122,6 +127,35 @@ class AdvertisementImageAdmin(admin.ModelAdmin):
     image_preview.short_description = 'Предварительный просмотр'
 
 
+@admin.register(MediaBlob)
+class MediaBlobAdmin(admin.ModelAdmin):
+    list_display = ['name', 'size', 'refcount', 'updated_at']
+    search_fields = ['name', 'digest']
+    readonly_fields = ['name', 'digest', 'size', 'refcount', 'created_at', 'updated_at']
+
+
+@admin.register(ImageUpload)
+class ImageUploadAdmin(admin.ModelAdmin):
+    list_display = ['filename', 'user', 'offset', 'size', 'status', 'updated_at']
+    list_filter = ['status']
+    readonly_fields = ['offset', 'created_at', 'updated_at']
+
+
+@admin.register(BackgroundTask)
+class BackgroundTaskAdmin(admin.ModelAdmin):
+    list_display = ['kind', 'status', 'attempts', 'run_after', 'locked_by', 'created_at']
+    list_filter = ['kind', 'status']
+    readonly_fields = ['attempts', 'locked_by', 'locked_at', 'last_error', 'created_at']
+
+
+@admin.register(SMSOutbox)
+class SMSOutboxAdmin(admin.ModelAdmin):
+    list_display = ['phone', 'status', 'attempts', 'run_after', 'expires_at', 'sent_at', 'created_at']
+    list_filter = ['status']
+    search_fields = ['phone']
+    readonly_fields = ['attempts', 'expires_at', 'locked_by', 'locked_at', 'gateway_id', 'last_error', 'created_at', 'sent_at']
+
+
 @admin.register(Favorite)
 class FavoriteAdmin(admin.ModelAdmin):
     list_display = ['user', 'advertisement', 'created_at']
@@ -138,10 +172,10 @@ class FavoriteAdmin(admin.ModelAdmin):
 
 @admin.register(SMSVerification)
 class SMSVerificationAdmin(admin.ModelAdmin):
-    list_display = ['phone', 'code', 'is_verified', 'is_expired', 'created_at']
+    list_display = ['phone', 'code', 'is_verified', 'attempts', 'is_expired', 'created_at']
     list_filter = ['is_verified', 'created_at']
     search_fields = ['phone']
-    readonly_fields = ['created_at', 'expires_at', 'is_expired']
+    readonly_fields = ['created_at', 'expires_at', 'is_expired', 'attempts']
     ordering = ['-created_at']
     
     def is_expired(self, obj):
@@ -1,7 +1,17 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class AdsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'ads'
     verbose_name = 'Объявления'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        # Регистрируют задачи фоновой очереди
+        from . import expiration, sms_outbox, verification_store  # noqa: F401
+        from .signals import create_cache_tables
+        from .versions import check_shared_cache
+        check_shared_cache()
+        post_migrate.connect(create_cache_tables, sender=self)
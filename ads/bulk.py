@@ -0,0 +1,148 @@
+"""
+Пакетное создание и обновление объявлений.
+
+Элементы обрабатываются пачками по ADVERTISEMENT_BULK_BATCH_SIZE. Для пачки
+одним запросом загружаются категории, города и обновляемые объявления автора,
+элементы проверяются без обращений к БД (AdvertisementBulkSerializer), затем
+новые объявления вставляются через bulk_create, а измененные сохраняются
+через bulk_update - в одной транзакции на пачку.
+
+Ошибка в элементе не мешает остальным: он получает статус error с описанием.
+Повтор id в одной пачке - ошибка повторного элемента, первый сохраняется.
+Если пачка не сохранилась целиком (ошибка БД), ошибку получают все ее элементы,
+а другие пачки не затрагиваются.
+
+bulk_create и bulk_update не вызывают save() и сигналы, поэтому счетчики
+(ads.counters), поисковый индекс, подсказки и версия лент обновляются здесь же,
+по одному разу на пачку.
+"""
+from collections import Counter
+from itertools import islice
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+from . import counters, search, suggest
+from .models import Advertisement, Category, City
+from .serializers import AdvertisementBulkSerializer
+from .versions import ADVERTISEMENTS_NAMESPACE, bump_version
+
+
+def batches(items, size):
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _ids(items, key):
+    return {_int(item.get(key)) for item in items if isinstance(item, dict)} - {None}
+
+
+def error(index, errors):
+    return {'index': index, 'status': 'error', 'errors': errors}
+
+
+def save_batch(items, start, user):
+    """Проверяет и сохраняет одну пачку; возвращает результаты ее элементов"""
+    context = {
+        'categories': Category.objects.in_bulk(_ids(items, 'category')),
+        'cities': City.objects.in_bulk(_ids(items, 'city')),
+    }
+    existing = Advertisement.objects.filter(author=user).select_related('category', 'city').in_bulk(
+        _ids(items, 'id')
+    )
+
+    results = {}
+    created = []
+    updated = []
+    changed_fields = set()
+    seen = set()
+    for index, item in enumerate(items, start=start):
+        if not isinstance(item, dict):
+            results[index] = error(index, {'non_field_errors': ['Ожидается JSON-объект']})
+            continue
+        instance = None
+        if item.get('id') is not None:
+            instance = existing.get(_int(item['id']))
+            if instance is None:
+                results[index] = error(index, {'id': ['Объявление не найдено']})
+                continue
+            if instance.pk in seen:
+                results[index] = error(index, {'id': ['Объявление уже изменено в этой пачке']})
+                continue
+            seen.add(instance.pk)
+        serializer = AdvertisementBulkSerializer(instance, data=item, partial=instance is not None, context=context)
+        if not serializer.is_valid():
+            results[index] = error(index, serializer.errors)
+            continue
+        if instance is None:
+            advertisement = Advertisement(author=user, **serializer.validated_data)
+            created.append((index, advertisement))
+        else:
+            for attr, value in serializer.validated_data.items():
+                setattr(instance, attr, value)
+            changed_fields.update(serializer.validated_data)
+            updated.append((index, instance))
+
+    now = timezone.now()
+    for _, advertisement in created:
+        # Как в Advertisement.save: объявление действует 30 дней
+        advertisement.expires_at = now + timezone.timedelta(days=30)
+    for _, advertisement in updated:
+        advertisement.updated_at = now
+        if advertisement.renew_expired(counters.stored_key(advertisement) is not None, now):
+            changed_fields.add('expires_at')
+
+    advertisements = [advertisement for _, advertisement in created + updated]
+    try:
+        with transaction.atomic():
+            Advertisement.objects.bulk_create([advertisement for _, advertisement in created])
+            if updated:
+                Advertisement.objects.bulk_update(
+                    [advertisement for _, advertisement in updated], sorted(changed_fields | {'updated_at'})
+                )
+            deltas = Counter()
+            for advertisement in advertisements:
+                old_key = getattr(advertisement, '_stored_counter_key', None)
+                new_key = advertisement.counter_key
+                if old_key != new_key:
+                    if old_key is not None:
+                        deltas[old_key] -= 1
+                    if new_key is not None:
+                        deltas[new_key] += 1
+            counters.apply_deltas(deltas)
+            search.index_advertisements(advertisements)
+    except DatabaseError as e:
+        print(f"Ошибка при сохранении пачки объявлений: {e}")
+        for index, _ in created + updated:
+            results[index] = error(index, {'non_field_errors': [str(e)]})
+        return [results[index] for index in sorted(results)]
+
+    for advertisement in advertisements:
+        advertisement._stored_counter_key = advertisement.counter_key
+        suggest.update('title', advertisement.pk, advertisement.title, visible=advertisement.status == 'active')
+    if advertisements:
+        bump_version(ADVERTISEMENTS_NAMESPACE)
+    for index, advertisement in created:
+        results[index] = {'index': index, 'status': 'created', 'id': advertisement.pk}
+    for index, advertisement in updated:
+        results[index] = {'index': index, 'status': 'updated', 'id': advertisement.pk}
+    return [results[index] for index in sorted(results)]
+
+
+def save_all(items, user, batch_size=None):
+    """Обрабатывает элементы (список или генератор) пачками; возвращает результаты по порядку"""
+    batch_size = batch_size or settings.ADVERTISEMENT_BULK_BATCH_SIZE
+    results = []
+    for batch in batches(items, batch_size):
+        results.extend(save_batch(batch, len(results), user))
+    return results
@@ -0,0 +1,410 @@
+"""
+Выгрузка и загрузка каталога: города, категории, объявления и данные фотографий.
+
+Форматы:
+- NDJSON - одна запись на строку с полем type (city, category, advertisement,
+  image); записи идут в порядке зависимостей: города, категории, объявления,
+  фотографии;
+- CSV - папка с файлами cities.csv, categories.csv, advertisements.csv, images.csv.
+
+Связи записываются естественными ключами: города и категории - slug,
+автор - username; объявления и фотографии сохраняют свои id, поэтому
+повторная загрузка обновляет уже загруженные строки (upsert).
+
+Выгрузка читает таблицы через iterator(chunk_size) и пишет по записи, загрузка
+разбирает поток построчно и сохраняет объявления и фотографии пачками через
+bulk_create(update_conflicts=True) - память не зависит от размера каталога.
+Пачки объявлений и фотографий можно сохранять в нескольких процессах
+(import_batch выполняется в процессе-обработчике); там же индексируются для
+поиска объявления пачки. Записи с неверными значениями и без обязательных
+полей пропускаются, import_batch возвращает их описания для вывода командой.
+
+Даты создания и изменения из выгрузки записываются вторым запросом
+(bulk_update) после bulk_create, который ставит в поля auto_now и
+auto_now_add текущее время: поля моделей при загрузке не меняются.
+"""
+import csv
+import json
+import os
+from decimal import Decimal, InvalidOperation
+from django.contrib.auth.models import User
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .models import Advertisement, AdvertisementImage, Category, City
+from .renderers import dumps
+
+
+CITY = 'city'
+CATEGORY = 'category'
+ADVERTISEMENT = 'advertisement'
+IMAGE = 'image'
+
+# Тип записи -> поля в порядке выгрузки
+FIELDS = {
+    CITY: ['slug', 'name', 'is_active', 'created_at'],
+    CATEGORY: ['slug', 'name', 'description', 'icon', 'parent', 'cities', 'created_at'],
+    ADVERTISEMENT: [
+        'id', 'title', 'description', 'price', 'category', 'city', 'author', 'status', 'location',
+        'contact_phone', 'contact_email', 'is_featured', 'views_count', 'created_at', 'updated_at', 'expires_at',
+    ],
+    IMAGE: ['id', 'advertisement', 'image', 'caption', 'is_primary', 'position', 'status', 'variants', 'created_at'],
+}
+CSV_FILES = {CITY: 'cities.csv', CATEGORY: 'categories.csv', ADVERTISEMENT: 'advertisements.csv', IMAGE: 'images.csv'}
+# Порядок загрузки: записи ссылаются только на предыдущие типы
+ORDER = [CITY, CATEGORY, ADVERTISEMENT, IMAGE]
+
+BOOLEAN_FIELDS = {'is_active', 'is_featured', 'is_primary'}
+DATETIME_FIELDS = {'created_at', 'updated_at', 'expires_at'}
+INTEGER_FIELDS = {'id', 'advertisement', 'views_count', 'position'}
+# Без этих полей запись не сохранить (NOT NULL в БД или нужны для связи)
+REQUIRED_FIELDS = {
+    CITY: ['slug', 'name'],
+    CATEGORY: ['slug', 'name'],
+    ADVERTISEMENT: ['id', 'title', 'price', 'category', 'author'],
+    IMAGE: ['id', 'advertisement', 'image'],
+}
+
+
+# Выгрузка
+
+def export_records(chunk_size=2000):
+    """Генератор пар (тип, запись) всего каталога"""
+    for row in City.objects.order_by('pk').values_list(*FIELDS[CITY]).iterator(chunk_size=chunk_size):
+        yield CITY, dict(zip(FIELDS[CITY], row))
+
+    category_cities = {}
+    for category_id, slug in Category.cities.through.objects.values_list('category_id', 'city__slug'):
+        category_cities.setdefault(category_id, []).append(slug)
+    # Родители выгружаются раньше подкатегорий
+    categories = Category.objects.order_by('depth', 'pk').values_list(
+        'pk', 'slug', 'name', 'description', 'icon', 'parent__slug', 'created_at'
+    )
+    for pk, slug, name, description, icon, parent, created_at in categories.iterator(chunk_size=chunk_size):
+        yield CATEGORY, {
+            'slug': slug, 'name': name, 'description': description, 'icon': icon, 'parent': parent,
+            'cities': sorted(category_cities.get(pk, [])), 'created_at': created_at,
+        }
+
+    columns = [
+        {'category': 'category__slug', 'city': 'city__slug', 'author': 'author__username'}.get(field, field)
+        for field in FIELDS[ADVERTISEMENT]
+    ]
+    for row in Advertisement.objects.order_by('pk').values_list(*columns).iterator(chunk_size=chunk_size):
+        record = dict(zip(FIELDS[ADVERTISEMENT], row))
+        # Decimal строкой, чтобы цена не прошла через float
+        record['price'] = str(record['price'])
+        yield ADVERTISEMENT, record
+
+    columns = ['advertisement_id' if field == 'advertisement' else field for field in FIELDS[IMAGE]]
+    for row in AdvertisementImage.objects.order_by('pk').values_list(*columns).iterator(chunk_size=chunk_size):
+        yield IMAGE, dict(zip(FIELDS[IMAGE], row))
+
+
+def write_ndjson(records, output):
+    """Пишет записи в бинарный поток; возвращает количество записей по типам"""
+    counts = dict.fromkeys(ORDER, 0)
+    for kind, record in records:
+        output.write(dumps({'type': kind, **record}) + b'\n')
+        counts[kind] += 1
+    return counts
+
+
+def csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, list):
+        return ' '.join(value)
+    if isinstance(value, dict):
+        return json.dumps(value, ensure_ascii=False)
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def write_csv(records, directory):
+    """Пишет записи в CSV-файлы папки directory"""
+    os.makedirs(directory, exist_ok=True)
+    files = {}
+    writers = {}
+    counts = dict.fromkeys(ORDER, 0)
+    try:
+        for kind in ORDER:
+            files[kind] = open(os.path.join(directory, CSV_FILES[kind]), 'w', newline='', encoding='utf-8')
+            writers[kind] = csv.writer(files[kind])
+            writers[kind].writerow(FIELDS[kind])
+        for kind, record in records:
+            writers[kind].writerow([csv_value(record[field]) for field in FIELDS[kind]])
+            counts[kind] += 1
+    finally:
+        for file in files.values():
+            file.close()
+    return counts
+
+
+# Загрузка
+
+def read_ndjson(stream):
+    """Генератор пар (тип, запись) из бинарного или текстового потока NDJSON"""
+    for number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise ValueError(f'Строка {number}: не JSON')
+        kind = record.pop('type', None)
+        if kind not in FIELDS:
+            raise ValueError(f'Строка {number}: неизвестный тип записи {kind!r}')
+        yield kind, record
+
+
+def read_csv(directory):
+    """Генератор пар (тип, запись) из CSV-файлов папки; отсутствующие файлы пропускаются"""
+    for kind in ORDER:
+        path = os.path.join(directory, CSV_FILES[kind])
+        if not os.path.exists(path):
+            continue
+        with open(path, newline='', encoding='utf-8') as file:
+            for row in csv.DictReader(file):
+                yield kind, row
+
+
+def _boolean(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes')
+    return bool(value)
+
+
+def normalize(kind, record):
+    """Приводит запись из NDJSON или CSV (где все значения - строки) к типам полей"""
+    record = {field: record.get(field) for field in FIELDS[kind] if field in record}
+    for field, value in record.items():
+        if value == '' and field not in ('description', 'icon', 'location', 'contact_phone', 'contact_email', 'caption'):
+            value = None
+        if value is None:
+            record[field] = None
+        elif field in BOOLEAN_FIELDS:
+            record[field] = _boolean(value)
+        elif field in DATETIME_FIELDS:
+            record[field] = parse_datetime(value) if isinstance(value, str) else value
+        elif field in INTEGER_FIELDS:
+            record[field] = int(value)
+        elif field == 'price':
+            record[field] = Decimal(str(value))
+        elif field == 'cities' and isinstance(value, str):
+            record[field] = value.split()
+        elif field == 'variants' and isinstance(value, str):
+            record[field] = json.loads(value)
+    missing = [field for field in REQUIRED_FIELDS[kind] if record.get(field) is None]
+    if missing:
+        raise ValueError(f'не заполнены обязательные поля: {", ".join(missing)}')
+    return record
+
+
+def timestamp_fields(model):
+    return [
+        field.name for field in model._meta.concrete_fields
+        if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)
+    ]
+
+
+def upsert(model, objects, unique_field, update_fields):
+    """
+    bulk_create(update_conflicts=True) с датами из выгрузки: bulk_create ставит
+    в поля auto_now/auto_now_add текущее время, поэтому заданные в объектах даты
+    записываются следом через bulk_update. Даты None остаются как есть в БД
+    """
+    fields = timestamp_fields(model)
+    stamps = [{field: getattr(obj, field) for field in fields} for obj in objects]
+    with transaction.atomic():
+        model.objects.bulk_create(
+            objects, update_conflicts=True, unique_fields=[unique_field], update_fields=update_fields
+        )
+        if any(obj.pk is None for obj in objects):
+            # Upsert по естественному ключу не возвращает id существующих строк
+            ids = dict(model.objects.filter(
+                **{f'{unique_field}__in': [getattr(obj, unique_field) for obj in objects]}
+            ).values_list(unique_field, 'pk'))
+            for obj in objects:
+                obj.pk = ids[getattr(obj, unique_field)]
+        for field in fields:
+            stamped = []
+            for obj, values in zip(objects, stamps):
+                if values[field] is not None:
+                    setattr(obj, field, values[field])
+                    stamped.append(obj)
+            if stamped:
+                model.objects.bulk_update(stamped, [field], batch_size=500)
+
+
+def import_cities(records):
+    cities = [
+        City(slug=record['slug'], name=record['name'], is_active=record.get('is_active', True),
+             created_at=record.get('created_at'))
+        for record in records
+    ]
+    upsert(City, cities, 'slug', ['name', 'is_active'])
+    return len(cities)
+
+
+def import_category(record):
+    """Категории сохраняются по одной: save() строит путь в дереве (их немного)"""
+    parent = None
+    if record.get('parent'):
+        parent = Category.objects.filter(slug=record['parent']).first()
+    category = Category.objects.filter(slug=record['slug']).first()
+    if category is None:
+        category = Category(slug=record['slug'])
+    category.name = record['name']
+    category.description = record.get('description') or ''
+    category.icon = record.get('icon') or ''
+    category.parent = parent
+    with transaction.atomic():
+        category.save()
+        if record.get('created_at'):
+            # save() ставит новой категории текущую дату создания
+            Category.objects.filter(pk=category.pk).update(created_at=record['created_at'])
+    if 'cities' in record:
+        category.cities.set(City.objects.filter(slug__in=record['cities'] or []))
+    return category
+
+
+def resolve_authors(usernames):
+    """username -> id; недостающие пользователи создаются без пароля"""
+    authors = dict(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+    missing = set(usernames) - set(authors)
+    if missing:
+        users = [User(username=username) for username in sorted(missing)]
+        for user in users:
+            user.set_unusable_password()
+        User.objects.bulk_create(users, ignore_conflicts=True)
+        authors.update(User.objects.filter(username__in=missing).values_list('username', 'id'))
+    return authors
+
+
+def import_advertisements(records, search_index=False):
+    """Upsert пачки объявлений; возвращает (сохранено, пропущено)"""
+    categories = dict(Category.objects.filter(
+        slug__in={record.get('category') for record in records}
+    ).values_list('slug', 'id'))
+    cities = dict(City.objects.filter(slug__in={record.get('city') for record in records}).values_list('slug', 'id'))
+    authors = resolve_authors({record['author'] for record in records if record.get('author')})
+
+    now = timezone.now()
+    advertisements = []
+    for record in records:
+        category_id = categories.get(record.get('category'))
+        author_id = authors.get(record.get('author'))
+        if category_id is None or author_id is None:
+            continue
+        values = {field: record[field] for field in FIELDS[ADVERTISEMENT] if field in record}
+        values.update(category_id=category_id, city_id=cities.get(record.get('city')), author_id=author_id)
+        for field in ('category', 'city', 'author'):
+            values.pop(field, None)
+        created_at = values.get('created_at') or now
+        values.update(
+            created_at=created_at,
+            updated_at=values.get('updated_at') or now,
+            # Как в Advertisement.save: объявление действует 30 дней
+            expires_at=values.get('expires_at') or created_at + timezone.timedelta(days=30),
+        )
+        advertisements.append(Advertisement(**values))
+
+    update_fields = [
+        field.name for field in Advertisement._meta.concrete_fields if not field.primary_key
+    ]
+    upsert(Advertisement, advertisements, 'id', update_fields)
+    if search_index:
+        from . import search
+        ids = [advertisement.pk for advertisement in advertisements]
+        search.index_queryset(Advertisement.objects.filter(pk__in=ids))
+    return len(advertisements), len(records) - len(advertisements)
+
+
+def import_images(records, search_index=False):
+    """Upsert пачки данных фотографий (сами файлы не переносятся)"""
+    advertisement_ids = set(Advertisement.objects.filter(
+        pk__in={record.get('advertisement') for record in records}
+    ).values_list('pk', flat=True))
+    now = timezone.now()
+    images = []
+    for record in records:
+        if record.get('advertisement') not in advertisement_ids:
+            continue
+        values = {field: record[field] for field in FIELDS[IMAGE] if field in record and record[field] is not None}
+        values['advertisement_id'] = values.pop('advertisement')
+        values.setdefault('created_at', now)
+        images.append(AdvertisementImage(**values))
+
+    update_fields = [
+        field.name for field in AdvertisementImage._meta.concrete_fields if not field.primary_key
+    ]
+    upsert(AdvertisementImage, images, 'id', update_fields)
+    return len(images), len(records) - len(images)
+
+
+BATCH_IMPORTERS = {ADVERTISEMENT: import_advertisements, IMAGE: import_images}
+
+
+def import_batch(kind, records, search_index=False):
+    """
+    Сохраняет пачку записей одного типа; выполняется и в процессах-обработчиках.
+    Возвращает (сохранено, пропущено, описания неверных записей)
+    """
+    normalized = []
+    errors = []
+    for record in records:
+        try:
+            normalized.append(normalize(kind, record))
+        except (ValueError, InvalidOperation) as e:
+            reason = 'неверное число' if isinstance(e, InvalidOperation) else e
+            errors.append(f"Ошибка в записи {kind} {record.get('id')}: {reason}")
+    saved, skipped = BATCH_IMPORTERS[kind](normalized, search_index=search_index)
+    return saved, skipped + len(records) - len(normalized), errors
+
+
+def batches(records, size):
+    """Группирует поток пар (тип, запись) в пачки одного типа: (тип, [записи])"""
+    records = iter(records)
+    pending_kind = None
+    pending = []
+    for kind, record in records:
+        if kind != pending_kind or len(pending) >= size:
+            if pending:
+                yield pending_kind, pending
+            pending_kind, pending = kind, []
+        pending.append(record)
+    if pending:
+        yield pending_kind, pending
+
+
+def reset_sequences():
+    """Сдвигает последовательности id за загруженные явные id (PostgreSQL), как loaddata"""
+    statements = connection.ops.sequence_reset_sql(no_style(), [Advertisement, AdvertisementImage])
+    if statements:
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+
+
+def finish(images=False):
+    """
+    Пересобирает производные данные после загрузки: bulk_create не вызывает
+    save() и сигналы, поэтому счетчики, подсказки и версии кэша обновляются
+    один раз в конце (поисковый индекс - в import_batch, по пачкам)
+    """
+    from . import category_tree, counters, media_store, suggest
+    from .versions import ADVERTISEMENTS_NAMESPACE, CITIES_NAMESPACE, bump_version
+
+    reset_sequences()
+    counters.rebuild()
+    if images:
+        media_store.recount()
+    suggest.reset()
+    for namespace in (ADVERTISEMENTS_NAMESPACE, CITIES_NAMESPACE, category_tree.NAMESPACE):
+        bump_version(namespace)
@@ -0,0 +1,110 @@
+import threading
+import time
+from django.conf import settings
+from . import versions
+
+
+NAMESPACE = 'categories'
+
+
+class CategoryTree:
+    """Снимок дерева категорий в памяти процесса: только идентификаторы и связи"""
+
+    def __init__(self, rows, version):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.parent_of = {}
+        self.depth_of = {}
+        self.children_of = {}
+        # Последнее изменение категорий (для Last-Modified)
+        self.updated_at = max((row[3] for row in rows), default=None)
+        for category_id, parent_id, depth, updated_at in rows:
+            self.parent_of[category_id] = parent_id
+            self.depth_of[category_id] = depth
+            self.children_of.setdefault(category_id, [])
+        for category_id, parent_id, depth, updated_at in rows:
+            if parent_id in self.children_of:
+                self.children_of[parent_id].append(category_id)
+
+    def __contains__(self, category_id):
+        return category_id in self.parent_of
+
+    def children(self, category_id):
+        return self.children_of.get(category_id, [])
+
+    def has_children(self, category_id):
+        return bool(self.children_of.get(category_id))
+
+    def level(self, category_id):
+        return self.depth_of.get(category_id, 0)
+
+    def ancestors(self, category_id):
+        """Предки категории, начиная с ближайшего"""
+        result = []
+        parent_id = self.parent_of.get(category_id)
+        while parent_id is not None:
+            result.append(parent_id)
+            parent_id = self.parent_of.get(parent_id)
+        return result
+
+    def descendants(self, category_id):
+        """Все потомки категории в порядке обхода в глубину"""
+        result = []
+        stack = list(reversed(self.children(category_id)))
+        while stack:
+            current = stack.pop()
+            result.append(current)
+            stack.extend(reversed(self.children(current)))
+        return result
+
+    def leaf_descendants(self, category_id):
+        """Конечные категории поддерева (сама категория, если у нее нет детей)"""
+        if not self.has_children(category_id):
+            return [category_id]
+        return [child for child in self.descendants(category_id) if not self.has_children(child)]
+
+
+_snapshot = None
+_checked_at = 0.0
+_lock = threading.Lock()
+
+
+def get_tree():
+    """
+    Возвращает снимок дерева. Версия в общем кеше сверяется не чаще раза в
+    CATEGORY_TREE_CHECK_INTERVAL секунд, снимок старше CATEGORY_TREE_TTL
+    перечитывается в любом случае.
+    """
+    global _snapshot, _checked_at
+    now = time.monotonic()
+    snapshot = _snapshot
+    check_interval = settings.CATEGORY_TREE_CHECK_INTERVAL
+    ttl = settings.CATEGORY_TREE_TTL
+
+    if snapshot is not None and now - snapshot.loaded_at < ttl:
+        if now - _checked_at < check_interval:
+            return snapshot
+        version = versions.get_version(NAMESPACE)
+        _checked_at = now
+        if snapshot.version == version:
+            return snapshot
+    else:
+        version = versions.get_version(NAMESPACE)
+
+    with _lock:
+        if _snapshot is not snapshot and _snapshot is not None:
+            return _snapshot
+        from .models import Category
+        rows = list(
+            Category.objects.order_by('name').values_list('id', 'parent_id', 'depth', 'updated_at')
+        )
+        _snapshot = CategoryTree(rows, version)
+        _checked_at = now
+        return _snapshot
+
+
+def invalidate():
+    """Сбрасывает снимок в текущем процессе и версию для остальных процессов"""
+    global _snapshot
+    _snapshot = None
+    versions.bump_version(NAMESPACE)
@@ -0,0 +1,154 @@
+"""
+Загрузка фотографий по частям с возобновлением.
+
+Клиент создает загрузку (имя и размер файла), затем отправляет части
+запросами PUT со смещением и завершает загрузку. Каждая часть пишется
+из потока запроса во временный файл на диске (IMAGE_UPLOAD_SESSION_DIR),
+без чтения в память целиком. Если соединение оборвалось, полученные байты
+сохраняются, и клиент продолжает с текущего смещения (offset).
+
+В файл частей байты переносятся только после того, как запрос сдвинул
+смещение условным UPDATE, и в той же транзакции: из двух запросов с одним
+смещением в файл попадает часть только победившего.
+
+Завершенную загрузку прикрепляют к объявлению по идентификатору: файл
+копируется во временную папку image_processing и обрабатывается в фоне,
+как обычная загрузка. Файл частей удаляется только после фиксации
+транзакции: при откате загрузку можно прикрепить снова.
+"""
+import glob
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+from . import image_processing
+from .models import ImageUpload
+
+
+# Сколько байт читается из запроса за раз
+READ_SIZE = 64 * 1024
+
+
+class OffsetMismatch(Exception):
+    """Часть начинается не с текущего смещения загрузки"""
+
+    def __init__(self, offset):
+        super().__init__(f'Ожидается часть со смещения {offset}')
+        self.offset = offset
+
+
+def upload_dir():
+    return settings.IMAGE_UPLOAD_SESSION_DIR or os.path.join(settings.MEDIA_ROOT, 'uploads')
+
+
+def part_path(upload):
+    return os.path.join(upload_dir(), f'{upload.pk}.part')
+
+
+def start(user, filename, size):
+    """Создает загрузку и пустой файл для ее частей"""
+    purge_expired()
+    upload = ImageUpload.objects.create(user=user, filename=os.path.basename(filename), size=size)
+    os.makedirs(upload_dir(), exist_ok=True)
+    open(part_path(upload), 'wb').close()
+    return upload
+
+
+def write_chunk(upload, offset, stream, length=None):
+    """
+    Дописывает часть из потока stream со смещения offset; length - длина
+    части из Content-Length (если известна). Возвращает загрузку с новым смещением.
+    """
+    if upload.status != ImageUpload.STATUS_UPLOADING:
+        raise ValidationError('Загрузка уже завершена')
+    if offset != upload.offset:
+        raise OffsetMismatch(upload.offset)
+    remaining = upload.size - offset
+    if length is not None and length > remaining:
+        raise ValidationError('Часть выходит за объявленный размер файла')
+
+    written = 0
+    descriptor, chunk_path = tempfile.mkstemp(dir=upload_dir(), prefix=f'{upload.pk}.', suffix='.chunk')
+    try:
+        with os.fdopen(descriptor, 'wb') as chunk:
+            while stream is not None:
+                try:
+                    # Байт сверх остатка означает, что часть длиннее объявленного размера
+                    data = stream.read(min(READ_SIZE, remaining - written + 1))
+                except OSError:
+                    # Соединение оборвалось: сохраняем то, что успели получить
+                    break
+                if not data:
+                    break
+                if written + len(data) > remaining:
+                    raise ValidationError('Часть выходит за объявленный размер файла')
+                chunk.write(data)
+                written += len(data)
+
+        with transaction.atomic():
+            # Смещение сдвигает только тот запрос, который начинал с него; строка
+            # остается заблокированной, пока часть переносится в файл
+            updated = ImageUpload.objects.filter(
+                pk=upload.pk, offset=offset, status=ImageUpload.STATUS_UPLOADING
+            ).update(offset=offset + written, updated_at=timezone.now())
+            if not updated:
+                upload.refresh_from_db()
+                raise OffsetMismatch(upload.offset)
+            with open(chunk_path, 'rb') as chunk, open(part_path(upload), 'r+b') as part:
+                part.seek(offset)
+                shutil.copyfileobj(chunk, part, READ_SIZE)
+    finally:
+        os.remove(chunk_path)
+    upload.offset = offset + written
+    return upload
+
+
+def finalize(upload):
+    """Завершает загрузку, когда получены все байты"""
+    if upload.offset != upload.size:
+        raise ValidationError(f'Получено {upload.offset} из {upload.size} байт')
+    ImageUpload.objects.filter(pk=upload.pk).update(status=ImageUpload.STATUS_COMPLETE)
+    upload.status = ImageUpload.STATUS_COMPLETE
+    return upload
+
+
+def attach(advertisement, upload, is_primary=False, position=0):
+    """Прикрепляет завершенную загрузку к объявлению; файл обрабатывается в фоне"""
+    path = part_path(upload)
+    with image_processing.staging_atomic():
+        # Одну загрузку можно прикрепить только один раз
+        claimed, _ = ImageUpload.objects.filter(pk=upload.pk, status=ImageUpload.STATUS_COMPLETE).delete()
+        if not claimed:
+            raise ValidationError('Загрузка не завершена или уже использована')
+        with open(path, 'rb') as file:
+            image = image_processing.stage(
+                advertisement, File(file, name=upload.filename), is_primary=is_primary, position=position
+            )
+        transaction.on_commit(lambda: remove_part(path))
+    return image
+
+
+def remove_part(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def discard(upload):
+    """Удаляет загрузку вместе с полученными частями"""
+    ImageUpload.objects.filter(pk=upload.pk).delete()
+    remove_part(part_path(upload))
+    # Части, которые писали оборвавшиеся процессы
+    for path in glob.glob(os.path.join(upload_dir(), f'{upload.pk}.*.chunk')):
+        remove_part(path)
+
+
+def purge_expired():
+    """Удаляет загрузки, которые не продолжались дольше IMAGE_UPLOAD_SESSION_TTL"""
+    deadline = timezone.now() - timedelta(seconds=settings.IMAGE_UPLOAD_SESSION_TTL)
+    for upload in ImageUpload.objects.filter(updated_at__lt=deadline):
+        discard(upload)
@@ -0,0 +1,79 @@
+"""
+Условные GET-запросы (ETag / Last-Modified).
+
+Валидаторы считаются без сериализации: из версий данных (ads.versions),
+времени их изменения и updated_at. Если клиент прислал совпадающий
+If-None-Match (или If-Modified-Since не старше Last-Modified), ответ 304
+отдается до выборки и сериализации данных.
+"""
+import hashlib
+from datetime import datetime, timezone as dt_timezone
+from functools import wraps
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from .versions import get_changed_at, get_versions
+
+
+def make_etag(parts):
+    """Сильный ETag из частей валидатора"""
+    digest = hashlib.sha1('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+    return quote_etag(digest[:32])
+
+
+def conditional_get(method):
+    """Отвечает 304, если данные не изменились; иначе добавляет ETag и Last-Modified"""
+    @wraps(method)
+    def wrapper(self, request, *args, **kwargs):
+        validators = self.get_conditional_validators(request, *args, **kwargs)
+        if validators is None:
+            return method(self, request, *args, **kwargs)
+        parts, last_modified = validators
+        etag = make_etag([
+            self.basename, self.action, request.get_full_path(),
+            request.user.pk or 0, request.accepted_renderer.format,
+        ] + list(parts))
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+
+        not_modified = get_conditional_response(request, etag=etag, last_modified=timestamp)
+        if not_modified is not None:
+            return not_modified
+
+        response = method(self, request, *args, **kwargs)
+        if response.status_code == 200:
+            response['ETag'] = etag
+            if timestamp is not None:
+                response['Last-Modified'] = http_date(timestamp)
+        return response
+    return wrapper
+
+
+class ConditionalGetMixin:
+    """
+    Условные GET для list и retrieve. Ответ зависит от данных пространств
+    имен conditional_namespaces; представления могут дополнить валидаторы.
+    """
+    conditional_namespaces = ()
+
+    def get_conditional_namespaces(self):
+        return self.conditional_namespaces
+
+    def get_conditional_validators(self, request, *args, **kwargs):
+        """Части ETag и время последнего изменения; None - без условной обработки"""
+        namespaces = self.get_conditional_namespaces()
+        changed_at = get_changed_at(namespaces)
+        last_modified = datetime.fromtimestamp(changed_at, dt_timezone.utc) if changed_at else None
+        return get_versions(namespaces), last_modified
+
+    @conditional_get
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @conditional_get
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+
+def latest(*values):
+    """Наибольшее из заданных значений времени (None пропускаются)"""
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
@@ -0,0 +1,116 @@
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import Greatest
+from .models import Advertisement, AdvertisementCounter
+from .versions import bump_version
+
+
+# Пространство имен версии счетчиков (см. ads.versions)
+NAMESPACE = 'advertisement_counters'
+
+
+def stored_key(advertisement):
+    """Возвращает ключ счетчика объявления в том виде, в каком оно сохранено в БД"""
+    if advertisement._state.adding or advertisement.pk is None:
+        return None
+    if hasattr(advertisement, '_stored_counter_key'):
+        return advertisement._stored_counter_key
+    row = Advertisement.objects.filter(pk=advertisement.pk).values_list(
+        'status', 'category_id', 'city_id'
+    ).first()
+    if row is None or row[0] != 'active':
+        return None
+    return (row[1], row[2])
+
+
+def apply_change(old_key, new_key):
+    """Переносит объявление между строками счетчиков (None - объявление не учитывается)"""
+    if old_key == new_key:
+        return
+    if old_key is not None:
+        _add(old_key, -1)
+    if new_key is not None:
+        _add(new_key, 1)
+    bump_version(NAMESPACE)
+
+
+def apply_deltas(deltas):
+    """Применяет набор изменений вида {(category_id, city_id): delta}"""
+    changed = False
+    for key, delta in deltas.items():
+        if delta:
+            _add(key, delta)
+            changed = True
+    if changed:
+        bump_version(NAMESPACE)
+
+
+def _add(key, delta):
+    category_id, city_id = key
+    counters = AdvertisementCounter.objects.filter(category_id=category_id, city_id=city_id)
+    if delta < 0:
+        if counters.filter(active_count__gte=-delta).update(active_count=F('active_count') + delta):
+            return
+        # Счетчик разошелся с данными: не уходим в минус и сообщаем о расхождении
+        # (точные значения восстанавливает rebuild_ad_counters)
+        counters.update(active_count=Greatest(F('active_count') + delta, 0))
+        print(
+            f"Ошибка счетчика объявлений {key}: уменьшение на {-delta} больше значения, "
+            f"запустите rebuild_ad_counters"
+        )
+        return
+    if counters.update(active_count=F('active_count') + delta):
+        return
+    try:
+        with transaction.atomic():
+            AdvertisementCounter.objects.create(
+                category_id=category_id, city_id=city_id, active_count=delta
+            )
+    except IntegrityError:
+        # Строку успел создать параллельный запрос
+        counters.update(active_count=F('active_count') + delta)
+
+
+def count_for_categories(category_ids, city_id=None):
+    """Количество активных объявлений в перечисленных категориях"""
+    counters = AdvertisementCounter.objects.filter(category_id__in=category_ids)
+    if city_id is not None:
+        counters = counters.filter(city_id=city_id)
+    return counters.aggregate(total=Sum('active_count'))['total'] or 0
+
+
+def category_count(category_id, city_id=None):
+    """Количество активных объявлений непосредственно в категории"""
+    return count_for_categories([category_id], city_id)
+
+
+def city_count(city_id):
+    """Количество активных объявлений в городе"""
+    return AdvertisementCounter.objects.filter(city_id=city_id).aggregate(
+        total=Sum('active_count')
+    )['total'] or 0
+
+
+def rebuild(batch_size=1000):
+    """Полностью пересчитывает таблицу счетчиков по объявлениям"""
+    rows = (
+        Advertisement.objects.filter(status='active')
+        .order_by()
+        .values('category_id', 'city_id')
+        .annotate(total=Count('pk'))
+    )
+    with transaction.atomic():
+        AdvertisementCounter.objects.all().delete()
+        AdvertisementCounter.objects.bulk_create(
+            (
+                AdvertisementCounter(
+                    category_id=row['category_id'],
+                    city_id=row['city_id'],
+                    active_count=row['total'],
+                )
+                for row in rows.iterator()
+            ),
+            batch_size=batch_size,
+        )
+        bump_version(NAMESPACE)
+    return AdvertisementCounter.objects.count()
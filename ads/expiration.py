@@ -0,0 +1,114 @@
+"""
+Снятие истекших объявлений.
+
+Advertisement.save ставит expires_at через 30 дней, а sweep() переводит
+активные объявления с прошедшим expires_at в inactive. Снова активированное
+объявление получает новые 30 дней (Advertisement.renew_expired). Объявления выбираются
+по индексу ad_status_expires_idx пачками по ADVERTISEMENT_EXPIRE_BATCH_SIZE,
+каждая пачка - отдельная короткая транзакция, поэтому строки не блокируются
+надолго, а лента и карточки продолжают работать во время обхода.
+
+Запускать можно одновременно на нескольких серверах:
+- где БД умеет SKIP LOCKED, строки выбираются с блокировкой, и узлы берут
+  разные пачки, не дожидаясь друг друга;
+- объявление снимается условным UPDATE (status = 'active'), а свои строки
+  пачка находит по отметке updated_at, поэтому объявление, которое снял другой
+  узел, не учитывается в счетчиках дважды.
+
+Счетчики (ads.counters), подсказки и версия лент обновляются по пачке сразу.
+Периодический запуск - команда expire_ads (cron) или задача фоновой очереди
+(expire_ads --schedule), которая перезапускает себя каждые
+ADVERTISEMENT_EXPIRE_INTERVAL секунд.
+"""
+from collections import Counter
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from . import counters, suggest, tasks
+from .models import Advertisement, BackgroundTask
+from .versions import ADVERTISEMENTS_NAMESPACE, bump_version
+
+
+EXPIRE_ADVERTISEMENTS = 'expire_advertisements'
+
+
+def expired(now=None):
+    """Активные объявления с прошедшим сроком в порядке индекса"""
+    return Advertisement.objects.filter(
+        status='active', expires_at__lte=now or timezone.now()
+    ).order_by('expires_at', 'id')
+
+
+def expire_batch(batch_size=None, now=None):
+    """Снимает одну пачку истекших объявлений; возвращает их количество"""
+    batch_size = batch_size or settings.ADVERTISEMENT_EXPIRE_BATCH_SIZE
+    now = now or timezone.now()
+    with transaction.atomic():
+        candidates = expired(now)
+        if connection.features.has_select_for_update_skip_locked:
+            candidates = candidates.select_for_update(skip_locked=True)
+        ids = list(candidates.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return 0
+        # Отметка времени обновления отличает строки, снятые этим вызовом
+        stamp = timezone.now()
+        Advertisement.objects.filter(pk__in=ids, status='active', expires_at__lte=now).update(
+            status='inactive', updated_at=stamp
+        )
+        rows = list(Advertisement.objects.filter(pk__in=ids, status='inactive', updated_at=stamp).values_list(
+            'id', 'title', 'category_id', 'city_id'
+        ))
+        deltas = {key: -count for key, count in Counter(
+            (category_id, city_id) for _, _, category_id, city_id in rows
+        ).items()}
+        counters.apply_deltas(deltas)
+
+    for advertisement_id, title, _, _ in rows:
+        suggest.update('title', advertisement_id, title, visible=False)
+    if rows:
+        bump_version(ADVERTISEMENTS_NAMESPACE)
+    return len(rows)
+
+
+def sweep(batch_size=None, limit=None, now=None):
+    """
+    Снимает истекшие объявления пачками, пока они есть (или пока не снято limit);
+    возвращает общее количество. Пачка, целиком снятая другим узлом, завершает
+    обход: оставшиеся объявления снимет тот узел
+    """
+    batch_size = batch_size or settings.ADVERTISEMENT_EXPIRE_BATCH_SIZE
+    now = now or timezone.now()
+    total = 0
+    while limit is None or total < limit:
+        size = batch_size if limit is None else min(batch_size, limit - total)
+        expired_count = expire_batch(size, now)
+        if not expired_count:
+            break
+        total += expired_count
+    return total
+
+
+def schedule(delay=0):
+    """
+    Ставит периодическую задачу снятия в очередь, если ее там еще нет;
+    возвращает задачу или None
+    """
+    if BackgroundTask.objects.filter(
+        kind=EXPIRE_ADVERTISEMENTS,
+        status__in=[BackgroundTask.STATUS_PENDING, BackgroundTask.STATUS_RUNNING],
+    ).exists():
+        return None
+    return tasks.enqueue(EXPIRE_ADVERTISEMENTS, delay=delay)
+
+
+def reschedule():
+    """Следующий периодический запуск, если он еще не в очереди"""
+    if not BackgroundTask.objects.filter(kind=EXPIRE_ADVERTISEMENTS, status=BackgroundTask.STATUS_PENDING).exists():
+        tasks.enqueue(EXPIRE_ADVERTISEMENTS, delay=settings.ADVERTISEMENT_EXPIRE_INTERVAL)
+
+
+# После последней неудачной попытки цепочка запусков не обрывается
+@tasks.register(EXPIRE_ADVERTISEMENTS, on_failure=lambda payload, error: reschedule())
+def run_scheduled(payload):
+    sweep()
+    reschedule()
@@ -0,0 +1,288 @@
+"""
+Быстрое представление объявлений для горячих путей чтения.
+
+Списки, карточка и избранное собираются в обычные словари напрямую из
+предзагруженных объектов, без обхода полей DRF и вызова SerializerMethodField
+для каждого значения. Результат совпадает с тем, что выдали бы сериализаторы
+DRF: те же ключи в том же порядке и те же форматы (даты ISO 8601 в текущем
+часовом поясе, цена строкой с двумя знаками). Сериализаторы в ads.serializers
+по-прежнему описывают поля и используются для записи.
+
+Каждое представление задано таблицей «ключ -> атрибут или функция», поэтому
+при выборке полей (ads.field_selection) вычисляются только запрошенные ключи.
+"""
+import decimal
+from django.conf import settings
+from django.utils import timezone
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
+from . import counters, image_variants
+from .field_selection import child, expands
+from .category_tree import get_tree
+from .models import Advertisement
+
+
+# Ключ контекста сериализатора, включающий обычный обход полей DRF (сравнение и замеры)
+GENERIC_CONTEXT_KEY = 'generic_representation'
+
+_datetime_field = serializers.DateTimeField()
+_price_field = Advertisement._meta.get_field('price')
+PRICE_EXPONENT = decimal.Decimal('.1') ** _price_field.decimal_places
+
+
+def format_datetime(value):
+    """Как serializers.DateTimeField"""
+    if not value:
+        return None
+    if api_settings.DATETIME_FORMAT != ISO_8601:
+        return _datetime_field.to_representation(value)
+    if settings.USE_TZ and timezone.is_aware(value):
+        value = value.astimezone(timezone.get_current_timezone())
+    value = value.isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def format_price(value):
+    """Как serializers.DecimalField(max_digits=10, decimal_places=2)"""
+    if value is None:
+        return None
+    if not isinstance(value, decimal.Decimal):
+        value = decimal.Decimal(str(value).strip())
+    context = decimal.getcontext().copy()
+    context.prec = _price_field.max_digits
+    return '{:f}'.format(value.quantize(PRICE_EXPONENT, context=context))
+
+
+def image_url(image, request):
+    if not image:
+        return None
+    url = image.url
+    if request is not None:
+        return request.build_absolute_uri(url)
+    return url
+
+
+def build(fields, instance, request, selection):
+    """
+    Словарь из таблицы полей с учетом выборки (None - все поля).
+    Строка в таблице - имя атрибута, иначе функция (instance, request, selection).
+    """
+    data = {}
+    for name, get in fields:
+        if selection is not None and not selection.includes(name):
+            continue
+        if get.__class__ is str:
+            data[name] = getattr(instance, get)
+        else:
+            data[name] = get(instance, request, selection)
+    return data
+
+
+def datetime_attribute(name):
+    return lambda instance, request, selection: format_datetime(getattr(instance, name))
+
+
+def related(name, represent):
+    """Связанный объект: целиком, если связь раскрыта, иначе идентификатор"""
+    def get(instance, request, selection):
+        if not expands(selection, name):
+            return getattr(instance, f'{name}_id')
+        value = getattr(instance, name)
+        if value is None:
+            return None
+        return represent(value, request, child(selection, name))
+    return get
+
+
+def related_list(name, represent):
+    """Связанные объекты (many): целиком или списком идентификаторов"""
+    def get(instance, request, selection):
+        items = getattr(instance, name).all()
+        if not expands(selection, name):
+            return [item.pk for item in items]
+        nested = child(selection, name)
+        return [represent(item, request, nested) for item in items]
+    return get
+
+
+def user_data(user, request=None, selection=None):
+    return build(USER_FIELDS, user, request, selection)
+
+
+def city_data(city, request=None, selection=None):
+    if city is None:
+        return None
+    return build(CITY_FIELDS, city, request, selection)
+
+
+def category_data(category, request=None, selection=None):
+    data = build(CATEGORY_FIELDS, category, request, selection)
+    # Оба ключа строятся из одного списка городов
+    if 'cities' in data or 'available_cities_display' in data:
+        cities = list(category.cities.all())
+        if 'cities' in data:
+            if expands(selection, 'cities'):
+                nested = child(selection, 'cities')
+                data['cities'] = [city_data(city, request, nested) for city in cities]
+            else:
+                data['cities'] = [city.pk for city in cities]
+        if 'available_cities_display' in data:
+            data['available_cities_display'] = ', '.join(city.name for city in cities) if cities else 'Все города'
+    return data
+
+
+def image_data(image, request, selection=None):
+    return build(IMAGE_FIELDS, image, request, selection)
+
+
+def advertisement_list_data(advertisement, request, selection=None):
+    """Как AdvertisementListSerializer"""
+    return build(ADVERTISEMENT_LIST_FIELDS, advertisement, request, selection)
+
+
+def advertisement_detail_data(advertisement, request, is_favorited, selection=None):
+    """Как AdvertisementDetailSerializer"""
+    data = build(ADVERTISEMENT_DETAIL_FIELDS, advertisement, request, selection)
+    if 'is_favorited' in data:
+        data['is_favorited'] = is_favorited
+    return data
+
+
+def favorite_data(favorite, request, selection=None):
+    """Как FavoriteSerializer"""
+    return build(FAVORITE_FIELDS, favorite, request, selection)
+
+
+def _city_advertisements_count(city, request, selection):
+    if hasattr(city, 'active_ads_count'):
+        return city.active_ads_count
+    return counters.city_count(city.pk)
+
+
+def _placeholder(instance, request, selection):
+    # Значение подставляет функция представления
+    return None
+
+
+def _category_advertisements_count(category, request, selection):
+    if hasattr(category, 'active_ads_count'):
+        return category.active_ads_count
+    return counters.category_count(category.pk)
+
+
+def _image_url(image, request, selection):
+    return image_url(image.image, request)
+
+
+def _primary_image(advertisement, request, selection):
+    if hasattr(advertisement, 'primary_images'):
+        primary_image = advertisement.primary_images[0] if advertisement.primary_images else None
+    else:
+        primary_image = advertisement.images.filter(is_primary=True).first()
+    if primary_image is None:
+        return None
+    return image_data(primary_image, request, child(selection, 'primary_image'))
+
+
+def _images_count(advertisement, request, selection):
+    if hasattr(advertisement, 'images_total'):
+        return advertisement.images_total
+    return advertisement.images.count()
+
+
+def _price(advertisement, request, selection):
+    return format_price(advertisement.price)
+
+
+USER_FIELDS = [
+    ('id', 'id'),
+    ('username', 'username'),
+    ('first_name', 'first_name'),
+    ('last_name', 'last_name'),
+    ('email', 'email'),
+]
+
+CITY_FIELDS = [
+    ('id', 'id'),
+    ('name', 'name'),
+    ('slug', 'slug'),
+    ('is_active', 'is_active'),
+    ('advertisements_count', _city_advertisements_count),
+    ('created_at', datetime_attribute('created_at')),
+]
+
+CATEGORY_FIELDS = [
+    ('id', 'id'),
+    ('name', 'name'),
+    ('slug', 'slug'),
+    ('description', 'description'),
+    ('icon', 'icon'),
+    ('parent', 'parent_id'),
+    ('advertisements_count', _category_advertisements_count),
+    ('children_count', lambda category, request, selection: len(get_tree().children(category.pk))),
+    ('level', 'level'),
+    ('cities', _placeholder),
+    ('available_cities_display', _placeholder),
+    ('created_at', datetime_attribute('created_at')),
+]
+
+IMAGE_FIELDS = [
+    ('id', 'id'),
+    ('image', _image_url),
+    ('image_url', _image_url),
+    ('variants', lambda image, request, selection: image_variants.variant_urls(image, request)),
+    ('caption', 'caption'),
+    ('is_primary', 'is_primary'),
+    ('position', 'position'),
+    ('status', 'status'),
+    ('created_at', datetime_attribute('created_at')),
+]
+
+ADVERTISEMENT_LIST_FIELDS = [
+    ('id', 'id'),
+    ('title', 'title'),
+    ('description', 'description'),
+    ('price', _price),
+    ('category', related('category', category_data)),
+    ('city', related('city', city_data)),
+    ('author', related('author', user_data)),
+    ('status', 'status'),
+    ('location', 'location'),
+    ('is_featured', 'is_featured'),
+    ('primary_image', _primary_image),
+    ('images_count', _images_count),
+    ('views_count', 'views_count'),
+    ('created_at', datetime_attribute('created_at')),
+    ('expires_at', datetime_attribute('expires_at')),
+    ('is_expired', 'is_expired'),
+]
+
+ADVERTISEMENT_DETAIL_FIELDS = [
+    ('id', 'id'),
+    ('title', 'title'),
+    ('description', 'description'),
+    ('price', _price),
+    ('category', related('category', category_data)),
+    ('city', related('city', city_data)),
+    ('author', related('author', user_data)),
+    ('status', 'status'),
+    ('location', 'location'),
+    ('contact_phone', 'contact_phone'),
+    ('contact_email', 'contact_email'),
+    ('is_featured', 'is_featured'),
+    ('images', related_list('images', image_data)),
+    ('is_favorited', _placeholder),
+    ('views_count', 'views_count'),
+    ('created_at', datetime_attribute('created_at')),
+    ('updated_at', datetime_attribute('updated_at')),
+    ('expires_at', datetime_attribute('expires_at')),
+    ('is_expired', 'is_expired'),
+]
+
+FAVORITE_FIELDS = [
+    ('id', 'id'),
+    ('advertisement', related('advertisement', advertisement_list_data)),
+    ('created_at', datetime_attribute('created_at')),
+]
@@ -0,0 +1,156 @@
+"""
+Выборочные поля ответа: параметры ?fields= и ?expand=.
+
+fields - список полей через запятую, вложенные поля через точку:
+`?fields=id,title,price,primary_image,city.name`. Без параметра отдаются все поля.
+
+expand - какие связанные объекты встраивать целиком: `?expand=city,category.cities`.
+Если параметр передан, не перечисленные связи отдаются идентификаторами;
+без параметра раскрываются все связи, как раньше. Связь, для которой в fields
+запрошены вложенные поля, раскрывается автоматически.
+
+Выборка учитывается и при сериализации, и в queryset: не запрошенные поля
+не читаются из БД (only()), а не раскрытые связи не подгружаются.
+"""
+from rest_framework import serializers
+
+
+FIELDS_PARAM = 'fields'
+EXPAND_PARAM = 'expand'
+# Ключ контекста сериализатора с выборкой полей корневого объекта
+CONTEXT_KEY = 'field_selection'
+
+
+def parse_paths(value):
+    """'id,city.name' -> {'id': {}, 'city': {'name': {}}}"""
+    tree = {}
+    for path in value.split(','):
+        node = tree
+        for part in path.strip().split('.'):
+            part = part.strip()
+            if part:
+                node = node.setdefault(part, {})
+    return tree
+
+
+class FieldSelection:
+    """Запрошенные поля и раскрываемые связи одного уровня ответа"""
+
+    def __init__(self, fields=None, expand=None):
+        # None (или пустое дерево) в fields - все поля, None в expand - все связи
+        self.fields = fields or None
+        self.expand = expand
+
+    @classmethod
+    def from_request(cls, request):
+        """Выборка из параметров запроса; None, если параметры не переданы"""
+        params = request.query_params
+        if FIELDS_PARAM not in params and EXPAND_PARAM not in params:
+            return None
+        fields = parse_paths(params[FIELDS_PARAM]) if FIELDS_PARAM in params else None
+        expand = parse_paths(params[EXPAND_PARAM]) if EXPAND_PARAM in params else None
+        return cls(fields, expand)
+
+    def includes(self, name):
+        return self.fields is None or name in self.fields
+
+    def expands(self, name):
+        if self.expand is None or name in self.expand:
+            return True
+        return bool(self.fields and self.fields.get(name))
+
+    def child(self, name):
+        """Выборка для вложенного объекта; None - все поля и все связи"""
+        fields = self.fields.get(name) if self.fields else None
+        expand = self.expand.get(name, {}) if self.expand is not None else None
+        if not fields and expand is None:
+            return None
+        return FieldSelection(fields, expand)
+
+    def only(self, model, sources=None, keep=()):
+        """
+        Поля модели для only(): первичный ключ, поля keep и поля, нужные
+        запрошенным ключам. sources сопоставляет ключам ответа поля модели
+        (по умолчанию - одноименные). None - ограничивать выборку не нужно.
+        """
+        if self.fields is None:
+            return None
+        concrete = {field.name for field in model._meta.concrete_fields}
+        names = {model._meta.pk.name, *keep}
+        for name in self.fields:
+            for source in (sources or {}).get(name, (name,)):
+                if source in concrete:
+                    names.add(source)
+        return sorted(names)
+
+
+def includes(selection, name):
+    return selection is None or selection.includes(name)
+
+
+def expands(selection, name):
+    return selection is None or selection.expands(name)
+
+
+def child(selection, name):
+    return selection.child(name) if selection is not None else None
+
+
+def restrict(queryset, selection, sources=None, keep=()):
+    """Применяет only() по выборке"""
+    if selection is None:
+        return queryset
+    names = selection.only(queryset.model, sources, keep)
+    return queryset.only(*names) if names is not None else queryset
+
+
+def get_selection(serializer):
+    """
+    Выборка для сериализатора: корневой берет ее из контекста, вложенным
+    ее назначает родитель (см. FieldSelectionMixin.get_fields).
+    """
+    if hasattr(serializer, '_field_selection'):
+        return serializer._field_selection
+    root = serializer.root
+    if root is serializer or getattr(root, 'child', None) is serializer:
+        return serializer.context.get(CONTEXT_KEY)
+    return None
+
+
+class FieldSelectionMixin:
+    """Сериализатор, который оставляет только запрошенные поля и раскрывает только запрошенные связи"""
+
+    def get_fields(self):
+        fields = super().get_fields()
+        selection = get_selection(self)
+        if selection is None:
+            return fields
+        for name in list(fields):
+            if not selection.includes(name):
+                del fields[name]
+                continue
+            field = fields[name]
+            nested = getattr(field, 'child', field)
+            if not isinstance(nested, serializers.BaseSerializer):
+                continue
+            if selection.expands(name):
+                nested._field_selection = selection.child(name)
+            else:
+                fields[name] = serializers.PrimaryKeyRelatedField(
+                    source=field.source, read_only=True, many=nested is not field
+                )
+        return fields
+
+
+class FieldSelectionViewMixin:
+    """Передает сериализаторам выборку полей из ?fields= и ?expand="""
+
+    def get_field_selection(self):
+        if not hasattr(self, '_field_selection'):
+            self._field_selection = FieldSelection.from_request(self.request)
+        return self._field_selection
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context[CONTEXT_KEY] = self.get_field_selection()
+        return context
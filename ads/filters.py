@@ -0,0 +1,12 @@
+from rest_framework import filters
+from . import search
+
+
+class AdvertisementSearchFilter(filters.SearchFilter):
+    """Параметр ?search= по поисковому индексу вместо LIKE по search_fields"""
+
+    def filter_queryset(self, request, queryset, view):
+        query = ' '.join(self.get_search_terms(request))
+        if not query:
+            return queryset
+        return search.filter_queryset(queryset, query)
@@ -0,0 +1,162 @@
+"""
+Фоновая обработка загруженных фотографий.
+
+В запросе файл только копируется во временную папку (STAGING_DIR) без
+декодирования, создается AdvertisementImage со статусом processing и задача
+в очереди (ads.tasks). Обработчик проверяет, что файл - изображение,
+переносит его в хранилище по содержимому (ads.media_store), строит
+уменьшенные копии (ads.image_variants) и переводит изображение в статус
+ready; битый файл получает статус failed.
+
+Если такой же файл уже есть в хранилище, изображение сразу ссылается на него:
+на диск ничего не пишется, а готовые копии берутся у другого изображения.
+
+Запись в БД откатывается вместе с транзакцией, а файл - нет: изменения
+объявления с фотографиями выполняются в staging_atomic(), которая при ошибке
+удаляет файлы, сохраненные во временную папку внутри нее.
+"""
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from django.core.validators import get_available_image_extensions
+from django.db import transaction
+from PIL import Image
+from . import image_variants, media_store, tasks
+from .models import AdvertisementImage
+
+
+PROCESS_IMAGE = 'process_image'
+STAGING_DIR = 'staging'
+
+# Файлы, сохраненные в открытых блоках staging_atomic текущего потока
+_staged = threading.local()
+
+
+@contextmanager
+def staging_atomic():
+    """transaction.atomic(), при откате которой удаляются сохраненные в ней временные файлы"""
+    names = []
+    stack = _staged.__dict__.setdefault('stack', [])
+    stack.append(names)
+    try:
+        with transaction.atomic():
+            yield
+    except BaseException:
+        for name in names:
+            default_storage.delete(name)
+        raise
+    finally:
+        stack.pop()
+        if stack:
+            # Вложенный блок: файлы удалит и откат внешнего
+            stack[-1].extend(names)
+
+
+def validate_name(name):
+    extension = os.path.splitext(name)[1].lower().lstrip('.')
+    if extension not in get_available_image_extensions():
+        raise ValidationError(f'Неподдерживаемый формат изображения: {extension or "без расширения"}')
+
+
+def validate_size(size):
+    if size > settings.IMAGE_UPLOAD_MAX_SIZE:
+        raise ValidationError(
+            f'Файл больше допустимого размера ({settings.IMAGE_UPLOAD_MAX_SIZE // (1024 * 1024)} МБ)'
+        )
+
+
+def validate_upload(file):
+    """Быстрая проверка в запросе: расширение и размер, без декодирования"""
+    validate_name(file.name)
+    validate_size(file.size)
+
+
+def stage(advertisement, file, is_primary=False, caption='', position=0):
+    """Сохраняет загруженный файл во временную папку и ставит его обработку в очередь"""
+    blob = media_store.find(file)
+    if blob is not None:
+        # Те же байты уже загружали: ссылаемся на готовый файл и его копии
+        return AdvertisementImage.objects.create(
+            advertisement=advertisement,
+            image=blob.name,
+            caption=caption,
+            is_primary=is_primary,
+            position=position,
+            variants=image_variants.shared_variants(blob.name) or {},
+        )
+    extension = os.path.splitext(file.name)[1].lower()
+    name = default_storage.save(f'{STAGING_DIR}/{uuid.uuid4().hex}{extension}', file)
+    if getattr(_staged, 'stack', None):
+        _staged.stack[-1].append(name)
+    image = AdvertisementImage.objects.create(
+        advertisement=advertisement,
+        image=name,
+        caption=caption,
+        is_primary=is_primary,
+        position=position,
+        status=AdvertisementImage.STATUS_PROCESSING,
+    )
+    enqueue(image)
+    return image
+
+
+def enqueue(image):
+    return tasks.enqueue(PROCESS_IMAGE, {'image_id': image.pk})
+
+
+def place(image, original_name):
+    """
+    Переносит файл из временной папки в хранилище поля image и переводит
+    изображение в статус ready. Временный файл удаляется только после фиксации
+    нового имени в БД, поэтому повтор после сбоя на любом шаге безопасен:
+    хранилище по содержимому не пишет файл повторно, а ссылка на файл
+    добавляется только тем, кто перевел изображение из processing.
+    """
+    staged = image.image.name
+    final_name = image.image.field.generate_filename(image, original_name)
+    with default_storage.open(staged, 'rb') as file:
+        final_name = image.image.storage.save(final_name, file)
+    with transaction.atomic():
+        placed = AdvertisementImage.objects.filter(
+            pk=image.pk, image=staged, status=AdvertisementImage.STATUS_PROCESSING
+        ).update(image=final_name, status=AdvertisementImage.STATUS_READY)
+        if placed:
+            media_store.acquire(final_name)
+            transaction.on_commit(lambda: default_storage.delete(staged))
+    return final_name
+
+
+def is_image(name):
+    try:
+        with default_storage.open(name, 'rb') as file:
+            Image.open(file).verify()
+    except Exception:
+        return False
+    return True
+
+
+@tasks.register(PROCESS_IMAGE, on_failure=lambda payload, error: mark_failed(payload['image_id']))
+def process_image(payload):
+    image = AdvertisementImage.objects.filter(pk=payload['image_id']).first()
+    if image is None or not image.image:
+        # Изображение удалили, пока задача ждала очереди
+        return
+    if image.status == AdvertisementImage.STATUS_PROCESSING:
+        if not is_image(image.image.name):
+            default_storage.delete(image.image.name)
+            mark_failed(image.pk)
+            return
+        image.image.name = place(image, os.path.basename(image.image.name))
+        image.status = AdvertisementImage.STATUS_READY
+    if not image_variants.is_current(image):
+        variants = image_variants.shared_variants(image.image.name)
+        image_variants.store([(image, variants or image_variants.render_variants(image.image.name))])
+
+
+def mark_failed(image_id):
+    AdvertisementImage.objects.filter(pk=image_id).update(status=AdvertisementImage.STATUS_FAILED)
+    image_variants.touch(AdvertisementImage.objects.filter(pk=image_id).values_list('advertisement_id', flat=True))
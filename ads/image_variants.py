@@ -0,0 +1,181 @@
+"""
+Уменьшенные копии фотографий объявлений.
+
+Для каждого загруженного изображения строятся варианты фиксированного размера
+(миниатюра, карточка списка, полноэкранный просмотр) в WebP и JPEG. Файлы
+лежат рядом с оригиналом: `photo.jpg` -> `photo__card.webp`, `photo__card.jpg`.
+Описание вариантов хранится в AdvertisementImage.variants:
+
+    {'source': 'advertisements/2024/05/01/photo.jpg',
+     'card': {'width': 640, 'height': 480,
+              'webp': '.../photo__card.webp', 'jpeg': '.../photo__card.jpg'}, ...}
+
+render_variants работает только с файлами и не обращается к БД, поэтому
+его можно выполнять в отдельных процессах (команда generate_image_variants).
+"""
+import io
+import os
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from PIL import Image, ImageOps
+from .media_store import is_blob
+from .versions import ADVERTISEMENTS_NAMESPACE, bump_version
+
+
+# Имя варианта -> (ширина, высота, обрезать до точного размера)
+VARIANTS = {
+    'thumbnail': (240, 240, True),
+    'card': (640, 480, True),
+    'full': (1600, 1600, False),
+}
+FORMATS = (('webp', 'WEBP', 'webp'), ('jpeg', 'JPEG', 'jpg'))
+
+
+def variant_name(name, variant, extension):
+    """Имя файла варианта рядом с оригиналом"""
+    stem = os.path.splitext(name)[0]
+    return f'{stem}__{variant}.{extension}'
+
+
+def open_image(file, size):
+    """
+    Открывает изображение для уменьшения до size. JPEG сразу декодируется
+    в уменьшенном масштабе (draft), что намного быстрее полного декодирования.
+    """
+    image = Image.open(file)
+    image.draft('RGB', size)
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        # Прозрачность JPEG не поддерживает: кладем изображение на белый фон
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def resize(image, width, height, crop):
+    if crop:
+        return ImageOps.fit(image, (width, height), Image.LANCZOS)
+    resized = image.copy()
+    # thumbnail не увеличивает изображение и сохраняет пропорции
+    resized.thumbnail((width, height), Image.LANCZOS)
+    return resized
+
+
+def save_file(storage, name, content):
+    """Сохраняет файл под точным именем, заменяя прежнюю версию"""
+    if storage.exists(name):
+        storage.delete(name)
+    return storage.save(name, ContentFile(content))
+
+
+def render_variants(name, storage=None):
+    """Строит и сохраняет все варианты изображения name; возвращает их описание"""
+    storage = storage or default_storage
+    quality = settings.IMAGE_VARIANT_QUALITY
+    largest = (max(size[0] for size in VARIANTS.values()), max(size[1] for size in VARIANTS.values()))
+    with storage.open(name, 'rb') as file:
+        image = open_image(file, largest)
+
+    variants = {'source': name}
+    for variant, (width, height, crop) in VARIANTS.items():
+        resized = resize(image, width, height, crop)
+        description = {'width': resized.width, 'height': resized.height}
+        for key, pillow_format, extension in FORMATS:
+            buffer = io.BytesIO()
+            options = {'quality': quality}
+            if pillow_format == 'JPEG':
+                options.update(optimize=True, progressive=True)
+            else:
+                options['method'] = 4
+            resized.save(buffer, pillow_format, **options)
+            description[key] = save_file(storage, variant_name(name, variant, extension), buffer.getvalue())
+        variants[variant] = description
+    return variants
+
+
+def render_safely(name):
+    """render_variants для пула процессов: возвращает (варианты, текст ошибки)"""
+    try:
+        return render_variants(name), None
+    except Exception as e:
+        return None, str(e)
+
+
+def delete_variants(variants, storage=None):
+    """Удаляет файлы вариантов"""
+    storage = storage or default_storage
+    for variant in VARIANTS:
+        for key, _, _ in FORMATS:
+            name = variants.get(variant, {}).get(key)
+            if name:
+                storage.delete(name)
+
+
+def delete_derived(name, storage=None):
+    """Удаляет файлы вариантов по имени исходного файла"""
+    storage = storage or default_storage
+    for variant in VARIANTS:
+        for _, _, extension in FORMATS:
+            storage.delete(variant_name(name, variant, extension))
+
+
+def shared_variants(name):
+    """Варианты, уже построенные для того же файла у другого изображения (ads.media_store)"""
+    from .models import AdvertisementImage
+    return AdvertisementImage.objects.filter(
+        image=name, variants__source=name
+    ).values_list('variants', flat=True).first()
+
+
+def is_current(image):
+    """Варианты построены для текущего файла изображения"""
+    return bool(image.image) and image.variants.get('source') == image.image.name
+
+
+def store(results):
+    """
+    Записывает построенные варианты: results - пары (изображение, варианты).
+    Меняет updated_at объявлений и версию лент, чтобы клиенты получили новые ссылки.
+    """
+    from .models import AdvertisementImage
+    advertisement_ids = set()
+    for image, variants in results:
+        previous = image.variants
+        AdvertisementImage.objects.filter(pk=image.pk).update(variants=variants)
+        image.variants = variants
+        advertisement_ids.add(image.advertisement_id)
+        if previous and previous.get('source') != variants['source'] and not is_blob(previous.get('source')):
+            # Изображение заменили: копии прежнего файла больше не нужны.
+            # Копии общих файлов удаляются вместе с файлом (media_store.collect)
+            delete_variants(previous)
+    touch(advertisement_ids)
+
+
+def touch(advertisement_ids):
+    """Обновляет updated_at объявлений и версию лент после изменения их фотографий"""
+    from .models import Advertisement
+    advertisement_ids = set(advertisement_ids)
+    if advertisement_ids:
+        Advertisement.objects.filter(pk__in=advertisement_ids).update(updated_at=timezone.now())
+        bump_version(ADVERTISEMENTS_NAMESPACE)
+
+
+def variant_urls(image, request):
+    """Ссылки на варианты для API: {'card': {'width', 'height', 'webp', 'jpeg'}, ...}"""
+    if not is_current(image):
+        return {}
+    urls = {}
+    for variant in VARIANTS:
+        description = image.variants.get(variant)
+        if not description:
+            continue
+        data = {'width': description['width'], 'height': description['height']}
+        for key, _, _ in FORMATS:
+            url = default_storage.url(description[key])
+            data[key] = request.build_absolute_uri(url) if request is not None else url
+        urls[variant] = data
+    return urls
@@ -0,0 +1,73 @@
+import time
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Prefetch
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from ads import fast_serializers
+from ads.models import Advertisement, Favorite
+from ads.serializers import AdvertisementDetailSerializer, AdvertisementListSerializer, FavoriteSerializer
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает скорость обычных сериализаторов DRF и быстрого представления объявлений'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=200,
+            help='Сколько раз сериализовать каждую выборку'
+        )
+        parser.add_argument(
+            '--page-size',
+            type=int,
+            default=20,
+            help='Количество объявлений в списке'
+        )
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        page_size = options['page_size']
+
+        # Данные загружаются один раз: замеряется только сериализация
+        advertisements = list(Advertisement.objects.for_listing()[:page_size])
+        if not advertisements:
+            raise CommandError('Нет объявлений для замера, создайте данные (например, init_data)')
+        detail = Advertisement.objects.for_listing().prefetch_related('images').get(pk=advertisements[0].pk)
+        favorites = list(
+            Favorite.objects.prefetch_related(
+                Prefetch('advertisement', queryset=Advertisement.objects.for_listing())
+            )[:page_size]
+        )
+
+        cases = [
+            ('Список объявлений', AdvertisementListSerializer, advertisements, True),
+            ('Карточка объявления', AdvertisementDetailSerializer, detail, False),
+        ]
+        if favorites:
+            cases.append(('Избранное', FavoriteSerializer, favorites, True))
+
+        for title, serializer_class, instance, many in cases:
+            objects = len(instance) if many else 1
+            generic = self.measure(serializer_class, instance, many, iterations, generic=True)
+            fast = self.measure(serializer_class, instance, many, iterations, generic=False)
+            self.stdout.write(
+                f'{title}: DRF {objects * iterations / generic:,.0f} об/с, '
+                f'быстрое представление {objects * iterations / fast:,.0f} об/с '
+                f'(в {generic / fast:.1f} раза быстрее)'
+            )
+        self.stdout.write(self.style.SUCCESS('✅ Замер завершен'))
+
+    def measure(self, serializer_class, instance, many, iterations, generic):
+        request = Request(APIRequestFactory().get('/api/advertisements/', HTTP_HOST='localhost'))
+        request.user = AnonymousUser()
+        context = {'request': request}
+        if generic:
+            context[fast_serializers.GENERIC_CONTEXT_KEY] = True
+        renderer = JSONRenderer()
+        started = time.perf_counter()
+        for _ in range(iterations):
+            renderer.render(serializer_class(instance, many=many, context=context).data)
+        return time.perf_counter() - started
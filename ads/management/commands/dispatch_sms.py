@@ -0,0 +1,43 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from ads import sms_outbox
+
+
+class Command(BaseCommand):
+    help = 'Отправляет исходящие SMS из outbox пачками'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=None,
+            help='Сколько SMS отправлять одним запросом к шлюзу (по умолчанию SMS_OUTBOX_BATCH_SIZE)'
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='Не завершаться: проверять outbox каждые TASK_POLL_INTERVAL секунд'
+        )
+
+    def handle(self, *args, **options):
+        if not options['loop']:
+            sent = sms_outbox.dispatch(batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f'✅ Отправлено SMS: {sent}'))
+            return
+
+        self.stdout.write(self.style.SUCCESS('✅ Диспетчер SMS запущен (Ctrl+C - остановка)'))
+        try:
+            while True:
+                try:
+                    sent = sms_outbox.dispatch(batch_size=options['batch_size'])
+                    if sent:
+                        self.stdout.write(f'Отправлено SMS: {sent}')
+                except Exception as e:
+                    print(f"Ошибка диспетчера SMS: {e}")
+                finally:
+                    close_old_connections()
+                time.sleep(settings.TASK_POLL_INTERVAL)
+        except KeyboardInterrupt:
+            pass
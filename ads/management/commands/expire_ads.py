@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from ads import expiration
+
+
+class Command(BaseCommand):
+    help = 'Переводит активные объявления с истекшим сроком в неактивные'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=None,
+            help='Сколько объявлений снимать одной транзакцией (по умолчанию ADVERTISEMENT_EXPIRE_BATCH_SIZE)'
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=None,
+            help='Снять не больше указанного количества объявлений'
+        )
+        parser.add_argument(
+            '--schedule',
+            action='store_true',
+            help='Не снимать сейчас, а поставить периодическую задачу в фоновую очередь'
+        )
+
+    def handle(self, *args, **options):
+        if options['schedule']:
+            if expiration.schedule():
+                self.stdout.write(self.style.SUCCESS('✅ Периодическое снятие истекших объявлений запланировано'))
+            else:
+                self.stdout.write(self.style.WARNING('⚠️ Задача уже есть в очереди'))
+            return
+        total = expiration.sweep(batch_size=options['batch_size'], limit=options['limit'])
+        self.stdout.write(self.style.SUCCESS(f'✅ Снято истекших объявлений: {total}'))
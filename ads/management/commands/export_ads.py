@@ -0,0 +1,49 @@
+import sys
+from django.core.management.base import BaseCommand
+from ads import catalog_io
+
+
+class Command(BaseCommand):
+    help = 'Выгружает города, категории, объявления и данные фотографий в NDJSON или CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output',
+            default='-',
+            help='Файл NDJSON или папка для CSV; "-" - стандартный вывод (только NDJSON)'
+        )
+        parser.add_argument(
+            '--format',
+            choices=['ndjson', 'csv'],
+            default='ndjson',
+            help='Формат выгрузки'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=2000,
+            help='Сколько строк читать из БД за раз'
+        )
+
+    def handle(self, *args, **options):
+        output = options['output']
+        records = catalog_io.export_records(chunk_size=options['chunk_size'])
+        # При выгрузке в стандартный вывод сообщения пишутся в stderr
+        log = self.stderr if output == '-' else self.stdout
+
+        if options['format'] == 'csv':
+            if output == '-':
+                self.stderr.write(self.style.ERROR('CSV выгружается в папку: укажите --output'))
+                return
+            counts = catalog_io.write_csv(records, output)
+        elif output == '-':
+            counts = catalog_io.write_ndjson(records, sys.stdout.buffer)
+            sys.stdout.buffer.flush()
+        else:
+            with open(output, 'wb') as file:
+                counts = catalog_io.write_ndjson(records, file)
+
+        log.write(self.style.SUCCESS(
+            f"✅ Выгружено: городов {counts['city']}, категорий {counts['category']}, "
+            f"объявлений {counts['advertisement']}, фотографий {counts['image']}"
+        ))
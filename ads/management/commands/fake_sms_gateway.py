@@ -0,0 +1,24 @@
+import time
+from django.core.management.base import BaseCommand
+from ads.sms_fake_gateway import FakeSMSGateway
+
+
+class Command(BaseCommand):
+    help = 'Запускает локальный поддельный SMS-шлюз (API smsc.ru) для разработки'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='Адрес для входящих запросов')
+        parser.add_argument('--port', type=int, default=8025, help='Порт для входящих запросов')
+
+    def handle(self, *args, **options):
+        with FakeSMSGateway(options['host'], options['port']) as gateway:
+            self.stdout.write(self.style.SUCCESS(f'✅ Шлюз запущен: SMS_GATEWAY_URL={gateway.url}'))
+            shown = 0
+            try:
+                while True:
+                    time.sleep(0.5)
+                    for params in gateway.requests[shown:]:
+                        self.stdout.write(f"📱 {params.get('phones')}: {params.get('mes')}")
+                    shown = len(gateway.requests)
+            except KeyboardInterrupt:
+                pass
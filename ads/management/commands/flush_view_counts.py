@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from ads import view_counter
+
+
+class Command(BaseCommand):
+    help = 'Записывает накопленные просмотры объявлений в БД'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Сброс счетчиков просмотров...')
+        recovered = view_counter.recover()
+        flushed = view_counter.flush()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'✅ Просмотры записаны, объявлений: {flushed}, из журналов завершившихся процессов: {recovered}'
+            )
+        )
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from ads import media_store
+
+
+class Command(BaseCommand):
+    help = 'Удаляет файлы фотографий, на которые больше не ссылается ни одно изображение'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--grace',
+            type=int,
+            default=None,
+            help='Сколько секунд файл без ссылок хранится до удаления (по умолчанию MEDIA_BLOB_GC_GRACE)'
+        )
+        parser.add_argument(
+            '--recount',
+            action='store_true',
+            help='Перед удалением пересчитать счетчики ссылок по изображениям'
+        )
+
+    def handle(self, *args, **options):
+        if options['recount']:
+            blobs = media_store.recount()
+            self.stdout.write(f'Счетчики ссылок пересчитаны, файлов: {blobs}')
+        removed = media_store.collect(options['grace'])
+        self.stdout.write(self.style.SUCCESS(f'✅ Удалено файлов без ссылок: {removed}'))
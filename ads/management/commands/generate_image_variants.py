@@ -0,0 +1,78 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import django
+from django.core.management.base import BaseCommand
+from ads import image_variants
+from ads.models import AdvertisementImage
+
+
+class Command(BaseCommand):
+    help = 'Строит уменьшенные копии (WebP и JPEG) для уже загруженных изображений объявлений'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Количество процессов для обработки изображений'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=200,
+            help='Сколько изображений обрабатывать и записывать за раз'
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Перестроить копии и для изображений, у которых они уже есть'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        images = AdvertisementImage.objects.exclude(image='').only('id', 'advertisement', 'image', 'variants')
+        pending = [image.pk for image in images.iterator(chunk_size=batch_size)
+                   if options['force'] or not image_variants.is_current(image)]
+        self.stdout.write(f'Изображений для обработки: {len(pending)}')
+        if not pending:
+            self.stdout.write(self.style.SUCCESS('✅ Все копии уже построены'))
+            return
+
+        done = failed = 0
+        with self.pool(options['workers']) as executor:
+            for start in range(0, len(pending), batch_size):
+                batch = list(images.filter(pk__in=pending[start:start + batch_size]))
+                names = [image.image.name for image in batch]
+                results = []
+                for image, (variants, error) in zip(batch, executor.map(image_variants.render_safely, names)):
+                    if error:
+                        failed += 1
+                        self.stdout.write(self.style.WARNING(f'⚠️ Изображение {image.pk} ({image.image.name}): {error}'))
+                    else:
+                        results.append((image, variants))
+                image_variants.store(results)
+                done += len(results)
+                self.stdout.write(f'Обработано {min(start + batch_size, len(pending))} из {len(pending)}')
+
+        self.stdout.write(self.style.SUCCESS(f'✅ Копии построены: {done}, ошибок: {failed}'))
+
+    def pool(self, workers):
+        if workers <= 1:
+            return InProcessExecutor()
+        # Процессы запускаются заново (spawn) и работают только с файлами, без соединений с БД
+        context = multiprocessing.get_context('spawn')
+        return ProcessPoolExecutor(workers, mp_context=context, initializer=django.setup)
+
+
+class InProcessExecutor:
+    """Обработка в текущем процессе (--workers 1)"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def map(self, function, *iterables):
+        return map(function, *iterables)
@@ -0,0 +1,126 @@
+import multiprocessing
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import django
+from django.core.management.base import BaseCommand, CommandError
+from ads import catalog_io
+
+
+class Command(BaseCommand):
+    help = 'Загружает города, категории, объявления и данные фотографий из выгрузки export_ads'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'input',
+            help='Файл NDJSON или папка с CSV; "-" - стандартный ввод (только NDJSON)'
+        )
+        parser.add_argument(
+            '--format',
+            choices=['ndjson', 'csv'],
+            default='ndjson',
+            help='Формат выгрузки'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Сколько объявлений или фотографий сохранять одним запросом'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Количество процессов для сохранения пачек объявлений и фотографий'
+        )
+        parser.add_argument(
+            '--skip-search-index',
+            action='store_true',
+            help='Не индексировать загруженные объявления для поиска'
+        )
+
+    def handle(self, *args, **options):
+        if options['format'] == 'csv':
+            if options['input'] == '-':
+                raise CommandError('CSV загружается из папки')
+            self.load(catalog_io.read_csv(options['input']), options)
+        elif options['input'] == '-':
+            self.load(catalog_io.read_ndjson(sys.stdin.buffer), options)
+        else:
+            with open(options['input'], 'rb') as file:
+                self.load(catalog_io.read_ndjson(file), options)
+
+    def load(self, records, options):
+        self.saved = dict.fromkeys(catalog_io.ORDER, 0)
+        self.skipped = 0
+        workers = options['workers']
+        executor = self.pool(workers) if workers > 1 else None
+        pending = set()
+        search_index = not options['skip_search_index']
+        try:
+            for kind, batch in catalog_io.batches(records, options['batch_size']):
+                if kind not in catalog_io.BATCH_IMPORTERS:
+                    # Справочники сохраняются в этом процессе и раньше ссылающихся на них записей
+                    self.drain(pending)
+                    self.load_reference(kind, batch)
+                elif executor is None:
+                    self.count(kind, catalog_io.import_batch(kind, batch, search_index))
+                else:
+                    if pending and next(iter(pending)).kind != kind:
+                        # Фотографии сохраняются после всех объявлений
+                        self.drain(pending)
+                    # В очереди не больше двух пачек на процесс, чтобы не читать выгрузку наперед
+                    while len(pending) >= workers * 2:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        self.collect(done, pending)
+                    future = executor.submit(catalog_io.import_batch, kind, batch, search_index)
+                    future.kind = kind
+                    pending.add(future)
+            self.drain(pending)
+        except ValueError as e:
+            raise CommandError(str(e))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        self.stdout.write('Обновление счетчиков и подсказок...')
+        catalog_io.finish(images=bool(self.saved['image']))
+        if self.skipped:
+            self.stdout.write(self.style.WARNING(
+                f'⚠️ Пропущено записей без категории, автора или объявления и с неверными значениями: {self.skipped}'
+            ))
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ Загружено: городов {self.saved['city']}, категорий {self.saved['category']}, "
+            f"объявлений {self.saved['advertisement']}, фотографий {self.saved['image']}"
+        ))
+
+    def load_reference(self, kind, batch):
+        records = [catalog_io.normalize(kind, record) for record in batch]
+        if kind == catalog_io.CITY:
+            self.saved[kind] += catalog_io.import_cities(records)
+        else:
+            for record in records:
+                catalog_io.import_category(record)
+            self.saved[kind] += len(records)
+
+    def count(self, kind, result):
+        saved, skipped, errors = result
+        for error in errors:
+            self.stderr.write(error)
+        self.saved[kind] += saved
+        self.skipped += skipped
+        self.stdout.write(f'{kind}: сохранено {self.saved[kind]}')
+
+    def collect(self, done, pending):
+        for future in done:
+            pending.discard(future)
+            self.count(future.kind, future.result())
+
+    def drain(self, pending):
+        if pending:
+            done, _ = wait(pending)
+            self.collect(done, pending)
+
+    def pool(self, workers):
+        # Процессы запускаются заново (spawn) и открывают собственные соединения с БД
+        context = multiprocessing.get_context('spawn')
+        return ProcessPoolExecutor(workers, mp_context=context, initializer=django.setup)
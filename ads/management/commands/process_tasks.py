@@ -0,0 +1,44 @@
+import threading
+from django.core.management.base import BaseCommand
+from ads import image_processing, tasks  # noqa: F401 - регистрирует обработчики задач
+
+
+class Command(BaseCommand):
+    help = 'Разбирает фоновую очередь задач (обработка загруженных фотографий и др.)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--threads',
+            type=int,
+            default=2,
+            help='Количество потоков-обработчиков'
+        )
+        parser.add_argument(
+            '--burst',
+            action='store_true',
+            help='Выполнить готовые задачи и завершиться'
+        )
+
+    def handle(self, *args, **options):
+        if options['burst']:
+            processed = tasks.run_pending(tasks.worker_name('burst'))
+            self.stdout.write(self.style.SUCCESS(f'✅ Выполнено задач: {processed}'))
+            return
+
+        stop = threading.Event()
+        threads = [
+            threading.Thread(
+                target=tasks.work_loop, args=(tasks.worker_name(f'command-{index}'), stop), daemon=True
+            )
+            for index in range(max(options['threads'], 1))
+        ]
+        self.stdout.write(f'Обработчики запущены: {len(threads)}. Остановка - Ctrl+C')
+        for thread in threads:
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(timeout=1)
+        except KeyboardInterrupt:
+            stop.set()
+            self.stdout.write(self.style.SUCCESS('✅ Обработчики остановлены'))
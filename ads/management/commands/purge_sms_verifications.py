@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from ads import verification_store
+
+
+class Command(BaseCommand):
+    help = 'Удаляет истекшие SMS-коды подтверждения'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=None,
+            help='Сколько записей удалять одним запросом (по умолчанию SMS_VERIFICATION_PURGE_BATCH_SIZE)'
+        )
+
+    def handle(self, *args, **options):
+        removed = verification_store.get_store().purge(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'✅ Удалено истекших кодов: {removed}'))
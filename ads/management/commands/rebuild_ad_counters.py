@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from ads import counters
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает счетчики активных объявлений по категориям и городам'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Размер пачки для bulk_create'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write('Пересчет счетчиков объявлений...')
+        rows = counters.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(
+            self.style.SUCCESS(f'✅ Счетчики пересчитаны, строк: {rows}')
+        )
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from ads import search
+
+
+class Command(BaseCommand):
+    help = 'Перестраивает поисковый индекс объявлений'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Количество объявлений в одной пачке'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write('Построение поискового индекса...')
+        total = search.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(
+            self.style.SUCCESS(f'✅ Проиндексировано объявлений: {total}')
+        )
@@ -0,0 +1,145 @@
+"""
+Хранилище фотографий по содержимому.
+
+Файл сохраняется под именем из SHA-256 своего содержимого:
+`blobs/ab/cd/abcd....jpg`. Одинаковые загрузки (повторная отправка фотографий
+при редактировании, одно фото в нескольких объявлениях) записываются на диск
+один раз, а их уменьшенные копии строятся один раз и общие для всех изображений.
+
+Для каждого файла есть запись MediaBlob со счетчиком ссылок - числом
+AdvertisementImage, которые на него указывают. Счетчик меняют сигналы
+изображений (ads.signals) и ads.image_processing. Файлы без ссылок вместе
+с копиями удаляет collect() (команда gc_media) - не сразу, а спустя
+MEDIA_BLOB_GC_GRACE, чтобы успела прикрепиться повторная загрузка тех же байт.
+"""
+import hashlib
+import os
+from collections import Counter, defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db.models import Case, Count, Exists, F, IntegerField, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+
+BLOB_DIR = 'blobs'
+
+
+def digest(file):
+    """SHA-256 содержимого файла; позиция чтения возвращается в начало"""
+    sha = hashlib.sha256()
+    for chunk in file.chunks():
+        sha.update(chunk)
+    file.seek(0)
+    return sha.hexdigest()
+
+
+def blob_name(hexdigest, name):
+    extension = os.path.splitext(name)[1].lower()
+    return f'{BLOB_DIR}/{hexdigest[:2]}/{hexdigest[2:4]}/{hexdigest}{extension}'
+
+
+def is_blob(name):
+    return bool(name) and name.startswith(f'{BLOB_DIR}/')
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """Файловое хранилище, в котором имя файла определяется его содержимым"""
+
+    def save(self, name, content, max_length=None):
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        hexdigest = digest(content)
+        name = blob_name(hexdigest, name)
+        if not self.exists(name):
+            name = self._save(name, content)
+        register(name, hexdigest, content.size)
+        return name
+
+
+storage = ContentAddressedStorage()
+
+
+def blob_storage():
+    """Хранилище поля AdvertisementImage.image"""
+    return storage
+
+
+def register(name, hexdigest, size):
+    from .models import MediaBlob
+    MediaBlob.objects.get_or_create(name=name, defaults={'digest': hexdigest, 'size': size})
+
+
+def find(file):
+    """Уже сохраненный файл с тем же содержимым или None"""
+    from .models import MediaBlob
+    for blob in MediaBlob.objects.filter(digest=digest(file)).order_by('-refcount'):
+        if storage.exists(blob.name):
+            return blob
+    return None
+
+
+def change_refcount(name, delta):
+    from .models import MediaBlob
+    if is_blob(name):
+        MediaBlob.objects.filter(name=name).update(refcount=F('refcount') + delta, updated_at=timezone.now())
+
+
+def acquire(name):
+    change_refcount(name, 1)
+
+
+def release(name):
+    change_refcount(name, -1)
+
+
+def release_many(names):
+    """Снимает ссылки на несколько файлов одним UPDATE (повторяющееся имя - несколько ссылок)"""
+    from .models import MediaBlob
+    counts = Counter(name for name in names if is_blob(name))
+    if not counts:
+        return
+    by_count = defaultdict(list)
+    for name, count in counts.items():
+        by_count[count].append(name)
+    MediaBlob.objects.filter(name__in=counts).update(
+        refcount=F('refcount') - Case(
+            *[When(name__in=group, then=Value(count)) for count, group in by_count.items()],
+            default=Value(0),
+            output_field=IntegerField(),
+        ),
+        updated_at=timezone.now(),
+    )
+
+
+def collect(grace=None):
+    """Удаляет файлы без ссылок и их копии; возвращает количество удаленных файлов"""
+    from .models import AdvertisementImage, MediaBlob
+    from .image_variants import delete_derived
+    grace = settings.MEDIA_BLOB_GC_GRACE if grace is None else grace
+    deadline = timezone.now() - timedelta(seconds=grace)
+    # Проверка по изображениям страхует от рассинхронизации счетчика
+    candidates = MediaBlob.objects.filter(refcount__lte=0, updated_at__lte=deadline).exclude(
+        Exists(AdvertisementImage.objects.filter(image=OuterRef('name')))
+    )
+    removed = 0
+    for blob in candidates.iterator():
+        # Файл могли снова прикрепить, пока шел обход
+        deleted, _ = MediaBlob.objects.filter(pk=blob.pk, refcount__lte=0, updated_at=blob.updated_at).delete()
+        if not deleted:
+            continue
+        storage.delete(blob.name)
+        delete_derived(blob.name, storage)
+        removed += 1
+    return removed
+
+
+def recount():
+    """Пересчитывает счетчики ссылок по изображениям; возвращает количество файлов"""
+    from .models import AdvertisementImage, MediaBlob
+    references = AdvertisementImage.objects.filter(image=OuterRef('name')).order_by().values('image').annotate(
+        total=Count('id')
+    ).values('total')
+    return MediaBlob.objects.update(refcount=Coalesce(Subquery(references), Value(0)))
@@ -0,0 +1,58 @@
+# Generated by Django 4.2.7 on 2026-10-17 22:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_counters(apps, schema_editor):
+    Advertisement = apps.get_model('ads', 'Advertisement')
+    AdvertisementCounter = apps.get_model('ads', 'AdvertisementCounter')
+    rows = (
+        Advertisement.objects.filter(status='active')
+        .order_by()
+        .values('category_id', 'city_id')
+        .annotate(total=models.Count('pk'))
+    )
+    AdvertisementCounter.objects.bulk_create(
+        [
+            AdvertisementCounter(
+                category_id=row['category_id'],
+                city_id=row['city_id'],
+                active_count=row['total'],
+            )
+            for row in rows
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0010_userlastcode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AdvertisementCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('active_count', models.PositiveIntegerField(default=0, verbose_name='Активных объявлений')),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='advertisement_counters', to='ads.category', verbose_name='Категория')),
+                ('city', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='advertisement_counters', to='ads.city', verbose_name='Город')),
+            ],
+            options={
+                'verbose_name': 'Счетчик объявлений',
+                'verbose_name_plural': 'Счетчики объявлений',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='advertisementcounter',
+            constraint=models.UniqueConstraint(fields=('category', 'city'), name='ads_counter_category_city_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='advertisementcounter',
+            constraint=models.UniqueConstraint(condition=models.Q(('city__isnull', True)), fields=('category',), name='ads_counter_category_no_city_uniq'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.7 on 2026-10-17 22:56
+
+from django.db import migrations, models
+
+
+def fill_paths(apps, schema_editor):
+    Category = apps.get_model('ads', 'Category')
+    parent_of = dict(Category.objects.values_list('id', 'parent_id'))
+    paths = {}
+
+    def build_path(category_id):
+        if category_id not in paths:
+            parent_id = parent_of[category_id]
+            prefix = build_path(parent_id) if parent_id else '/'
+            paths[category_id] = f'{prefix}{category_id}/'
+        return paths[category_id]
+
+    categories = list(Category.objects.all())
+    for category in categories:
+        category.path = build_path(category.id)
+        category.depth = category.path.count('/') - 2
+    Category.objects.bulk_update(categories, ['path', 'depth'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0011_advertisementcounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='depth',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='Уровень'),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, editable=False, help_text='Идентификаторы предков и самой категории, например /1/5/', max_length=255, verbose_name='Путь в дереве'),
+        ),
+        migrations.RunPython(fill_paths, migrations.RunPython.noop),
+    ]
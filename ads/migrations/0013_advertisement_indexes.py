@@ -0,0 +1,37 @@
+# Generated by Django 4.2.7 on 2026-10-17 22:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0012_category_path'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='advertisement',
+            index=models.Index(fields=['status', '-created_at', '-id'], name='ad_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='advertisement',
+            index=models.Index(fields=['status', 'city', '-created_at', '-id'], name='ad_status_city_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='advertisement',
+            index=models.Index(fields=['status', 'category', 'city', '-created_at'], name='ad_status_cat_city_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='advertisement',
+            index=models.Index(fields=['author', 'status', '-created_at'], name='ad_author_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='advertisement',
+            index=models.Index(fields=['status', 'price', 'id'], name='ad_status_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='advertisement',
+            index=models.Index(fields=['status', 'is_featured', '-created_at', '-id'], name='ad_featured_created_idx'),
+        ),
+    ]
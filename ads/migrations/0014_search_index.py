@@ -0,0 +1,241 @@
+# Generated by Django 4.2.7 on 2026-10-17 23:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+import re
+from collections import Counter
+
+
+# Анализатор текста ads.search на момент миграции: миграция не зависит
+# от текущего кода поиска
+
+FIELD_BOOSTS = {
+    't': 3.0,  # заголовок
+    'c': 2.0,  # категория
+    'l': 1.5,  # местоположение
+    'y': 1.5,  # город
+    'd': 1.0,  # описание
+}
+
+MAX_TERM_LENGTH = 64
+
+TOKEN_RE = re.compile(r'[0-9a-zа-я]+')
+
+STOPWORDS = frozenset('''
+и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по
+только ее мне было вот от меня еще нет о из ему теперь когда даже ну вдруг ли если
+уже или ни быть был него до вас нибудь опять уж вам ведь там потом себя ничего ей
+может они тут где есть надо ней для мы тебя их чем была сам чтоб без будто чего раз
+тоже себе под будет ж тогда кто этот того потому этого какой совсем ним здесь этом
+один почти мой тем чтобы нее были куда зачем всех никогда можно при наконец два об
+другой хоть после над больше тот через эти нас про всего них какая много разве три
+эту моя впрочем свою этой перед иногда чуть том нельзя такой им более всегда всю
+между
+'''.split())
+
+VOWELS = 'аеиоуыэюя'
+
+PERFECTIVE_GERUND = [
+    (('вшись', 'вши', 'в'), True),
+    (('ившись', 'ывшись', 'ивши', 'ывши', 'ив', 'ыв'), False),
+]
+ADJECTIVE = [(
+    ('ими', 'ыми', 'его', 'ого', 'ему', 'ому', 'ее', 'ие', 'ые', 'ое', 'ей', 'ий', 'ый',
+     'ой', 'ем', 'им', 'ым', 'ом', 'их', 'ых', 'ую', 'юю', 'ая', 'яя', 'ою', 'ею'),
+    False
+)]
+PARTICIPLE = [
+    (('ем', 'нн', 'вш', 'ющ', 'щ'), True),
+    (('ивш', 'ывш', 'ующ'), False),
+]
+REFLEXIVE = [(('ся', 'сь'), False)]
+VERB = [
+    (('ла', 'на', 'ете', 'йте', 'ли', 'й', 'л', 'ем', 'н', 'ло', 'но', 'ет', 'ют', 'ны',
+      'ть', 'ешь', 'нно'), True),
+    (('ила', 'ыла', 'ена', 'ейте', 'уйте', 'ите', 'или', 'ыли', 'ей', 'уй', 'ил', 'ыл',
+      'им', 'ым', 'ен', 'ило', 'ыло', 'ено', 'ят', 'ует', 'уют', 'ит', 'ыт', 'ены', 'ить',
+      'ыть', 'ишь', 'ую', 'ю'), False),
+]
+NOUN = [(
+    ('а', 'ев', 'ов', 'ие', 'ье', 'е', 'иями', 'ями', 'ами', 'еи', 'ии', 'и', 'ией', 'ей',
+     'ой', 'ий', 'й', 'иям', 'ям', 'ием', 'ем', 'ам', 'ом', 'о', 'у', 'ах', 'иях', 'ях',
+     'ы', 'ь', 'ию', 'ью', 'ю', 'ия', 'ья', 'я'),
+    False
+)]
+SUPERLATIVE = [(('ейше', 'ейш'), False)]
+DERIVATIONAL = [(('ость', 'ост'), False)]
+
+
+def _strip_ending(word, start, groups):
+    """
+    Отрезает самое длинное окончание из groups, целиком лежащее в word[start:].
+    Для групп с флагом окончанию должна предшествовать «а» или «я».
+    Возвращает None, если окончание не найдено.
+    """
+    best = ''
+    for endings, after_a in groups:
+        for ending in endings:
+            if len(ending) <= len(best) or not word.endswith(ending):
+                continue
+            position = len(word) - len(ending)
+            if position < start:
+                continue
+            if after_a and (position - 1 < start or word[position - 1] not in 'ая'):
+                continue
+            best = ending
+    if not best:
+        return None
+    return word[:-len(best)]
+
+
+def _region_after_consonant(word, start):
+    """Начало области после первой согласной, следующей за гласной"""
+    for index in range(start + 1, len(word)):
+        if word[index] not in VOWELS and word[index - 1] in VOWELS:
+            return index + 1
+    return len(word)
+
+
+def stem(word):
+    """Возвращает основу русского слова (алгоритм Snowball)"""
+    word = word.replace('ё', 'е')
+    rv = next((index + 1 for index, char in enumerate(word) if char in VOWELS), None)
+    if rv is None:
+        return word
+    r1 = _region_after_consonant(word, 0)
+    r2 = _region_after_consonant(word, r1)
+
+    # Шаг 1
+    stripped = _strip_ending(word, rv, PERFECTIVE_GERUND)
+    if stripped is None:
+        reflexive = _strip_ending(word, rv, REFLEXIVE)
+        if reflexive is not None:
+            word = reflexive
+        adjective = _strip_ending(word, rv, ADJECTIVE)
+        if adjective is not None:
+            participle = _strip_ending(adjective, rv, PARTICIPLE)
+            stripped = participle if participle is not None else adjective
+        else:
+            stripped = _strip_ending(word, rv, VERB)
+            if stripped is None:
+                stripped = _strip_ending(word, rv, NOUN)
+    if stripped is not None:
+        word = stripped
+
+    # Шаг 2
+    if word.endswith('и') and len(word) - 1 >= rv:
+        word = word[:-1]
+
+    # Шаг 3
+    derivational = _strip_ending(word, r2, DERIVATIONAL)
+    if derivational is not None:
+        word = derivational
+
+    # Шаг 4
+    if word.endswith('нн') and len(word) - 2 >= rv:
+        return word[:-1]
+    superlative = _strip_ending(word, rv, SUPERLATIVE)
+    if superlative is not None:
+        word = superlative
+        if word.endswith('нн') and len(word) - 2 >= rv:
+            word = word[:-1]
+    elif word.endswith('ь') and len(word) - 1 >= rv:
+        word = word[:-1]
+    return word
+
+
+def tokenize(text):
+    """Разбивает текст на слова в нижнем регистре"""
+    return TOKEN_RE.findall((text or '').lower().replace('ё', 'е'))
+
+
+def normalize(token):
+    """Приводит слово к термину индекса"""
+    if any('а' <= char <= 'я' for char in token):
+        token = stem(token)
+    return token[:MAX_TERM_LENGTH]
+
+
+def analyze(text):
+    """Список терминов текста без стоп-слов"""
+    terms = []
+    for token in tokenize(text):
+        if token in STOPWORDS or (len(token) < 2 and not token.isdigit()):
+            continue
+        term = normalize(token)
+        if term:
+            terms.append(term)
+    return terms
+
+
+def fill_index(apps, schema_editor):
+    Advertisement = apps.get_model('ads', 'Advertisement')
+    SearchDocument = apps.get_model('ads', 'SearchDocument')
+    SearchPosting = apps.get_model('ads', 'SearchPosting')
+
+    postings = []
+    documents = []
+    for advertisement in Advertisement.objects.select_related('category', 'city').iterator(chunk_size=500):
+        fields = {
+            't': advertisement.title,
+            'd': advertisement.description,
+            'l': advertisement.location,
+            'c': advertisement.category.name,
+            'y': advertisement.city.name if advertisement.city_id else '',
+        }
+        length = 0.0
+        for field, text in fields.items():
+            frequencies = Counter(analyze(text))
+            length += FIELD_BOOSTS[field] * sum(frequencies.values())
+            postings.extend(
+                SearchPosting(term=term, advertisement_id=advertisement.pk, field=field, frequency=frequency)
+                for term, frequency in frequencies.items()
+            )
+        documents.append(SearchDocument(advertisement_id=advertisement.pk, length=length))
+        if len(documents) >= 500:
+            SearchPosting.objects.bulk_create(postings, batch_size=500)
+            SearchDocument.objects.bulk_create(documents, batch_size=500)
+            postings, documents = [], []
+    SearchPosting.objects.bulk_create(postings, batch_size=500)
+    SearchDocument.objects.bulk_create(documents, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0013_advertisement_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('advertisement', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='ads.advertisement', verbose_name='Объявление')),
+                ('length', models.FloatField(default=0, verbose_name='Взвешенная длина документа')),
+                ('indexed_at', models.DateTimeField(auto_now=True, verbose_name='Дата индексации')),
+            ],
+            options={
+                'verbose_name': 'Поисковый документ',
+                'verbose_name_plural': 'Поисковые документы',
+            },
+        ),
+        migrations.CreateModel(
+            name='SearchPosting',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(db_index=True, max_length=64, verbose_name='Термин')),
+                ('field', models.CharField(choices=[('t', 'Заголовок'), ('d', 'Описание'), ('l', 'Местоположение'), ('c', 'Категория'), ('y', 'Город')], max_length=1, verbose_name='Поле')),
+                ('frequency', models.PositiveSmallIntegerField(default=1, verbose_name='Частота')),
+                ('advertisement', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_postings', to='ads.advertisement', verbose_name='Объявление')),
+            ],
+            options={
+                'verbose_name': 'Вхождение термина',
+                'verbose_name_plural': 'Вхождения терминов',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='searchposting',
+            constraint=models.UniqueConstraint(fields=('term', 'advertisement', 'field'), name='search_posting_uniq'),
+        ),
+        migrations.RunPython(fill_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.7 on 2026-10-17 23:44
+
+import ads.media_store
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0017_image_uploads'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='advertisementimage',
+            name='image',
+            field=models.ImageField(storage=ads.media_store.blob_storage, upload_to='advertisements/%Y/%m/%d/', verbose_name='Изображение'),
+        ),
+        migrations.CreateModel(
+            name='MediaBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='Путь к файлу')),
+                ('digest', models.CharField(db_index=True, max_length=64, verbose_name='SHA-256')),
+                ('size', models.PositiveBigIntegerField(default=0, verbose_name='Размер')),
+                ('refcount', models.IntegerField(default=0, verbose_name='Ссылок')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата изменения счетчика')),
+            ],
+            options={
+                'verbose_name': 'Файл фотографии',
+                'verbose_name_plural': 'Файлы фотографий',
+                'indexes': [models.Index(fields=['refcount', 'updated_at'], name='media_blob_gc_idx')],
+            },
+        ),
+    ]
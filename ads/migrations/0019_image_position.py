@@ -0,0 +1,22 @@
+# Generated by Django 4.2.7 on 2026-10-17 23:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0018_media_blobs'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='advertisementimage',
+            options={'ordering': ['-is_primary', 'position', 'created_at'], 'verbose_name': 'Изображение объявления', 'verbose_name_plural': 'Изображения объявлений'},
+        ),
+        migrations.AddField(
+            model_name='advertisementimage',
+            name='position',
+            field=models.PositiveIntegerField(default=0, verbose_name='Порядок'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-17 23:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0019_image_position'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='advertisement',
+            index=models.Index(fields=['status', 'expires_at', 'id'], name='ad_status_expires_idx'),
+        ),
+    ]
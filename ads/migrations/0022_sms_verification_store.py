@@ -0,0 +1,43 @@
+# Generated by Django 4.2.7 on 2026-10-18 00:06
+
+from django.db import migrations, models
+
+
+def remove_duplicates(apps, schema_editor):
+    """Оставляет по номеру только последнюю запись перед добавлением уникальности"""
+    SMSVerification = apps.get_model('ads', 'SMSVerification')
+    duplicated = (
+        SMSVerification.objects.order_by()
+        .values('phone')
+        .annotate(total=models.Count('pk'))
+        .filter(total__gt=1)
+        .values_list('phone', flat=True)
+    )
+    for phone in list(duplicated):
+        latest = SMSVerification.objects.filter(phone=phone).order_by('-created_at', '-pk').first()
+        SMSVerification.objects.filter(phone=phone).exclude(pk=latest.pk).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0021_sms_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='smsverification',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='Попыток'),
+        ),
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='smsverification',
+            name='phone',
+            field=models.CharField(max_length=15, unique=True, verbose_name='Номер телефона'),
+        ),
+        migrations.AddIndex(
+            model_name='smsverification',
+            index=models.Index(fields=['expires_at', 'id'], name='sms_verification_expires_idx'),
+        ),
+    ]
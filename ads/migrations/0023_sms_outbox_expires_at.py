@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 00:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0022_sms_verification_store'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='smsoutbox',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Актуально до'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-18 00:45
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def fill_stats(apps, schema_editor):
+    SearchDocument = apps.get_model('ads', 'SearchDocument')
+    SearchStats = apps.get_model('ads', 'SearchStats')
+
+    stats = SearchDocument.objects.aggregate(documents=Count('pk'), length=Sum('length'))
+    SearchStats.objects.create(pk=1, documents=stats['documents'], total_length=stats['length'] or 0.0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0023_sms_outbox_expires_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('documents', models.PositiveIntegerField(default=0, verbose_name='Документов')),
+                ('total_length', models.FloatField(default=0, verbose_name='Суммарная длина документов')),
+            ],
+            options={
+                'verbose_name': 'Статистика поискового индекса',
+                'verbose_name_plural': 'Статистика поискового индекса',
+            },
+        ),
+        migrations.RunPython(fill_stats, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,116 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F, OuterRef, Prefetch, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Concat, Substr
 from django.contrib.auth.models import User
 from django.utils import timezone
 from django.core.validators import MinValueValidator, MaxValueValidator
-import random
-import string
+import uuid
+from .media_store import blob_storage
+
+
+def active_advertisements_count(field):
+    """Подзапрос с количеством активных объявлений из таблицы счетчиков по полю field"""
+    return Coalesce(
+        Subquery(
+            AdvertisementCounter.objects.filter(**{field: OuterRef('pk')})
+            .order_by()
+            .values(field)
+            .annotate(total=Sum('active_count'))
+            .values('total')
+        ),
+        0
+    )
+
+
+class CityQuerySet(models.QuerySet):
+    def with_counts(self, selection=None):
+        """Добавляет количество активных объявлений, чтобы сериализатор не делал запрос на каждый город"""
+        from .field_selection import includes, restrict
+        queryset = self
+        if includes(selection, 'advertisements_count'):
+            queryset = queryset.annotate(active_ads_count=active_advertisements_count('city'))
+        return restrict(queryset, selection)
+
+
+class CategoryQuerySet(models.QuerySet):
+    # Поля модели, из которых строятся ключи ответа с другими именами
+    selection_sources = {'level': ('depth',)}
+
+    def with_counts(self, selection=None, keep=()):
+        """
+        Добавляет счетчики и предзагружает связанные данные для сериализатора категории.
+        selection (ads.field_selection) ограничивает выборку запрошенными полями.
+        """
+        from .field_selection import child, expands, includes, restrict
+        queryset = self
+        if includes(selection, 'advertisements_count'):
+            queryset = queryset.annotate(active_ads_count=active_advertisements_count('category'))
+        if includes(selection, 'cities') and expands(selection, 'cities'):
+            # Строке available_cities_display нужны названия городов
+            city_selection = None if includes(selection, 'available_cities_display') else child(selection, 'cities')
+            queryset = queryset.prefetch_related(
+                Prefetch('cities', queryset=City.objects.with_counts(city_selection))
+            )
+        elif includes(selection, 'cities') or includes(selection, 'available_cities_display'):
+            queryset = queryset.prefetch_related(Prefetch('cities', queryset=City.objects.only('id', 'name')))
+        return restrict(queryset, selection, self.selection_sources, keep)
+
+    def with_children(self, selection=None):
+        """То же, что with_counts, плюс предзагруженные подкатегории со счетчиками"""
+        from .field_selection import child, expands, includes
+        queryset = self.with_counts(selection)
+        if not includes(selection, 'children'):
+            return queryset
+        # parent нужен, чтобы разложить подкатегории по родителям
+        if expands(selection, 'children'):
+            children = Category.objects.with_counts(child(selection, 'children'), keep=('parent',))
+        else:
+            children = Category.objects.only('id', 'parent')
+        return queryset.prefetch_related(Prefetch('children', queryset=children))
+
+
+class AdvertisementQuerySet(models.QuerySet):
+    # Поля модели, из которых строятся ключи ответа с другими именами
+    selection_sources = {'is_expired': ('expires_at',)}
+
+    def for_listing(self, selection=None):
+        """
+        Queryset для списков объявлений с фиксированным числом запросов на страницу:
+        счетчики считаются подзапросами, связанные объекты подгружаются через Prefetch.
+        selection (ads.field_selection) оставляет только то, что нужно запрошенным полям.
+        """
+        from .field_selection import child, expands, includes, restrict
+        queryset = self
+        if includes(selection, 'author') and expands(selection, 'author'):
+            queryset = queryset.select_related('author')
+        if includes(selection, 'images_count'):
+            images_total = Coalesce(
+                Subquery(
+                    AdvertisementImage.objects.filter(advertisement=OuterRef('pk'))
+                    .order_by()
+                    .values('advertisement')
+                    .annotate(total=Count('pk'))
+                    .values('total')
+                ),
+                0
+            )
+            queryset = queryset.annotate(images_total=images_total)
+        prefetches = []
+        if includes(selection, 'category') and expands(selection, 'category'):
+            prefetches.append(
+                Prefetch('category', queryset=Category.objects.with_counts(child(selection, 'category')))
+            )
+        if includes(selection, 'city') and expands(selection, 'city'):
+            prefetches.append(Prefetch('city', queryset=City.objects.with_counts(child(selection, 'city'))))
+        if includes(selection, 'primary_image'):
+            prefetches.append(Prefetch(
+                'images',
+                queryset=AdvertisementImage.objects.filter(is_primary=True),
+                to_attr='primary_images'
+            ))
+        # По дате и цене строятся сортировка и курсор пагинации
+        queryset = restrict(queryset, selection, self.selection_sources, keep=('created_at', 'price'))
+        return queryset.prefetch_related(*prefetches)
 
 
 class City(models.Model):
@@ -12,6 +119,8 @@ class City(models.Model):
     slug = models.SlugField(max_length=100, unique=True, verbose_name='URL')
     is_active = models.BooleanField(default=True, verbose_name='Активный')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+
+    objects = CityQuerySet.as_manager()
     
     class Meta:
         verbose_name = 'Город'
@@ -42,9 +151,20 @@ class Category(models.Model):
         verbose_name='Города',
         help_text='Оставьте пустым, чтобы категория была доступна во всех городах'
     )
+    path = models.CharField(
+        max_length=255,
+        blank=True,
+        db_index=True,
+        editable=False,
+        verbose_name='Путь в дереве',
+        help_text='Идентификаторы предков и самой категории, например /1/5/'
+    )
+    depth = models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='Уровень')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата обновления')
 
+    objects = CategoryQuerySet.as_manager()
+
     class Meta:
         verbose_name = 'Категория'
         verbose_name_plural = 'Категории'
@@ -55,25 +175,46 @@ class Category(models.Model):
             return f"{self.parent.name} → {self.name}"
         return self.name
 
+    def save(self, *args, **kwargs):
+        # Путь пересчитывается после сохранения, так как в нем участвует id категории
+        with transaction.atomic():
+            old_path = ''
+            if not self._state.adding:
+                old_path = Category.objects.filter(pk=self.pk).values_list('path', flat=True).first() or ''
+            parent_path = '/'
+            if self.parent_id:
+                parent_path = Category.objects.filter(pk=self.parent_id).values_list('path', flat=True).first() or '/'
+                if old_path and parent_path.startswith(old_path):
+                    raise ValueError('Категория не может быть вложена в собственную подкатегорию')
+
+            super().save(*args, **kwargs)
+
+            new_path = f'{parent_path}{self.pk}/'
+            if new_path != old_path:
+                new_depth = new_path.count('/') - 2
+                Category.objects.filter(pk=self.pk).update(path=new_path, depth=new_depth)
+                if old_path:
+                    # Переносим все поддерево одним запросом
+                    Category.objects.filter(path__startswith=old_path).exclude(pk=self.pk).update(
+                        path=Concat(Value(new_path), Substr('path', len(old_path) + 1)),
+                        depth=F('depth') + (new_depth - (old_path.count('/') - 2)),
+                    )
+                self.path = new_path
+                self.depth = new_depth
+
     def get_unviewed_count_for_user(self, user, city_id=None):
         """Получает количество объявлений в категории (теперь просто возвращает общее количество)"""
+        from . import counters
+        from .category_tree import get_tree
         try:
-            # Если это родительская категория, считаем сумму всех подкатегорий
-            if self.is_parent:
-                total_ads = 0
-                for child in self.get_all_children():
-                    total_ads += child.get_unviewed_count_for_user(user, city_id)
-                return total_ads
-            
-            # Для дочерних категорий считаем только объявления в текущей категории
-            from django.db.models import Q
-            ads_filter = Q(category=self, status='active')
-
-            # Добавляем фильтр по городу, если указан
-            if city_id and city_id != 'all':
-                ads_filter &= Q(city_id=city_id)
-
-            return Advertisement.objects.filter(ads_filter).count()
+            # Для родительской категории считаем сумму по всем конечным подкатегориям
+            category_ids = get_tree().leaf_descendants(self.pk)
+
+            # Фильтр по городу применяем, только если указан конкретный город
+            if not city_id or city_id == 'all':
+                city_id = None
+
+            return counters.count_for_categories(category_ids, city_id)
         except Exception as e:
             print(f"Ошибка в get_unviewed_count_for_user: {e}")
             return 0
@@ -81,39 +222,39 @@ class Category(models.Model):
     @property
     def is_parent(self):
         """Проверяет, является ли категория родительской"""
-        return self.children.exists()
+        from .category_tree import get_tree
+        return get_tree().has_children(self.pk)
 
     @property
     def is_child(self):
         """Проверяет, является ли категория дочерней"""
-        return self.parent is not None
+        return self.parent_id is not None
 
     @property
     def level(self):
         """Возвращает уровень вложенности категории"""
-        level = 0
-        parent = self.parent
-        while parent:
-            level += 1
-            parent = parent.parent
-        return level
+        return self.depth
+
+    def get_ancestor_ids(self):
+        """Идентификаторы предков категории, начиная с ближайшего"""
+        return [int(part) for part in reversed(self.path.strip('/').split('/')[:-1])]
+
+    def get_descendant_ids(self):
+        """Идентификаторы всех подкатегорий из снимка дерева"""
+        from .category_tree import get_tree
+        return get_tree().descendants(self.pk)
 
     def get_all_children(self):
         """Получает все дочерние категории (рекурсивно)"""
-        children = []
-        for child in self.children.all():
-            children.append(child)
-            children.extend(child.get_all_children())
-        return children
+        descendant_ids = self.get_descendant_ids()
+        categories = Category.objects.in_bulk(descendant_ids)
+        return [categories[pk] for pk in descendant_ids if pk in categories]
 
     def get_all_parents(self):
         """Получает всех родителей категории"""
-        parents = []
-        parent = self.parent
-        while parent:
-            parents.append(parent)
-            parent = parent.parent
-        return parents
+        parent_ids = self.get_ancestor_ids()
+        categories = Category.objects.in_bulk(parent_ids)
+        return [categories[pk] for pk in parent_ids if pk in categories]
 
     def is_available_in_city(self, city):
         """Проверяет, доступна ли категория в указанном городе"""
@@ -190,19 +331,81 @@ class Advertisement(models.Model):
         verbose_name='Дата истечения'
     )
 
+    objects = AdvertisementQuerySet.as_manager()
+
     class Meta:
         verbose_name = 'Объявление'
         verbose_name_plural = 'Объявления'
         ordering = ['-created_at']
+        # Индексы повторяют фильтры и сортировки AdvertisementViewSet
+        indexes = [
+            # Лента: status=active ORDER BY -created_at (id - для курсорной пагинации)
+            models.Index(fields=['status', '-created_at', '-id'], name='ad_status_created_idx'),
+            # by_city и список с city_id
+            models.Index(fields=['status', 'city', '-created_at', '-id'], name='ad_status_city_created_idx'),
+            # Список с фильтром category и by_category_and_city
+            models.Index(fields=['status', 'category', 'city', '-created_at'], name='ad_status_cat_city_idx'),
+            # my_advertisements и pending
+            models.Index(fields=['author', 'status', '-created_at'], name='ad_author_status_idx'),
+            # Фильтры и сортировка по цене
+            models.Index(fields=['status', 'price', 'id'], name='ad_status_price_idx'),
+            # featured
+            models.Index(fields=['status', 'is_featured', '-created_at', '-id'], name='ad_featured_created_idx'),
+            # Снятие истекших объявлений (ads.expiration): status=active AND expires_at <= now
+            models.Index(fields=['status', 'expires_at', 'id'], name='ad_status_expires_idx'),
+        ]
 
     def __str__(self):
         return self.title
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Запоминаем ключ счетчика из БД, чтобы при сохранении не перечитывать строку
+        if {'status', 'category_id', 'city_id'} <= instance.__dict__.keys():
+            instance._stored_counter_key = instance.counter_key
+        return instance
+
+    @property
+    def counter_key(self):
+        """Ключ строки AdvertisementCounter, в которой учитывается объявление"""
+        if self.status != 'active':
+            return None
+        return (self.category_id, self.city_id)
+
     def save(self, *args, **kwargs):
+        from . import counters
+
         # Автоматически устанавливаем дату истечения через 30 дней
         if not self.expires_at:
             self.expires_at = timezone.now() + timezone.timedelta(days=30)
-        super().save(*args, **kwargs)
+
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and not {'status', 'category', 'city'} & set(update_fields):
+            super().save(*args, **kwargs)
+            return
+
+        # Счетчики меняются в той же транзакции, что и само объявление
+        with transaction.atomic():
+            old_key = counters.stored_key(self)
+            if self.renew_expired(was_active=old_key is not None) and update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'expires_at'}
+            super().save(*args, **kwargs)
+            new_key = self.counter_key
+            counters.apply_change(old_key, new_key)
+            self._stored_counter_key = new_key
+
+    def renew_expired(self, was_active, now=None):
+        """
+        Снова активируемому объявлению с прошедшим сроком дает новые 30 дней,
+        иначе снятие истекших объявлений сразу выключит его опять.
+        Возвращает True, если срок изменен
+        """
+        now = now or timezone.now()
+        if self.status != 'active' or was_active or not self.expires_at or self.expires_at > now:
+            return False
+        self.expires_at = now + timezone.timedelta(days=30)
+        return True
 
     @property
     def is_expired(self):
@@ -212,31 +415,91 @@ class Advertisement(models.Model):
         return False
 
     def increment_views(self):
-        """Увеличивает счетчик просмотров объявления"""
-        self.views_count += 1
-        self.save(update_fields=['views_count'])
+        """
+        Учитывает просмотр в буфере (в БД попадет при сбросе буфера)
+        и возвращает приблизительное общее число просмотров
+        """
+        from . import view_counter
+
+        return self.views_count + view_counter.record(self.pk)
+
+
+class AdvertisementCounter(models.Model):
+    """Денормализованный счетчик активных объявлений по категории и городу"""
+    category = models.ForeignKey(
+        Category,
+        on_delete=models.CASCADE,
+        related_name='advertisement_counters',
+        verbose_name='Категория'
+    )
+    city = models.ForeignKey(
+        City,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='advertisement_counters',
+        verbose_name='Город'
+    )
+    active_count = models.PositiveIntegerField(default=0, verbose_name='Активных объявлений')
+
+    class Meta:
+        verbose_name = 'Счетчик объявлений'
+        verbose_name_plural = 'Счетчики объявлений'
+        constraints = [
+            models.UniqueConstraint(fields=['category', 'city'], name='ads_counter_category_city_uniq'),
+            models.UniqueConstraint(
+                fields=['category'],
+                condition=Q(city__isnull=True),
+                name='ads_counter_category_no_city_uniq'
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.category} / {self.city or 'без города'}: {self.active_count}"
 
 
 class AdvertisementImage(models.Model):
     """Модель изображения объявления"""
+    STATUS_PROCESSING = 'processing'
+    STATUS_READY = 'ready'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PROCESSING, 'Обрабатывается'),
+        (STATUS_READY, 'Готово'),
+        (STATUS_FAILED, 'Ошибка обработки'),
+    ]
+
     advertisement = models.ForeignKey(
         Advertisement, 
         on_delete=models.CASCADE, 
         related_name='images',
         verbose_name='Объявление'
     )
+    # Файлы хранятся по содержимому, одинаковые - один раз (см. ads.media_store)
     image = models.ImageField(
         upload_to='advertisements/%Y/%m/%d/', 
+        storage=blob_storage,
         verbose_name='Изображение'
     )
     caption = models.CharField(max_length=200, blank=True, verbose_name='Подпись')
     is_primary = models.BooleanField(default=False, verbose_name='Главное изображение')
+    # Порядок показа; главное изображение всегда идет первым
+    position = models.PositiveIntegerField(default=0, verbose_name='Порядок')
+    # Уменьшенные копии изображения (см. ads.image_variants)
+    variants = models.JSONField(default=dict, blank=True, editable=False, verbose_name='Варианты')
+    # Загруженный через API файл сначала лежит во временной папке и обрабатывается в фоне (ads.image_processing)
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default=STATUS_READY,
+        verbose_name='Статус обработки'
+    )
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата загрузки')
 
     class Meta:
         verbose_name = 'Изображение объявления'
         verbose_name_plural = 'Изображения объявлений'
-        ordering = ['-is_primary', 'created_at']
+        ordering = ['-is_primary', 'position', 'created_at']
 
     def __str__(self):
         return f"Изображение для {self.advertisement.title}"
@@ -251,6 +514,133 @@ class AdvertisementImage(models.Model):
         super().save(*args, **kwargs)
 
 
+class MediaBlob(models.Model):
+    """Файл фотографии в хранилище по содержимому (см. ads.media_store)"""
+    name = models.CharField(max_length=255, unique=True, verbose_name='Путь к файлу')
+    digest = models.CharField(max_length=64, db_index=True, verbose_name='SHA-256')
+    size = models.PositiveBigIntegerField(default=0, verbose_name='Размер')
+    # Сколько изображений ссылается на файл; файлы без ссылок удаляет команда gc_media
+    refcount = models.IntegerField(default=0, verbose_name='Ссылок')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата изменения счетчика')
+
+    class Meta:
+        verbose_name = 'Файл фотографии'
+        verbose_name_plural = 'Файлы фотографий'
+        indexes = [
+            models.Index(fields=['refcount', 'updated_at'], name='media_blob_gc_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.refcount})"
+
+
+class ImageUpload(models.Model):
+    """Загрузка фотографии по частям (см. ads.chunked_upload)"""
+    STATUS_UPLOADING = 'uploading'
+    STATUS_COMPLETE = 'complete'
+    STATUS_CHOICES = [
+        (STATUS_UPLOADING, 'Загружается'),
+        (STATUS_COMPLETE, 'Загружено'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='image_uploads',
+        verbose_name='Пользователь'
+    )
+    filename = models.CharField(max_length=255, verbose_name='Имя файла')
+    size = models.PositiveBigIntegerField(verbose_name='Размер файла')
+    # Сколько байт уже получено: следующая часть должна начинаться с этого смещения
+    offset = models.PositiveBigIntegerField(default=0, verbose_name='Получено байт')
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default=STATUS_UPLOADING,
+        verbose_name='Статус'
+    )
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата обновления')
+
+    class Meta:
+        verbose_name = 'Загрузка фотографии'
+        verbose_name_plural = 'Загрузки фотографий'
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.filename} ({self.offset}/{self.size})"
+
+
+class SearchDocument(models.Model):
+    """Служебные данные поискового индекса по объявлению"""
+    advertisement = models.OneToOneField(
+        Advertisement,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='search_document',
+        verbose_name='Объявление'
+    )
+    length = models.FloatField(default=0, verbose_name='Взвешенная длина документа')
+    indexed_at = models.DateTimeField(auto_now=True, verbose_name='Дата индексации')
+
+    class Meta:
+        verbose_name = 'Поисковый документ'
+        verbose_name_plural = 'Поисковые документы'
+
+    def __str__(self):
+        return f"Индекс для {self.advertisement_id}"
+
+
+class SearchStats(models.Model):
+    """
+    Статистика корпуса для BM25 (одна строка): число документов и их суммарная
+    длина. Обновляется при индексации и удалении объявлений, чтобы поиск не
+    агрегировал всю таблицу SearchDocument.
+    """
+    documents = models.PositiveIntegerField(default=0, verbose_name='Документов')
+    total_length = models.FloatField(default=0, verbose_name='Суммарная длина документов')
+
+    class Meta:
+        verbose_name = 'Статистика поискового индекса'
+        verbose_name_plural = 'Статистика поискового индекса'
+
+    def __str__(self):
+        return f"{self.documents} документов"
+
+
+class SearchPosting(models.Model):
+    """Вхождение термина в поле объявления (инвертированный индекс)"""
+    FIELD_CHOICES = [
+        ('t', 'Заголовок'),
+        ('d', 'Описание'),
+        ('l', 'Местоположение'),
+        ('c', 'Категория'),
+        ('y', 'Город'),
+    ]
+
+    term = models.CharField(max_length=64, db_index=True, verbose_name='Термин')
+    advertisement = models.ForeignKey(
+        Advertisement,
+        on_delete=models.CASCADE,
+        related_name='search_postings',
+        verbose_name='Объявление'
+    )
+    field = models.CharField(max_length=1, choices=FIELD_CHOICES, verbose_name='Поле')
+    frequency = models.PositiveSmallIntegerField(default=1, verbose_name='Частота')
+
+    class Meta:
+        verbose_name = 'Вхождение термина'
+        verbose_name_plural = 'Вхождения терминов'
+        constraints = [
+            models.UniqueConstraint(fields=['term', 'advertisement', 'field'], name='search_posting_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.term} → {self.advertisement_id}"
+
+
 class Favorite(models.Model):
     """Модель избранных объявлений"""
     user = models.ForeignKey(
@@ -278,10 +668,12 @@ class Favorite(models.Model):
 
 
 class SMSVerification(models.Model):
-    """Модель для SMS-верификации"""
-    phone = models.CharField(max_length=15, verbose_name='Номер телефона')
+    """Модель для SMS-верификации: одна действующая запись на номер (см. ads.verification_store)"""
+    phone = models.CharField(max_length=15, unique=True, verbose_name='Номер телефона')
     code = models.CharField(max_length=6, verbose_name='Код подтверждения')
     is_verified = models.BooleanField(default=False, verbose_name='Подтвержден')
+    # Неверные попытки ввода текущего кода
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name='Попыток')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
     expires_at = models.DateTimeField(verbose_name='Дата истечения')
     
@@ -289,6 +681,10 @@ class SMSVerification(models.Model):
         verbose_name = 'SMS-верификация'
         verbose_name_plural = 'SMS-верификации'
         ordering = ['-created_at']
+        indexes = [
+            # Удаление истекших записей пачками
+            models.Index(fields=['expires_at', 'id'], name='sms_verification_expires_idx'),
+        ]
     
     def __str__(self):
         return f"SMS для {self.phone}"
@@ -296,13 +692,6 @@ class SMSVerification(models.Model):
     def is_expired(self):
         """Проверяет, истек ли код"""
         return timezone.now() > self.expires_at
-    
-    def generate_code(self):
-        """Генерирует новый код подтверждения"""
-        self.code = ''.join(random.choices(string.digits, k=4))
-        self.expires_at = timezone.now() + timezone.timedelta(minutes=5)
-        self.save()
-        return self.code
 
 
 class UserLastCode(models.Model):
@@ -329,4 +718,78 @@ class UserLastCode(models.Model):
                 'code': code,
             }
         )
-        return obj
\ No newline at end of file
+        return obj
+
+
+class SMSOutbox(models.Model):
+    """Исходящее SMS: пишется вместе с кодом и отправляется фоновым диспетчером (см. ads.sms_outbox)"""
+    STATUS_PENDING = 'pending'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'В очереди'),
+        (STATUS_SENDING, 'Отправляется'),
+        (STATUS_SENT, 'Отправлено'),
+        (STATUS_FAILED, 'Ошибка'),
+    ]
+
+    phone = models.CharField(max_length=15, verbose_name='Номер телефона')
+    message = models.TextField(verbose_name='Текст')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING, verbose_name='Статус')
+    attempts = models.PositiveIntegerField(default=0, verbose_name='Попыток')
+    run_after = models.DateTimeField(default=timezone.now, verbose_name='Отправить после')
+    # Срок действия кода в сообщении: позже отправлять его незачем
+    expires_at = models.DateTimeField(null=True, blank=True, verbose_name='Актуально до')
+    locked_by = models.CharField(max_length=100, blank=True, verbose_name='Обработчик')
+    locked_at = models.DateTimeField(null=True, blank=True, verbose_name='Взято в работу')
+    gateway_id = models.CharField(max_length=50, blank=True, verbose_name='Идентификатор в шлюзе')
+    last_error = models.TextField(blank=True, verbose_name='Последняя ошибка')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+    sent_at = models.DateTimeField(null=True, blank=True, verbose_name='Дата отправки')
+
+    class Meta:
+        verbose_name = 'Исходящее SMS'
+        verbose_name_plural = 'Исходящие SMS'
+        ordering = ['run_after', 'id']
+        indexes = [
+            # Выбор пачки: WHERE status = 'pending' AND run_after <= now ORDER BY run_after, id
+            models.Index(fields=['status', 'run_after', 'id'], name='sms_outbox_queue_idx'),
+        ]
+
+    def __str__(self):
+        return f"SMS на {self.phone} ({self.get_status_display()})"
+
+
+class BackgroundTask(models.Model):
+    """Задача фоновой очереди в БД (см. ads.tasks)"""
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'В очереди'),
+        (STATUS_RUNNING, 'Выполняется'),
+        (STATUS_FAILED, 'Ошибка'),
+    ]
+
+    kind = models.CharField(max_length=50, verbose_name='Тип задачи')
+    payload = models.JSONField(default=dict, blank=True, verbose_name='Параметры')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING, verbose_name='Статус')
+    attempts = models.PositiveIntegerField(default=0, verbose_name='Попыток')
+    run_after = models.DateTimeField(default=timezone.now, verbose_name='Выполнить после')
+    locked_by = models.CharField(max_length=100, blank=True, verbose_name='Обработчик')
+    locked_at = models.DateTimeField(null=True, blank=True, verbose_name='Взята в работу')
+    last_error = models.TextField(blank=True, verbose_name='Последняя ошибка')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+
+    class Meta:
+        verbose_name = 'Фоновая задача'
+        verbose_name_plural = 'Фоновые задачи'
+        ordering = ['run_after', 'id']
+        indexes = [
+            # Выбор следующей задачи: WHERE status = 'pending' AND run_after <= now ORDER BY run_after, id
+            models.Index(fields=['status', 'run_after', 'id'], name='task_queue_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} #{self.pk} ({self.get_status_display()})"
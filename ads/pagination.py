@@ -0,0 +1,173 @@
+import base64
+import binascii
+import json
+from decimal import Decimal, InvalidOperation
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Пагинация по курсору (keyset): следующая страница выбирается условием
+    «после последней записи» по паре (поле сортировки, id), без COUNT и OFFSET,
+    поэтому время ответа не зависит от глубины прокрутки.
+    """
+    cursor_query_param = 'cursor'
+    ordering_query_param = 'ordering'
+    invalid_cursor_message = 'Неверный курсор'
+
+    # Допустимые сортировки и их разбор на значение и направление
+    orderings = {
+        '-created_at': ('created_at', True),
+        'created_at': ('created_at', False),
+        '-price': ('price', True),
+        'price': ('price', False),
+    }
+    default_ordering = '-created_at'
+
+    def __init__(self, page_size):
+        self.page_size = page_size
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        cursor = self.decode_cursor(request)
+
+        if cursor is None:
+            self.ordering = self.get_ordering(request)
+            reverse = False
+        else:
+            self.ordering = cursor['o']
+            reverse = cursor['r']
+        field, descending = self.orderings[self.ordering]
+
+        # При движении назад сортируем в обратную сторону и затем разворачиваем страницу
+        backwards = descending != reverse
+        prefix = '-' if backwards else ''
+        queryset = queryset.order_by(f'{prefix}{field}', f'{prefix}id')
+
+        if cursor is not None:
+            lookup = 'lt' if backwards else 'gt'
+            value = self.parse_value(field, cursor['v'])
+            queryset = queryset.filter(
+                Q(**{f'{field}__{lookup}': value}) |
+                Q(**{field: value, f'id__{lookup}': cursor['id']})
+            )
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+
+        self.field = field
+        self.page = results
+        if reverse:
+            self.has_next = cursor is not None
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = cursor is not None
+        return results
+
+    def get_ordering(self, request):
+        params = request.query_params.get(self.ordering_query_param, '')
+        for ordering in params.split(','):
+            ordering = ordering.strip()
+            if ordering in self.orderings:
+                return ordering
+        return self.default_ordering
+
+    def parse_value(self, field, raw):
+        if field == 'created_at':
+            value = parse_datetime(raw) if isinstance(raw, str) else None
+            if value is None:
+                raise NotFound(self.invalid_cursor_message)
+            return value
+        try:
+            return Decimal(raw)
+        except (InvalidOperation, TypeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+            if cursor['o'] not in self.orderings:
+                raise ValueError(cursor['o'])
+            cursor['id'] = int(cursor['id'])
+            cursor['r'] = bool(cursor.get('r', False))
+        except (TypeError, ValueError, KeyError, UnicodeError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+        return cursor
+
+    def encode_cursor(self, obj, reverse):
+        value = getattr(obj, self.field)
+        cursor = {
+            'o': self.ordering,
+            'v': value.isoformat() if self.field == 'created_at' else str(value),
+            'id': obj.pk,
+            'r': reverse,
+        }
+        encoded = base64.urlsafe_b64encode(
+            json.dumps(cursor, separators=(',', ':')).encode('utf-8')
+        ).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            url = remove_query_param(self.base_url, self.cursor_query_param)
+            return replace_query_param(url, AdvertisementPagination.mode_query_param, 'cursor')
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+
+class AdvertisementPagination(PageNumberPagination):
+    """
+    Пагинация лент объявлений. По умолчанию - по номеру страницы, как раньше;
+    клиент может перейти на курсор параметром ?pagination=cursor
+    (дальше достаточно переходить по ссылкам next/previous).
+    """
+    mode_query_param = 'pagination'
+    cursor_class = KeysetPagination
+
+    def is_cursor_request(self, request):
+        return (
+            request.query_params.get(self.mode_query_param) == 'cursor'
+            or bool(request.query_params.get(self.cursor_class.cursor_query_param))
+        )
+
+    def get_cursor_paginator(self, request):
+        if self.is_cursor_request(request):
+            return self.cursor_class(self.get_page_size(request))
+        return None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_paginator = self.get_cursor_paginator(request)
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.get_paginated_response(data)
+        return super().get_paginated_response(data)
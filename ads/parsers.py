@@ -0,0 +1,29 @@
+"""
+Разбор NDJSON (по одному JSON-объекту на строку).
+
+NDJSONParser не читает тело целиком: request.data - генератор, который
+разбирает строки по мере чтения потока запроса. Строка, которая не является
+JSON, превращается в None, чтобы обработчик сообщил об ошибке только для нее.
+"""
+import json
+from rest_framework.parsers import BaseParser
+
+
+class NDJSONParser(BaseParser):
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        return iter_lines(stream)
+
+
+def iter_lines(stream):
+    if stream is None:
+        return
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
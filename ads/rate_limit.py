@@ -0,0 +1,213 @@
+"""
+Ограничение частоты запросов корзинами токенов (token bucket).
+
+Корзина вмещает capacity токенов и пополняется со скоростью rate токенов
+в секунду; запрос забирает токен. Так разрешается короткий всплеск до
+capacity запросов, а в среднем - не больше rate. Состояние корзины - два
+числа (токены и время обновления), пополнение считается при обращении,
+без фоновых таймеров.
+
+Запрос проверяется сразу по нескольким корзинам (номер телефона, IP, общий
+лимит): токены забираются из всех корзин или ни из одной, поэтому запрос,
+отклоненный по одному ограничению, не расходует остальные.
+
+Хранилище задается RATE_LIMIT_BACKEND:
+- LocalTokenBuckets - память процесса (быстро, но у каждого процесса свои лимиты);
+- RedisTokenBuckets - общие для всех серверов корзины в Redis, проверка
+  атомарна (Lua-скрипт, время - часы сервера Redis).
+
+Счетчики пропущенных и отклоненных запросов по ограничениям (stats) отдает
+/api/auth/rate_limits/ для мониторинга.
+"""
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+_RATE_RE = re.compile(r'^\s*(\d+)\s*/\s*(\d*)\s*([smhd])[a-z]*\s*$')
+
+
+def parse_rate(rate):
+    """'5/10m' -> (5, 5 / 600): до 5 запросов подряд, пополнение 5 токенов за 10 минут"""
+    match = _RATE_RE.match(rate or '')
+    if not match:
+        raise ValueError(f'Неверный формат ограничения: {rate!r}')
+    capacity = int(match.group(1))
+    period = int(match.group(2) or 1) * UNITS[match.group(3)]
+    return capacity, capacity / period
+
+
+class Bucket:
+    """Корзина для проверки: имя ограничения, ключ и параметры"""
+    __slots__ = ('scope', 'key', 'capacity', 'rate')
+
+    def __init__(self, scope, key, capacity, rate):
+        self.scope = scope
+        self.key = key
+        self.capacity = capacity
+        self.rate = rate
+
+    @property
+    def name(self):
+        return f'{self.scope}:{self.key}'
+
+
+class LocalTokenBuckets:
+    """Корзины в памяти процесса; сверх max_buckets вытесняются давно не использованные"""
+
+    def __init__(self, max_buckets=100000, clock=time.monotonic):
+        self.max_buckets = max_buckets
+        self.clock = clock
+        self.buckets = OrderedDict()
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def _level(self, bucket, now):
+        tokens, updated = self.buckets.get(bucket.name, (bucket.capacity, now))
+        return min(bucket.capacity, tokens + (now - updated) * bucket.rate)
+
+    def consume(self, buckets, cost=1):
+        """Забирает cost токенов из всех корзин или ни из одной; возвращает (пропущен, ждать секунд)"""
+        with self.lock:
+            now = self.clock()
+            levels = [self._level(bucket, now) for bucket in buckets]
+            short = [
+                (bucket, level) for bucket, level in zip(buckets, levels) if level < cost
+            ]
+            if short:
+                for bucket, _ in short:
+                    self.counts[(bucket.scope, 'denied')] += 1
+                wait = max((cost - level) / bucket.rate for bucket, level in short)
+                return False, wait
+            for bucket, level in zip(buckets, levels):
+                self.buckets[bucket.name] = (level - cost, now)
+                self.buckets.move_to_end(bucket.name)
+                self.counts[(bucket.scope, 'allowed')] += 1
+            while len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+            return True, 0
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def reset(self):
+        with self.lock:
+            self.buckets.clear()
+            self.counts.clear()
+
+
+# KEYS - корзины, ARGV: cost, ключ счетчиков, затем capacity и rate каждой корзины
+TOKEN_BUCKET_SCRIPT = """
+-- Redis до 5.0: TIME в скрипте с записью требует репликации команд
+if redis.replicate_commands then redis.replicate_commands() end
+local cost = tonumber(ARGV[1])
+local stats_key = ARGV[2]
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[1 + i * 2])
+    local rate = tonumber(ARGV[2 + i * 2])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    levels[i] = tokens
+    if tokens < cost then
+        wait = math.max(wait, (cost - tokens) / rate)
+        redis.call('HINCRBY', stats_key, ARGV[2 + #KEYS * 2 + i] .. ':denied', 1)
+    end
+end
+if wait > 0 then
+    return {0, tostring(wait)}
+end
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[1 + i * 2])
+    local rate = tonumber(ARGV[2 + i * 2])
+    redis.call('HSET', key, 'tokens', tostring(levels[i] - cost), 'ts', tostring(now))
+    -- Корзина удаляется, когда успела бы наполниться
+    redis.call('PEXPIRE', key, math.ceil(capacity / rate * 1000) + 1000)
+    redis.call('HINCRBY', stats_key, ARGV[2 + #KEYS * 2 + i] .. ':allowed', 1)
+end
+return {1, '0'}
+"""
+
+
+class RedisTokenBuckets:
+    """Общие корзины всех процессов и серверов в Redis"""
+    prefix = 'ads:ratelimit:'
+    stats_key = 'ads:ratelimit:stats'
+
+    def __init__(self, url):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def consume(self, buckets, cost=1):
+        args = [cost, self.stats_key]
+        for bucket in buckets:
+            args += [bucket.capacity, bucket.rate]
+        args += [bucket.scope for bucket in buckets]
+        allowed, wait = self.script(keys=[self.prefix + bucket.name for bucket in buckets], args=args)
+        return bool(allowed), float(wait)
+
+    def stats(self):
+        counts = {}
+        for field, value in self.client.hgetall(self.stats_key).items():
+            scope, outcome = field.decode().rsplit(':', 1)
+            counts[(scope, outcome)] = int(value)
+        return counts
+
+    def reset(self):
+        keys = list(self.client.scan_iter(f'{self.prefix}*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def create_backend():
+    backend = import_string(settings.RATE_LIMIT_BACKEND)
+    if backend is RedisTokenBuckets:
+        return backend(settings.RATE_LIMIT_REDIS_URL)
+    return backend()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = create_backend()
+    return _backend
+
+
+def bucket(scope, key):
+    """Корзина ограничения scope из RATE_LIMITS для ключа key"""
+    capacity, rate = parse_rate(settings.RATE_LIMITS[scope])
+    return Bucket(scope, key, capacity, rate)
+
+
+def consume(buckets, cost=1):
+    return get_backend().consume(buckets, cost)
+
+
+def stats():
+    """{ограничение: {'allowed': n, 'denied': n}} с момента запуска (Local) или всего (Redis)"""
+    result = {scope: {'allowed': 0, 'denied': 0} for scope in settings.RATE_LIMITS}
+    for (scope, outcome), value in get_backend().stats().items():
+        result.setdefault(scope, {'allowed': 0, 'denied': 0})[outcome] = value
+    return result
+
+
+def reset():
+    get_backend().reset()
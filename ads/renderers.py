@@ -0,0 +1,79 @@
+"""
+Быстрый JSON-рендерер и потоковая выдача списков.
+
+FastJSONRenderer кодирует ответ через orjson (если установлен) и выдает те же
+байты, что стандартный JSONRenderer DRF: компактные разделители, UTF-8 без
+экранирования, даты в ISO 8601 («Z» для UTC), Decimal - числом. Без orjson
+или при JSON_RENDERER_BACKEND=stdlib используется стандартный рендерер.
+
+stream_json_list отдает список по одному элементу, не собирая весь ответ
+в памяти; байты совпадают с выдачей рендерера для целого списка.
+"""
+from django.conf import settings
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils import encoders
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+_encoder = encoders.JSONEncoder()
+# DRF экранирует разделители строк U+2028 и U+2029 для совместимости с JavaScript
+_LINE_SEPARATORS = ((b'\xe2\x80\xa8', b'\\u2028'), (b'\xe2\x80\xa9', b'\\u2029'))
+
+
+def use_orjson():
+    return orjson is not None and settings.JSON_RENDERER_BACKEND == 'orjson'
+
+
+def _orjson_dumps(data):
+    rendered = orjson.dumps(
+        data,
+        default=_encoder.default,
+        option=orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS,
+    )
+    for separator, escaped in _LINE_SEPARATORS:
+        if separator in rendered:
+            rendered = rendered.replace(separator, escaped)
+    return rendered
+
+
+class FastJSONRenderer(JSONRenderer):
+    """JSONRenderer на orjson с откатом на стандартный json"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        # Отступы (браузерный API) и нестандартные настройки - стандартным рендерером
+        if (
+            not use_orjson()
+            or self.get_indent(accepted_media_type, renderer_context or {})
+            or self.ensure_ascii
+            or not self.compact
+        ):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            return _orjson_dumps(data)
+        except (orjson.JSONEncodeError, TypeError):
+            # Например, целые числа больше 64 бит
+            return super().render(data, accepted_media_type, renderer_context)
+
+
+def dumps(data):
+    """Кодирует данные так же, как FastJSONRenderer (None - как null)"""
+    if data is None:
+        return b'null'
+    return FastJSONRenderer().render(data)
+
+
+def stream_json_list(items, serialize):
+    """Генератор байтов JSON-массива: элементы кодируются по одному"""
+    yield b'['
+    first = True
+    for item in items:
+        rendered = dumps(serialize(item))
+        yield rendered if first else b',' + rendered
+        first = False
+    yield b']'
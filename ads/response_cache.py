@@ -0,0 +1,63 @@
+"""
+Кеш ответов API, которые одинаковы для многих пользователей.
+
+Ключ собирается из действия, формата, города, признака авторизации, выборки
+полей и версий данных (ads.versions): при изменении категорий, городов или
+счетчиков объявлений версия растет, и старые ответы просто перестают находиться.
+Потоковые ответы кешируются готовыми байтами после полной отправки.
+"""
+from functools import wraps
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from rest_framework.response import Response
+from .field_selection import EXPAND_PARAM, FIELDS_PARAM
+from .versions import get_versions
+
+
+KEY_PREFIX = 'ads:response:'
+
+
+def response_cache_key(view, request, namespaces):
+    version = '.'.join(str(version) for version in get_versions(namespaces))
+    city_id = request.query_params.get('city_id', '')
+    auth = 'user' if request.user.is_authenticated else 'anon'
+    renderer_format = request.accepted_renderer.format
+    # Выборка полей (ads.field_selection) меняет содержимое ответа
+    selection = ':'.join(request.query_params.get(param, '') for param in (FIELDS_PARAM, EXPAND_PARAM))
+    return (
+        f'{KEY_PREFIX}{view.basename}:{view.action}:{renderer_format}:'
+        f'{city_id}:{auth}:{selection}:{version}'
+    )
+
+
+def _store_when_complete(key, chunks):
+    """Пропускает части потокового ответа и кладет их в кеш, когда поток дочитан"""
+    rendered = []
+    for chunk in chunks:
+        rendered.append(chunk)
+        yield chunk
+    cache.set(key, b''.join(rendered), settings.RESPONSE_CACHE_TIMEOUT)
+
+
+def cache_response(*namespaces):
+    """Кеширует успешный ответ действия до изменения данных указанных пространств имен"""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            key = response_cache_key(self, request, namespaces)
+            data = cache.get(key)
+            if isinstance(data, bytes):
+                return HttpResponse(data, content_type=request.accepted_renderer.media_type)
+            if data is not None:
+                return Response(data)
+            response = method(self, request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            if response.streaming:
+                response.streaming_content = _store_when_complete(key, response.streaming_content)
+            else:
+                cache.set(key, response.data, settings.RESPONSE_CACHE_TIMEOUT)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,472 @@
+"""
+Полнотекстовый поиск по объявлениям на основе инвертированного индекса.
+
+Текст заголовка, описания, местоположения, категории и города разбивается на
+термины (нижний регистр, стоп-слова, стемминг Snowball для русского языка) и
+хранится в SearchPosting. Ранжирование - BM25 с весами полей. Индекс хранится в
+обычных таблицах, поэтому одинаково работает на SQLite и PostgreSQL.
+
+Число документов и их суммарная длина для BM25 ведутся в SearchStats при
+индексации и удалении объявлений. По BM25 ранжируются только
+SEARCH_MAX_CANDIDATES объявлений с лучшей предварительной оценкой (TF-IDF
+в SQL), поэтому время запроса не растет с числом найденных объявлений;
+остальные идут следом в порядке предварительной оценки.
+"""
+import math
+import re
+from collections import Counter, defaultdict
+from functools import reduce
+from operator import add, or_
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Count, F, FloatField, Q, Sum, Value, When
+from .models import Advertisement, SearchDocument, SearchPosting, SearchStats
+
+
+# Веса полей при подсчете релевантности
+FIELD_BOOSTS = {
+    't': 3.0,  # заголовок
+    'c': 2.0,  # категория
+    'l': 1.5,  # местоположение
+    'y': 1.5,  # город
+    'd': 1.0,  # описание
+}
+
+# Параметры BM25
+K1 = 1.2
+B = 0.75
+
+MAX_TERM_LENGTH = 64
+MIN_PREFIX_LENGTH = 3
+
+TOKEN_RE = re.compile(r'[0-9a-zа-я]+')
+
+STOPWORDS = frozenset('''
+и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по
+только ее мне было вот от меня еще нет о из ему теперь когда даже ну вдруг ли если
+уже или ни быть был него до вас нибудь опять уж вам ведь там потом себя ничего ей
+может они тут где есть надо ней для мы тебя их чем была сам чтоб без будто чего раз
+тоже себе под будет ж тогда кто этот того потому этого какой совсем ним здесь этом
+один почти мой тем чтобы нее были куда зачем всех никогда можно при наконец два об
+другой хоть после над больше тот через эти нас про всего них какая много разве три
+эту моя впрочем свою этой перед иногда чуть том нельзя такой им более всегда всю
+между
+'''.split())
+
+
+# Стеммер Snowball для русского языка
+
+VOWELS = 'аеиоуыэюя'
+
+PERFECTIVE_GERUND = [
+    (('вшись', 'вши', 'в'), True),
+    (('ившись', 'ывшись', 'ивши', 'ывши', 'ив', 'ыв'), False),
+]
+ADJECTIVE = [(
+    ('ими', 'ыми', 'его', 'ого', 'ему', 'ому', 'ее', 'ие', 'ые', 'ое', 'ей', 'ий', 'ый',
+     'ой', 'ем', 'им', 'ым', 'ом', 'их', 'ых', 'ую', 'юю', 'ая', 'яя', 'ою', 'ею'),
+    False
+)]
+PARTICIPLE = [
+    (('ем', 'нн', 'вш', 'ющ', 'щ'), True),
+    (('ивш', 'ывш', 'ующ'), False),
+]
+REFLEXIVE = [(('ся', 'сь'), False)]
+VERB = [
+    (('ла', 'на', 'ете', 'йте', 'ли', 'й', 'л', 'ем', 'н', 'ло', 'но', 'ет', 'ют', 'ны',
+      'ть', 'ешь', 'нно'), True),
+    (('ила', 'ыла', 'ена', 'ейте', 'уйте', 'ите', 'или', 'ыли', 'ей', 'уй', 'ил', 'ыл',
+      'им', 'ым', 'ен', 'ило', 'ыло', 'ено', 'ят', 'ует', 'уют', 'ит', 'ыт', 'ены', 'ить',
+      'ыть', 'ишь', 'ую', 'ю'), False),
+]
+NOUN = [(
+    ('а', 'ев', 'ов', 'ие', 'ье', 'е', 'иями', 'ями', 'ами', 'еи', 'ии', 'и', 'ией', 'ей',
+     'ой', 'ий', 'й', 'иям', 'ям', 'ием', 'ем', 'ам', 'ом', 'о', 'у', 'ах', 'иях', 'ях',
+     'ы', 'ь', 'ию', 'ью', 'ю', 'ия', 'ья', 'я'),
+    False
+)]
+SUPERLATIVE = [(('ейше', 'ейш'), False)]
+DERIVATIONAL = [(('ость', 'ост'), False)]
+
+
+def _strip_ending(word, start, groups):
+    """
+    Отрезает самое длинное окончание из groups, целиком лежащее в word[start:].
+    Для групп с флагом окончанию должна предшествовать «а» или «я».
+    Возвращает None, если окончание не найдено.
+    """
+    best = ''
+    for endings, after_a in groups:
+        for ending in endings:
+            if len(ending) <= len(best) or not word.endswith(ending):
+                continue
+            position = len(word) - len(ending)
+            if position < start:
+                continue
+            if after_a and (position - 1 < start or word[position - 1] not in 'ая'):
+                continue
+            best = ending
+    if not best:
+        return None
+    return word[:-len(best)]
+
+
+def _region_after_consonant(word, start):
+    """Начало области после первой согласной, следующей за гласной"""
+    for index in range(start + 1, len(word)):
+        if word[index] not in VOWELS and word[index - 1] in VOWELS:
+            return index + 1
+    return len(word)
+
+
+def stem(word):
+    """Возвращает основу русского слова (алгоритм Snowball)"""
+    word = word.replace('ё', 'е')
+    rv = next((index + 1 for index, char in enumerate(word) if char in VOWELS), None)
+    if rv is None:
+        return word
+    r1 = _region_after_consonant(word, 0)
+    r2 = _region_after_consonant(word, r1)
+
+    # Шаг 1
+    stripped = _strip_ending(word, rv, PERFECTIVE_GERUND)
+    if stripped is None:
+        reflexive = _strip_ending(word, rv, REFLEXIVE)
+        if reflexive is not None:
+            word = reflexive
+        adjective = _strip_ending(word, rv, ADJECTIVE)
+        if adjective is not None:
+            participle = _strip_ending(adjective, rv, PARTICIPLE)
+            stripped = participle if participle is not None else adjective
+        else:
+            stripped = _strip_ending(word, rv, VERB)
+            if stripped is None:
+                stripped = _strip_ending(word, rv, NOUN)
+    if stripped is not None:
+        word = stripped
+
+    # Шаг 2
+    if word.endswith('и') and len(word) - 1 >= rv:
+        word = word[:-1]
+
+    # Шаг 3
+    derivational = _strip_ending(word, r2, DERIVATIONAL)
+    if derivational is not None:
+        word = derivational
+
+    # Шаг 4
+    if word.endswith('нн') and len(word) - 2 >= rv:
+        return word[:-1]
+    superlative = _strip_ending(word, rv, SUPERLATIVE)
+    if superlative is not None:
+        word = superlative
+        if word.endswith('нн') and len(word) - 2 >= rv:
+            word = word[:-1]
+    elif word.endswith('ь') and len(word) - 1 >= rv:
+        word = word[:-1]
+    return word
+
+
+def tokenize(text):
+    """Разбивает текст на слова в нижнем регистре"""
+    return TOKEN_RE.findall((text or '').lower().replace('ё', 'е'))
+
+
+def normalize(token):
+    """Приводит слово к термину индекса"""
+    if any('а' <= char <= 'я' for char in token):
+        token = stem(token)
+    return token[:MAX_TERM_LENGTH]
+
+
+def analyze(text):
+    """Список терминов текста без стоп-слов"""
+    terms = []
+    for token in tokenize(text):
+        if token in STOPWORDS or (len(token) < 2 and not token.isdigit()):
+            continue
+        term = normalize(token)
+        if term:
+            terms.append(term)
+    return terms
+
+
+# Индексация
+
+def document_fields(advertisement):
+    return {
+        't': advertisement.title,
+        'd': advertisement.description,
+        'l': advertisement.location,
+        'c': advertisement.category.name if advertisement.category_id else '',
+        'y': advertisement.city.name if advertisement.city_id else '',
+    }
+
+
+def build_document(advertisement):
+    """Вхождения терминов и взвешенная длина документа для объявления"""
+    postings = []
+    length = 0.0
+    for field, text in document_fields(advertisement).items():
+        frequencies = Counter(analyze(text))
+        length += FIELD_BOOSTS[field] * sum(frequencies.values())
+        postings.extend(
+            SearchPosting(
+                term=term,
+                advertisement_id=advertisement.pk,
+                field=field,
+                frequency=min(frequency, 32767),
+            )
+            for term, frequency in frequencies.items()
+        )
+    return postings, SearchDocument(advertisement_id=advertisement.pk, length=length)
+
+
+def index_advertisements(advertisements, batch_size=500):
+    """Переиндексирует объявления (category и city желательно подгрузить заранее)"""
+    postings = []
+    documents = []
+    for advertisement in advertisements:
+        advertisement_postings, document = build_document(advertisement)
+        postings.extend(advertisement_postings)
+        documents.append(document)
+    if not documents:
+        return 0
+
+    ids = [document.advertisement_id for document in documents]
+    with transaction.atomic():
+        previous = list(
+            SearchDocument.objects.select_for_update().filter(advertisement_id__in=ids).values_list('length', flat=True)
+        )
+        SearchPosting.objects.filter(advertisement_id__in=ids).delete()
+        SearchPosting.objects.bulk_create(postings, batch_size=batch_size)
+        SearchDocument.objects.bulk_create(
+            documents,
+            batch_size=batch_size,
+            update_conflicts=True,
+            unique_fields=['advertisement'],
+            update_fields=['length', 'indexed_at'],
+        )
+        change_stats(
+            len(documents) - len(previous),
+            sum(document.length for document in documents) - sum(previous),
+        )
+    return len(documents)
+
+
+def forget(advertisement_ids):
+    """Убирает документы объявлений из статистики (сами строки удаляются каскадно)"""
+    stats = SearchDocument.objects.filter(advertisement_id__in=advertisement_ids).aggregate(
+        documents=Count('pk'), length=Sum('length')
+    )
+    change_stats(-stats['documents'], -(stats['length'] or 0.0))
+
+
+# Статистика корпуса
+
+STATS_ID = 1
+
+
+def change_stats(documents, length):
+    """Изменяет число документов и суммарную длину корпуса"""
+    if not documents and not length:
+        return
+    updated = SearchStats.objects.filter(pk=STATS_ID).update(
+        documents=F('documents') + documents,
+        total_length=F('total_length') + length,
+    )
+    if not updated:
+        refresh_stats()
+
+
+def refresh_stats():
+    """Пересчитывает статистику по SearchDocument; возвращает (документов, суммарная длина)"""
+    stats = SearchDocument.objects.aggregate(documents=Count('pk'), length=Sum('length'))
+    documents, length = stats['documents'], stats['length'] or 0.0
+    SearchStats.objects.update_or_create(
+        pk=STATS_ID, defaults={'documents': documents, 'total_length': length}
+    )
+    return documents, length
+
+
+def corpus_stats():
+    """Число документов и средняя длина документа"""
+    row = SearchStats.objects.filter(pk=STATS_ID).values_list('documents', 'total_length').first()
+    documents, length = row if row is not None else refresh_stats()
+    return documents, (length / documents if documents and length > 0 else 1.0)
+
+
+def index_queryset(queryset, batch_size=500):
+    """Переиндексирует объявления из queryset пачками, не загружая все в память"""
+    queryset = queryset.select_related('category', 'city').order_by('pk')
+    batch = []
+    total = 0
+    for advertisement in queryset.iterator(chunk_size=batch_size):
+        batch.append(advertisement)
+        if len(batch) >= batch_size:
+            total += index_advertisements(batch, batch_size)
+            batch = []
+    total += index_advertisements(batch, batch_size)
+    return total
+
+
+def rebuild(batch_size=500):
+    """Полностью перестраивает индекс"""
+    with transaction.atomic():
+        SearchPosting.objects.all().delete()
+        SearchDocument.objects.all().delete()
+        refresh_stats()
+        return index_queryset(Advertisement.objects.all(), batch_size)
+
+
+# Поиск
+
+def parse_query(query):
+    """
+    Термины запроса: список пар (термин, по_префиксу). Последнее слово ищется
+    по префиксу, если пользователь еще его набирает (нет пробела в конце).
+    """
+    terms = []
+    tokens = tokenize(query)
+    for index, token in enumerate(tokens):
+        if token in STOPWORDS:
+            continue
+        term = normalize(token)
+        prefix = (
+            index == len(tokens) - 1
+            and not query[-1:].isspace()
+            and len(term) >= MIN_PREFIX_LENGTH
+        )
+        if term and (term, prefix) not in terms:
+            terms.append((term, prefix))
+    return terms
+
+
+def term_condition(term, prefix):
+    if prefix:
+        return Q(term__startswith=term)
+    return Q(term=term)
+
+
+def filter_queryset(queryset, query):
+    """Оставляет объявления, в которых встречаются все термины запроса"""
+    terms = parse_query(query)
+    if not terms:
+        return queryset.none()
+    for term, prefix in terms:
+        queryset = queryset.filter(
+            pk__in=SearchPosting.objects.filter(term_condition(term, prefix)).values('advertisement_id')
+        )
+    return queryset
+
+
+class Ranking:
+    """
+    Идентификаторы найденных объявлений по убыванию релевантности для пагинатора:
+    первые - список, упорядоченный по BM25, дальше - объявления в порядке
+    предварительной оценки (запрос prescored), которые читаются только при
+    переходе на страницы за пределами списка
+    """
+
+    def __init__(self, ranked, prescored, matched, limit):
+        self.ranked = ranked
+        self.prescored = prescored
+        self.matched = matched
+        # Кандидатов меньше limit - найдены все объявления
+        self.complete = len(ranked) < limit
+        self._count = len(ranked) if self.complete else None
+
+    def count(self):
+        if self._count is None:
+            self._count = self.matched.count()
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __bool__(self):
+        return bool(self.ranked)
+
+    def __iter__(self):
+        yield from self.ranked
+        if not self.complete:
+            yield from self.prescored[len(self.ranked):]
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return list(self[index:index + 1])[0]
+        start, stop = index.start or 0, index.stop
+        result = self.ranked[start:stop]
+        if not self.complete and (stop is None or stop > len(self.ranked)):
+            result = result + list(self.prescored[max(start, len(self.ranked)):stop])
+        return result
+
+
+def rank(queryset, query, limit=None):
+    """
+    Найденные объявления из queryset по убыванию релевантности (Ranking).
+    По BM25 ранжируются не больше limit (по умолчанию SEARCH_MAX_CANDIDATES)
+    объявлений с лучшей предварительной оценкой, остальные идут за ними.
+    """
+    terms = parse_query(query)
+    if not terms:
+        return []
+    if limit is None:
+        limit = settings.SEARCH_MAX_CANDIDATES
+    matched = filter_queryset(queryset, query)
+    conditions = [term_condition(term, prefix) for term, prefix in terms]
+    any_term = reduce(or_, conditions)
+
+    total, avg_length = corpus_stats()
+
+    # Документная частота каждого термина одним запросом
+    frequencies = SearchPosting.objects.filter(any_term).aggregate(**{
+        f'df{index}': Count('advertisement', distinct=True, filter=condition)
+        for index, condition in enumerate(conditions)
+    })
+    idf = []
+    for index in range(len(terms)):
+        df = frequencies[f'df{index}'] or 0
+        idf.append(math.log(1 + (total - df + 0.5) / (df + 0.5)))
+
+    # Предварительная оценка в SQL: сумма idf * вес поля * частота, без насыщения
+    # и нормировки по длине. По BM25 ранжируются только лучшие кандидаты
+    term_weight = reduce(add, [
+        Case(When(condition, then=Value(idf[index])), default=Value(0.0), output_field=FloatField())
+        for index, condition in enumerate(conditions)
+    ])
+    field_boost = Case(
+        *[When(field=field, then=Value(boost)) for field, boost in FIELD_BOOSTS.items()],
+        default=Value(0.0),
+        output_field=FloatField(),
+    )
+    prescored = SearchPosting.objects.filter(
+        any_term, advertisement__in=matched.values('pk')
+    ).values('advertisement_id').annotate(
+        score=Sum(term_weight * field_boost * F('frequency'), output_field=FloatField())
+    ).order_by('-score', '-advertisement_id').values_list('advertisement_id', flat=True)
+
+    postings = SearchPosting.objects.filter(
+        any_term, advertisement_id__in=prescored[:limit]
+    ).values_list('advertisement_id', 'term', 'field', 'frequency', 'advertisement__search_document__length')
+
+    weighted = defaultdict(lambda: [0.0] * len(terms))
+    lengths = {}
+    for advertisement_id, posting_term, field, frequency, length in postings:
+        lengths[advertisement_id] = length or 0.0
+        for index, (term, prefix) in enumerate(terms):
+            if posting_term == term or (prefix and posting_term.startswith(term)):
+                weighted[advertisement_id][index] += FIELD_BOOSTS[field] * frequency
+
+    scores = {}
+    for advertisement_id, term_frequencies in weighted.items():
+        norm = K1 * (1 - B + B * lengths[advertisement_id] / avg_length)
+        scores[advertisement_id] = sum(
+            idf[index] * tf * (K1 + 1) / (tf + norm)
+            for index, tf in enumerate(term_frequencies) if tf
+        )
+    ranked = [
+        advertisement_id for advertisement_id, score
+        in sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+    ]
+    return Ranking(ranked, prescored, matched, limit)
@@ -1,9 +1,15 @@
+import json
 from rest_framework import serializers
 from django.contrib.auth.models import User
-from .models import City, Category, Advertisement, AdvertisementImage, Favorite
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Case, F, PositiveIntegerField, Value, When
+from .models import City, Category, Advertisement, AdvertisementImage, Favorite, ImageUpload
+from . import chunked_upload, counters, fast_serializers, image_processing, image_variants, signals
+from .category_tree import get_tree
+from .field_selection import FieldSelectionMixin, child, get_selection, includes
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(FieldSelectionMixin, serializers.ModelSerializer):
     """Сериализатор для пользователя"""
     class Meta:
         model = User
@@ -11,7 +17,7 @@ class UserSerializer(serializers.ModelSerializer):
         read_only_fields = ['id']
 
 
-class CitySerializer(serializers.ModelSerializer):
+class CitySerializer(FieldSelectionMixin, serializers.ModelSerializer):
     """Сериализатор для города"""
     advertisements_count = serializers.SerializerMethodField()
 
@@ -20,10 +26,13 @@ class CitySerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'slug', 'is_active', 'advertisements_count', 'created_at']
 
     def get_advertisements_count(self, obj):
-        return obj.advertisements.filter(status='active').count()
+        # Значение уже посчитано в City.objects.with_counts()
+        if hasattr(obj, 'active_ads_count'):
+            return obj.active_ads_count
+        return counters.city_count(obj.pk)
 
 
-class CategorySerializer(serializers.ModelSerializer):
+class CategorySerializer(FieldSelectionMixin, serializers.ModelSerializer):
     """Сериализатор для категории"""
     advertisements_count = serializers.SerializerMethodField()
     children_count = serializers.SerializerMethodField()
@@ -39,10 +48,13 @@ class CategorySerializer(serializers.ModelSerializer):
         return obj.get_available_cities_display()
 
     def get_advertisements_count(self, obj):
-        return obj.advertisements.filter(status='active').count()
+        # Значение уже посчитано в Category.objects.with_counts()
+        if hasattr(obj, 'active_ads_count'):
+            return obj.active_ads_count
+        return counters.category_count(obj.pk)
 
     def get_children_count(self, obj):
-        return obj.children.count()
+        return len(get_tree().children(obj.pk))
 
 
 class CategoryWithChildrenSerializer(CategorySerializer):
@@ -74,13 +86,20 @@ class CategoryWithUnviewedCountSerializer(CategorySerializer):
             return 0
 
 
-class AdvertisementImageSerializer(serializers.ModelSerializer):
+class AdvertisementImageSerializer(FieldSelectionMixin, serializers.ModelSerializer):
     """Сериализатор для изображения объявления"""
+    # Файл не декодируется в запросе: проверка и обработка идут в фоне (ads.image_processing)
+    image = serializers.FileField(validators=[image_processing.validate_upload])
     image_url = serializers.SerializerMethodField()
+    variants = serializers.SerializerMethodField()
 
     class Meta:
         model = AdvertisementImage
-        fields = ['id', 'image', 'image_url', 'caption', 'is_primary', 'created_at']
+        fields = ['id', 'image', 'image_url', 'variants', 'caption', 'is_primary', 'position', 'status', 'created_at']
+        read_only_fields = ['position', 'status']
+
+    def get_variants(self, obj):
+        return image_variants.variant_urls(obj, self.context.get('request'))
 
     def get_image_url(self, obj):
         if obj.image:
@@ -91,7 +110,41 @@ class AdvertisementImageSerializer(serializers.ModelSerializer):
         return None
 
 
-class AdvertisementListSerializer(serializers.ModelSerializer):
+class ImageUploadSerializer(serializers.ModelSerializer):
+    """Сериализатор для загрузки фотографии по частям"""
+    filename = serializers.CharField(max_length=255, validators=[image_processing.validate_name])
+    size = serializers.IntegerField(min_value=1, validators=[image_processing.validate_size])
+
+    class Meta:
+        model = ImageUpload
+        fields = ['id', 'filename', 'size', 'offset', 'status', 'created_at']
+        read_only_fields = ['id', 'offset', 'status', 'created_at']
+
+
+class ImageOperationsSerializer(serializers.Serializer):
+    """
+    Изменения изображений объявления при обновлении: remove - удалить,
+    order - новый порядок (не перечисленные изображения идут следом в прежнем
+    порядке), primary - главное изображение. Остальные изображения сохраняются,
+    новые файлы из images и uploads добавляются в конец.
+    """
+    remove = serializers.ListField(child=serializers.IntegerField(), required=False, default=list)
+    order = serializers.ListField(child=serializers.IntegerField(), required=False, default=list)
+    primary = serializers.IntegerField(required=False, allow_null=True, default=None)
+
+    def validate(self, attrs):
+        existing = self.context['existing']
+        unknown = (set(attrs['remove']) | set(attrs['order']) | {attrs['primary']} - {None}) - existing
+        if unknown:
+            raise serializers.ValidationError(f'Изображения не найдены: {sorted(unknown)}')
+        if len(set(attrs['order'])) != len(attrs['order']):
+            raise serializers.ValidationError('Изображение указано в order несколько раз')
+        if set(attrs['order']) & set(attrs['remove']) or attrs['primary'] in attrs['remove']:
+            raise serializers.ValidationError('Удаляемое изображение нельзя упорядочить или сделать главным')
+        return attrs
+
+
+class AdvertisementListSerializer(FieldSelectionMixin, serializers.ModelSerializer):
     """Сериализатор для списка объявлений"""
     category = CategorySerializer(read_only=True)
     city = CitySerializer(read_only=True)
@@ -108,16 +161,32 @@ class AdvertisementListSerializer(serializers.ModelSerializer):
         ]
 
     def get_primary_image(self, obj):
-        primary_image = obj.images.filter(is_primary=True).first()
+        # Главные изображения предзагружены в Advertisement.objects.for_listing()
+        if hasattr(obj, 'primary_images'):
+            primary_image = obj.primary_images[0] if obj.primary_images else None
+        else:
+            primary_image = obj.images.filter(is_primary=True).first()
         if primary_image:
-            return AdvertisementImageSerializer(primary_image, context=self.context).data
+            serializer = AdvertisementImageSerializer(primary_image, context=self.context)
+            serializer._field_selection = child(get_selection(self), 'primary_image')
+            return serializer.data
         return None
 
     def get_images_count(self, obj):
+        if hasattr(obj, 'images_total'):
+            return obj.images_total
         return obj.images.count()
 
+    def to_representation(self, instance):
+        # Поля собираются напрямую, без обхода полей DRF (см. ads.fast_serializers)
+        if self.context.get(fast_serializers.GENERIC_CONTEXT_KEY):
+            return super().to_representation(instance)
+        return fast_serializers.advertisement_list_data(
+            instance, self.context.get('request'), get_selection(self)
+        )
+
 
-class AdvertisementDetailSerializer(serializers.ModelSerializer):
+class AdvertisementDetailSerializer(FieldSelectionMixin, serializers.ModelSerializer):
     """Сериализатор для детального просмотра объявления"""
     category = CategorySerializer(read_only=True)
     city = CitySerializer(read_only=True)
@@ -140,51 +209,135 @@ class AdvertisementDetailSerializer(serializers.ModelSerializer):
             return obj.favorited_by.filter(user=user).exists()
         return False
 
+    def to_representation(self, instance):
+        if self.context.get(fast_serializers.GENERIC_CONTEXT_KEY):
+            return super().to_representation(instance)
+        selection = get_selection(self)
+        is_favorited = self.get_is_favorited(instance) if includes(selection, 'is_favorited') else None
+        return fast_serializers.advertisement_detail_data(
+            instance, self.context.get('request'), is_favorited, selection
+        )
+
 
 class AdvertisementCreateSerializer(serializers.ModelSerializer):
     """Сериализатор для создания объявления"""
     images = serializers.ListField(
-        child=serializers.ImageField(),
+        child=serializers.FileField(validators=[image_processing.validate_upload]),
         required=False,
         write_only=True
     )
+    # Идентификаторы завершенных загрузок по частям (ads.chunked_upload) вместо файлов
+    uploads = serializers.PrimaryKeyRelatedField(
+        queryset=ImageUpload.objects.all(),
+        many=True,
+        required=False,
+        write_only=True
+    )
+    # Изменения изображений вместо полной замены (см. ImageOperationsSerializer)
+    image_operations = serializers.JSONField(required=False, write_only=True)
     images_count = serializers.SerializerMethodField()
 
     class Meta:
         model = Advertisement
         fields = [
             'id', 'title', 'description', 'price', 'category', 'city',
-            'status', 'location', 'is_featured', 'images', 'images_count', 'views_count', 'created_at', 'expires_at', 'is_expired', 'author'
+            'status', 'location', 'is_featured', 'images', 'uploads', 'image_operations', 'images_count', 'views_count', 'created_at', 'expires_at', 'is_expired', 'author'
         ]
         read_only_fields = ['id', 'author', 'created_at', 'expires_at', 'is_expired', 'views_count']
 
     def get_expires_at(self, obj):
-        """Вычисляем дату истечения объявления (30 дней после создания)"""
-        if obj.created_at:
-            from datetime import timedelta
-            return obj.created_at + timedelta(days=30)
-        return None
+        """Дата истечения объявления (продлевается при повторной активации)"""
+        return obj.expires_at
 
     def get_is_expired(self, obj):
         """Проверяем, истекло ли объявление"""
-        if obj.created_at:
-            from datetime import timedelta
-            expires_at = obj.created_at + timedelta(days=30)
-            return timezone.now() > expires_at
-        return False
+        return obj.is_expired
 
     def get_images_count(self, obj):
         return obj.images.count()
 
+    def validate_uploads(self, value):
+        user = self.context['request'].user
+        if len({upload.pk for upload in value}) != len(value):
+            raise serializers.ValidationError('Загрузка указана несколько раз')
+        for upload in value:
+            if upload.user_id != user.id:
+                raise serializers.ValidationError('Загрузка не найдена')
+            if upload.status != ImageUpload.STATUS_COMPLETE:
+                raise serializers.ValidationError(f'Загрузка {upload.pk} не завершена')
+        return value
+
+    def validate_image_operations(self, value):
+        if self.instance is None:
+            raise serializers.ValidationError('Операции с изображениями доступны только при обновлении объявления')
+        if isinstance(value, str):
+            # В multipart-запросе операции приходят строкой JSON
+            try:
+                value = json.loads(value)
+            except ValueError:
+                raise serializers.ValidationError('Ожидается JSON-объект')
+        operations = ImageOperationsSerializer(
+            data=value, context={'existing': set(self.instance.images.values_list('id', flat=True))}
+        )
+        operations.is_valid(raise_exception=True)
+        return operations.validated_data
+
+    def add_images(self, advertisement, images_data, uploads, first_primary=True, start=0):
+        """Создает изображения из файлов и загрузок по частям; обработка файлов идет в фоне"""
+        images = []
+        for index, image_file in enumerate(images_data):
+            # Первое изображение автоматически становится главным
+            is_primary = first_primary and index == 0
+            images.append(image_processing.stage(
+                advertisement, image_file, is_primary=is_primary, position=start + index
+            ))
+        for index, upload in enumerate(uploads, start=len(images_data)):
+            try:
+                images.append(chunked_upload.attach(
+                    advertisement, upload, is_primary=first_primary and index == 0, position=start + index
+                ))
+            except DjangoValidationError as e:
+                raise serializers.ValidationError({'uploads': e.messages})
+        return images
+
+    def apply_image_operations(self, instance, operations, images_data, uploads):
+        """
+        Применяет только изменения изображений, не трогая остальные: удаление,
+        порядок и главное изображение - по одному запросу, объявление
+        обновляется один раз (signals.image_batch)
+        """
+        with signals.image_batch():
+            current = list(instance.images.values_list('id', 'is_primary'))
+            kept = [(pk, is_primary) for pk, is_primary in current if pk not in operations['remove']]
+            ordered = operations['order'] + [pk for pk, _ in kept if pk not in operations['order']]
+            # Сначала новые файлы: если они не сохранятся, удалять ничего не нужно
+            added = self.add_images(instance, images_data, uploads, first_primary=False, start=len(ordered))
+            ordered += [image.pk for image in added]
+            if operations['remove']:
+                instance.images.filter(pk__in=operations['remove']).delete()
+            if ordered:
+                primary = operations['primary']
+                if primary is None:
+                    # Прежнее главное изображение, а если его удалили - первое по порядку
+                    primary = next((pk for pk, is_primary in kept if is_primary), ordered[0])
+                # Порядок и главное изображение - одним UPDATE
+                instance.images.update(
+                    position=Case(
+                        *[When(pk=pk, then=Value(index)) for index, pk in enumerate(ordered)],
+                        default=F('position'),
+                        output_field=PositiveIntegerField(),
+                    ),
+                    is_primary=Case(When(pk=primary, then=Value(True)), default=Value(False)),
+                )
+        image_variants.touch([instance.pk])
+
     def to_representation(self, instance):
         """Переопределяем представление для добавления полных объектов"""
         data = super().to_representation(instance)
         
         # Добавляем expires_at
-        if instance.created_at:
-            from datetime import timedelta
-            expires_at = instance.created_at + timedelta(days=30)
-            data['expires_at'] = expires_at.isoformat()
+        if instance.expires_at:
+            data['expires_at'] = instance.expires_at.isoformat()
         
         # Добавляем полный объект author
         if instance.author:
@@ -205,8 +358,8 @@ class AdvertisementCreateSerializer(serializers.ModelSerializer):
                 'description': instance.category.description or '',
                 'icon': instance.category.icon or '',
                 'parent': instance.category.parent.id if instance.category.parent else None,
-                'advertisements_count': instance.category.advertisements.filter(status='active').count(),
-                'children_count': instance.category.children.count(),
+                'advertisements_count': counters.category_count(instance.category.id),
+                'children_count': len(get_tree().children(instance.category.id)),
                 'level': instance.category.level,
                 'cities': [],
                 'available_cities_display': instance.category.get_available_cities_display(),
@@ -220,7 +373,7 @@ class AdvertisementCreateSerializer(serializers.ModelSerializer):
                 'name': instance.city.name,
                 'slug': instance.city.slug,
                 'is_active': instance.city.is_active,
-                'advertisements_count': instance.city.advertisements.filter(status='active').count(),
+                'advertisements_count': counters.city_count(instance.city.id),
                 'created_at': instance.city.created_at.isoformat() if instance.city.created_at else None
             }
         
@@ -233,8 +386,11 @@ class AdvertisementCreateSerializer(serializers.ModelSerializer):
                 'id': image.id,
                 'image': self.context['request'].build_absolute_uri(image.image.url) if image.image else None,
                 'image_url': self.context['request'].build_absolute_uri(image.image.url) if image.image else None,
+                'variants': image_variants.variant_urls(image, self.context['request']),
+                'status': image.status,
                 'caption': image.caption or '',
                 'is_primary': image.is_primary,
+                'position': image.position,
                 'created_at': image.created_at.isoformat() if image.created_at else None
             }
             images.append(image_data)
@@ -250,48 +406,78 @@ class AdvertisementCreateSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         images_data = validated_data.pop('images', [])
+        uploads = validated_data.pop('uploads', [])
         validated_data['author'] = self.context['request'].user
-        advertisement = Advertisement.objects.create(**validated_data)
+        # Объявление сохраняется вместе с изображениями или не сохраняется вовсе
+        with image_processing.staging_atomic():
+            advertisement = Advertisement.objects.create(**validated_data)
 
-        # Создаем записи для изображений
-        for index, image_file in enumerate(images_data):
-            # Первое изображение автоматически становится главным
-            is_primary = index == 0
-            AdvertisementImage.objects.create(
-                advertisement=advertisement,
-                image=image_file,
-                is_primary=is_primary
-            )
+            # Создаем записи для изображений
+            self.add_images(advertisement, images_data, uploads)
 
         # Возвращаем объект с полными данными для iOS приложения
         return advertisement
 
     def update(self, instance, validated_data):
         images_data = validated_data.pop('images', [])
+        uploads = validated_data.pop('uploads', [])
+        operations = validated_data.pop('image_operations', None)
         
-        # Обновляем основные поля
-        for attr, value in validated_data.items():
-            setattr(instance, attr, value)
-        instance.save()
-
-        # Обновляем изображения
-        if images_data:
-            # Удаляем старые изображения
-            instance.images.all().delete()
-            # Создаем новые
-            for index, image_file in enumerate(images_data):
-                # Первое изображение автоматически становится главным
-                is_primary = index == 0
-                AdvertisementImage.objects.create(
-                    advertisement=instance,
-                    image=image_file,
-                    is_primary=is_primary
-                )
+        with image_processing.staging_atomic():
+            # Обновляем основные поля; если меняются только изображения, объявление
+            # не сохраняется и не переиндексируется (updated_at обновит touch)
+            if validated_data:
+                for attr, value in validated_data.items():
+                    setattr(instance, attr, value)
+                instance.save()
+
+            # Обновляем изображения
+            if operations is not None:
+                self.apply_image_operations(instance, operations, images_data, uploads)
+            elif images_data or uploads:
+                previous_ids = list(instance.images.values_list('id', flat=True))
+                with signals.image_batch():
+                    # Сначала создаем новые: повторно отправленные фотографии ссылаются на те же файлы
+                    self.add_images(instance, images_data, uploads)
+                    # Удаляем старые изображения
+                    instance.images.filter(pk__in=previous_ids).delete()
+                image_variants.touch([instance.pk])
 
         return instance
 
 
-class FavoriteSerializer(serializers.ModelSerializer):
+class AdvertisementBulkSerializer(serializers.ModelSerializer):
+    """
+    Элемент пакетной загрузки объявлений (ads.bulk). Категории и города берутся
+    из заранее загруженных для всей пачки словарей context['categories'] и
+    context['cities'], поэтому проверка элемента не обращается к БД.
+    """
+    category = serializers.IntegerField()
+    city = serializers.IntegerField(required=False, allow_null=True)
+
+    class Meta:
+        model = Advertisement
+        fields = [
+            'title', 'description', 'price', 'category', 'city', 'status',
+            'location', 'contact_phone', 'contact_email', 'is_featured'
+        ]
+
+    def validate_category(self, value):
+        category = self.context['categories'].get(value)
+        if category is None:
+            raise serializers.ValidationError('Категория не найдена')
+        return category
+
+    def validate_city(self, value):
+        if value is None:
+            return None
+        city = self.context['cities'].get(value)
+        if city is None:
+            raise serializers.ValidationError('Город не найден')
+        return city
+
+
+class FavoriteSerializer(FieldSelectionMixin, serializers.ModelSerializer):
     """Сериализатор для избранных объявлений"""
     advertisement = AdvertisementListSerializer(read_only=True)
 
@@ -299,6 +485,11 @@ class FavoriteSerializer(serializers.ModelSerializer):
         model = Favorite
         fields = ['id', 'advertisement', 'created_at']
 
+    def to_representation(self, instance):
+        if self.context.get(fast_serializers.GENERIC_CONTEXT_KEY):
+            return super().to_representation(instance)
+        return fast_serializers.favorite_data(instance, self.context.get('request'), get_selection(self))
+
 
 class FavoriteCreateSerializer(serializers.ModelSerializer):
     """Сериализатор для создания избранного"""
@@ -0,0 +1,197 @@
+import threading
+from contextlib import contextmanager
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.conf import settings
+from django.core.management import call_command
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils import timezone
+from . import category_tree, counters, image_processing, image_variants, media_store, search, suggest
+from .versions import ADVERTISEMENTS_NAMESPACE, CITIES_NAMESPACE, bump_version
+from .models import Advertisement, AdvertisementImage, Category, City
+
+
+# Поля объявления, от которых зависит поисковый индекс
+SEARCH_FIELDS = {'title', 'description', 'location', 'category', 'city'}
+
+# Удаленные изображения открытого блока image_batch текущего потока
+_image_batch = threading.local()
+
+
+@contextmanager
+def image_batch():
+    """
+    Групповое изменение фотографий: обработчики отдельных изображений не
+    обновляют объявление, а удаленные изображения собираются и снимают ссылки
+    на файлы одним UPDATE в конце блока. Объявление обновляет вызывающий код
+    (image_variants.touch) - один раз на блок.
+    """
+    deleted = []
+    _image_batch.deleted = deleted
+    try:
+        yield
+    finally:
+        _image_batch.deleted = None
+    media_store.release_many(image.image.name for image in deleted)
+    for image in deleted:
+        delete_own_variants(image)
+
+
+def in_image_batch():
+    return getattr(_image_batch, 'deleted', None) is not None
+
+
+@receiver(post_delete, sender=Advertisement)
+def advertisement_deleted(sender, instance, **kwargs):
+    """Уменьшает счетчик при удалении объявления (в т.ч. каскадном и через queryset)"""
+    if hasattr(instance, '_stored_counter_key'):
+        key = instance._stored_counter_key
+    else:
+        key = instance.counter_key
+    counters.apply_change(key, None)
+    suggest.update('title', instance.pk, None, visible=False)
+
+
+@receiver(pre_delete, sender=Advertisement)
+def advertisement_deleting(sender, instance, **kwargs):
+    """Убирает документ объявления из статистики поиска до каскадного удаления"""
+    search.forget([instance.pk])
+
+
+@receiver(post_save, sender=Advertisement)
+def advertisement_saved(sender, instance, update_fields=None, **kwargs):
+    """Обновляет поисковый индекс и подсказки объявления"""
+    if update_fields is not None and not (SEARCH_FIELDS | {'status'}) & set(update_fields):
+        return
+    suggest.update('title', instance.pk, instance.title, visible=instance.status == 'active')
+    if update_fields is not None and not SEARCH_FIELDS & set(update_fields):
+        return
+    search.index_advertisements([instance])
+
+
+@receiver(post_save, sender=Advertisement)
+@receiver(post_delete, sender=Advertisement)
+def advertisement_changed(sender, instance, **kwargs):
+    """Меняет версию лент объявлений (ETag списков)"""
+    bump_version(ADVERTISEMENTS_NAMESPACE)
+
+
+@receiver(post_save, sender=AdvertisementImage)
+@receiver(post_delete, sender=AdvertisementImage)
+def advertisement_image_changed(sender, instance, **kwargs):
+    """Изменение фотографий - изменение объявления: обновляем updated_at и версию лент"""
+    if in_image_batch():
+        return
+    Advertisement.objects.filter(pk=instance.advertisement_id).update(updated_at=timezone.now())
+    bump_version(ADVERTISEMENTS_NAMESPACE)
+
+
+@receiver(post_save, sender=AdvertisementImage)
+def advertisement_image_uploaded(sender, instance, **kwargs):
+    """Ставит в очередь построение копий нового или замененного изображения (например, из админки)"""
+    if (
+        settings.IMAGE_VARIANTS_ON_UPLOAD
+        and instance.status == AdvertisementImage.STATUS_READY
+        and instance.image
+        and not image_variants.is_current(instance)
+    ):
+        image_processing.enqueue(instance)
+
+
+@receiver(post_delete, sender=AdvertisementImage)
+def advertisement_image_deleted(sender, instance, **kwargs):
+    """Удаляет файлы уменьшенных копий и снимает ссылку на файл"""
+    if in_image_batch():
+        _image_batch.deleted.append(instance)
+        return
+    media_store.release(instance.image.name)
+    delete_own_variants(instance)
+
+
+def delete_own_variants(image):
+    # Копии общего файла удаляются вместе с ним (media_store.collect)
+    if image.variants and not media_store.is_blob(image.variants.get('source')):
+        transaction.on_commit(lambda: image_variants.delete_variants(image.variants))
+
+
+@receiver(pre_save, sender=AdvertisementImage)
+def remember_image_name(sender, instance, **kwargs):
+    """Запоминает прежний файл изображения, чтобы перенести ссылку при замене"""
+    if instance._state.adding:
+        instance._stored_image = None
+    else:
+        instance._stored_image = sender.objects.filter(pk=instance.pk).values_list('image', flat=True).first()
+
+
+@receiver(post_save, sender=AdvertisementImage)
+def count_image_reference(sender, instance, **kwargs):
+    """Счетчик ссылок на файлы в хранилище по содержимому"""
+    previous = getattr(instance, '_stored_image', None)
+    if previous != instance.image.name:
+        media_store.release(previous)
+        media_store.acquire(instance.image.name)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_changed(sender, instance, **kwargs):
+    """Сбрасывает снимок дерева категорий"""
+    category_tree.invalidate()
+
+
+@receiver(m2m_changed, sender=Category.cities.through)
+def category_cities_changed(sender, action, **kwargs):
+    """Сбрасывает закешированные ответы при изменении городов категории"""
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_version(category_tree.NAMESPACE)
+
+
+@receiver(post_save, sender=City)
+@receiver(post_delete, sender=City)
+def city_changed(sender, instance, **kwargs):
+    """Сбрасывает закешированные ответы, в которых есть города"""
+    bump_version(CITIES_NAMESPACE)
+
+
+@receiver(pre_save, sender=Category)
+@receiver(pre_save, sender=City)
+def remember_indexed_name(sender, instance, **kwargs):
+    """Запоминает прежнее название, чтобы переиндексировать объявления при переименовании"""
+    if instance.pk is None:
+        instance._indexed_name = None
+    else:
+        instance._indexed_name = sender.objects.filter(pk=instance.pk).values_list('name', flat=True).first()
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=City)
+def reindex_renamed(sender, instance, created, **kwargs):
+    """Переиндексирует объявления переименованной категории или города"""
+    if created or getattr(instance, '_indexed_name', instance.name) == instance.name:
+        return
+    field = 'category' if sender is Category else 'city'
+    search.index_queryset(Advertisement.objects.filter(**{field: instance}))
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=City)
+def update_suggestions(sender, instance, **kwargs):
+    """Обновляет подсказки по названию категории или города"""
+    kind = 'category' if sender is Category else 'city'
+    suggest.update(kind, instance.pk, instance.name, visible=getattr(instance, 'is_active', True))
+
+
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=City)
+def remove_suggestions(sender, instance, **kwargs):
+    """Убирает удаленную категорию или город из подсказок"""
+    kind = 'category' if sender is Category else 'city'
+    suggest.update(kind, instance.pk, None, visible=False)
+
+
+def create_cache_tables(sender, using, verbosity=1, **kwargs):
+    """
+    Таблица кеша в БД (CACHE_BACKEND=db) после migrate: зависит от CACHES, а не
+    от состояния миграций. Для других кешей createcachetable ничего не делает
+    """
+    call_command('createcachetable', database=using, verbosity=verbosity)
@@ -0,0 +1,101 @@
+"""
+Локальный поддельный SMS-шлюз с API smsc.ru (send.php, fmt=3) для тестов и разработки.
+
+Сервер запоминает полученные запросы (requests) и адреса клиентов (clients -
+по ним видно, переиспользуются ли соединения) и отвечает по сценарию:
+script - очередь ответов (статус, тело, задержка в секундах); когда она пуста,
+отвечает успехом. Запуск из консоли: команда fake_sms_gateway, затем
+SMS_GATEWAY_URL=http://127.0.0.1:8025/sys/send.php.
+"""
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+
+class FakeSMSGateway:
+    def __init__(self, host='127.0.0.1', port=0):
+        self.requests = []
+        self.clients = set()
+        # Номера, которые шлюз отклоняет в ответе на list
+        self.rejected = set()
+        self.script = deque()
+        self._lock = threading.Lock()
+        self._sent = 0
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/sys/send.php'
+
+    def respond(self, status=200, body=None, delay=0):
+        """Добавляет ответ в сценарий; body - словарь (JSON) или байты"""
+        self.script.append((status, body, delay))
+
+    def fail(self, times, status=503):
+        for _ in range(times):
+            self.respond(status, {'error': 'service unavailable'})
+
+    def _next_response(self, params, client):
+        with self._lock:
+            self.requests.append(params)
+            self.clients.add(client)
+            if self.script:
+                return self.script.popleft()
+            self._sent += 1
+            if 'list' not in params:
+                return 200, {'id': self._sent, 'cnt': 1}, 0
+            # Несколько сообщений (list, op=1): результат по каждому номеру
+            phones = [{'phone': line.split(':', 1)[0]} for line in params['list'].splitlines()]
+            for entry in phones:
+                if entry['phone'] in self.rejected:
+                    entry.update(error='invalid phone', error_code=7)
+            return 200, {'id': self._sent, 'cnt': len(phones), 'phones': phones}, 0
+
+    def _handler(self):
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                params = dict(parse_qsl(urlsplit(self.path).query))
+                status, body, delay = gateway._next_response(params, self.client_address)
+                if delay:
+                    time.sleep(delay)
+                content = body if isinstance(body, bytes) else json.dumps(body or {}).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(content)))
+                    self.end_headers()
+                    self.wfile.write(content)
+                except OSError:
+                    # Клиент не дождался ответа (таймаут)
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fake-sms-gateway', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
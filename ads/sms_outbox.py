@@ -0,0 +1,192 @@
+"""
+Исходящие SMS через таблицу-outbox.
+
+Код подтверждения и строка SMSOutbox пишутся в одной транзакции, а запрос
+к шлюзу делает фоновый диспетчер: API отвечает сразу, и медленный или
+недоступный шлюз не занимает рабочий процесс. Если транзакция откатилась,
+SMS не уйдет; если сохранилась - уйдет, даже когда шлюз временно недоступен.
+
+Диспетчер (задача dispatch_sms фоновой очереди ads.tasks или команда
+dispatch_sms) забирает пачки по SMS_OUTBOX_BATCH_SIZE условным UPDATE
+(pending -> sending), как ads.tasks, поэтому несколько обработчиков не отправят
+одно сообщение дважды. Пачка уходит одним запросом (параметр list smsc.ru),
+статус каждого сообщения берется из ответа по номерам. Временные ошибки
+шлюза возвращают пачку в очередь с задержкой, после SMS_OUTBOX_MAX_ATTEMPTS
+попыток сообщения получают статус failed. Пока предохранитель транспорта
+разомкнут (шлюз недоступен), пачка откладывается до его пробного вызова без
+расхода попыток. Сообщения, зависшие в sending дольше SMS_OUTBOX_LOCK_TIMEOUT
+(обработчик упал), отправляются повторно, а сообщения с истекшим кодом
+(expires_at) не отправляются вовсе.
+"""
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+from . import sms_transport, tasks
+from .models import BackgroundTask, SMSOutbox
+
+
+DISPATCH_SMS = 'dispatch_sms'
+
+
+def enqueue(phone, message, expires_at=None):
+    """Добавляет SMS в outbox; вызывается в транзакции, которая создает код"""
+    outgoing = SMSOutbox.objects.create(phone=phone, message=message, expires_at=expires_at)
+    schedule()
+    return outgoing
+
+
+def schedule(delay=0):
+    """Ставит задачу диспетчера, если в очереди нет такой же, которая выполнится не позже"""
+    run_after = timezone.now() + timedelta(seconds=delay)
+    if not BackgroundTask.objects.filter(
+        kind=DISPATCH_SMS, status=BackgroundTask.STATUS_PENDING, run_after__lte=run_after
+    ).exists():
+        tasks.enqueue(DISPATCH_SMS, delay=delay)
+
+
+def release_stale():
+    """Возвращает в очередь сообщения, которые слишком долго висят в sending"""
+    deadline = timezone.now() - timedelta(seconds=settings.SMS_OUTBOX_LOCK_TIMEOUT)
+    return SMSOutbox.objects.filter(status=SMSOutbox.STATUS_SENDING, locked_at__lt=deadline).update(
+        status=SMSOutbox.STATUS_PENDING, locked_by='', locked_at=None
+    )
+
+
+def drop_expired():
+    """Сообщения с истекшим кодом получают статус failed вместо отправки"""
+    return SMSOutbox.objects.filter(
+        status=SMSOutbox.STATUS_PENDING, expires_at__lte=timezone.now()
+    ).update(status=SMSOutbox.STATUS_FAILED, last_error='Код истек до отправки')
+
+
+def claim(worker, batch_size):
+    """Забирает пачку готовых к отправке сообщений"""
+    now = timezone.now()
+    ids = list(SMSOutbox.objects.filter(
+        Q(expires_at__isnull=True) | Q(expires_at__gt=now), status=SMSOutbox.STATUS_PENDING, run_after__lte=now
+    ).order_by('run_after', 'id').values_list('id', flat=True)[:batch_size])
+    if not ids:
+        return []
+    # Сообщение получает тот, чей UPDATE изменил строку
+    SMSOutbox.objects.filter(pk__in=ids, status=SMSOutbox.STATUS_PENDING).update(
+        status=SMSOutbox.STATUS_SENDING, locked_by=worker, locked_at=now, attempts=F('attempts') + 1
+    )
+    return list(SMSOutbox.objects.filter(
+        pk__in=ids, status=SMSOutbox.STATUS_SENDING, locked_by=worker, locked_at=now
+    ).order_by('id'))
+
+
+def mark_failed(messages, error):
+    SMSOutbox.objects.filter(pk__in=[message.pk for message in messages]).update(
+        status=SMSOutbox.STATUS_FAILED, locked_by='', locked_at=None, last_error=error
+    )
+
+
+def retry_later(messages, error):
+    """Временная ошибка: сообщения возвращаются в очередь с экспоненциальной задержкой"""
+    now = timezone.now()
+    by_attempts = defaultdict(list)
+    for message in messages:
+        by_attempts[message.attempts].append(message)
+    for attempts, group in by_attempts.items():
+        if attempts >= settings.SMS_OUTBOX_MAX_ATTEMPTS:
+            mark_failed(group, error)
+            continue
+        delay = min(settings.SMS_OUTBOX_RETRY_DELAY * 2 ** (attempts - 1), 3600)
+        SMSOutbox.objects.filter(pk__in=[message.pk for message in group]).update(
+            status=SMSOutbox.STATUS_PENDING,
+            run_after=now + timedelta(seconds=delay),
+            locked_by='',
+            locked_at=None,
+            last_error=error,
+        )
+
+
+def postpone(messages, delay, error):
+    """Шлюз недоступен (предохранитель разомкнут): пачка ждет без расхода попытки"""
+    SMSOutbox.objects.filter(pk__in=[message.pk for message in messages]).update(
+        status=SMSOutbox.STATUS_PENDING,
+        run_after=timezone.now() + timedelta(seconds=delay),
+        attempts=F('attempts') - 1,
+        locked_by='',
+        locked_at=None,
+        last_error=error,
+    )
+
+
+def send_batch(messages, transport):
+    """
+    Отправляет пачку одним запросом и записывает статус каждого сообщения;
+    CircuitOpen пробрасывается после того, как пачка отложена
+    """
+    try:
+        if len(messages) == 1:
+            result = transport.send(messages[0].phone, messages[0].message)
+        else:
+            result = transport.send_list([(message.phone, message.message) for message in messages])
+    except sms_transport.CircuitOpen as e:
+        print(f"Ошибка отправки SMS (будет повтор): {e}")
+        postpone(messages, max(e.retry_after, 1), str(e))
+        raise
+    except sms_transport.RetryableError as e:
+        print(f"Ошибка отправки SMS (будет повтор): {e}")
+        retry_later(messages, str(e))
+        return 0
+    except sms_transport.SMSTransportError as e:
+        print(f"Ошибка отправки SMS: {e}")
+        mark_failed(messages, str(e))
+        return 0
+
+    # Результат по номерам (op=1) - в порядке строк запроса
+    results = result.get('phones') or [{}] * len(messages)
+    if len(results) != len(messages):
+        by_phone = {entry.get('phone'): entry for entry in results}
+        results = [by_phone.get(message.phone, {}) for message in messages]
+    rejected = [(message, entry) for message, entry in zip(messages, results) if 'error' in entry]
+    for message, entry in rejected:
+        mark_failed([message], f"{entry['error']} (код {entry.get('error_code')})")
+    rejected_ids = {message.pk for message, _ in rejected}
+    sent = [message.pk for message in messages if message.pk not in rejected_ids]
+    SMSOutbox.objects.filter(pk__in=sent).update(
+        status=SMSOutbox.STATUS_SENT,
+        gateway_id=str(result.get('id', '')),
+        sent_at=timezone.now(),
+        locked_by='',
+        locked_at=None,
+        last_error='',
+    )
+    return len(sent)
+
+
+def dispatch(worker=None, batch_size=None, transport=None):
+    """Отправляет готовые сообщения пачками, пока они есть; возвращает количество отправленных"""
+    worker = worker or tasks.worker_name()
+    batch_size = batch_size or settings.SMS_OUTBOX_BATCH_SIZE
+    transport = transport or sms_transport.get_transport()
+    release_stale()
+    drop_expired()
+    sent = 0
+    while True:
+        messages = claim(worker, batch_size)
+        if not messages:
+            break
+        try:
+            sent += send_batch(messages, transport)
+        except sms_transport.CircuitOpen:
+            # Остальные пачки тоже отклонит предохранитель
+            break
+
+    # Отложенные повторы: диспетчер проснется к ближайшему
+    next_at = SMSOutbox.objects.filter(status=SMSOutbox.STATUS_PENDING).order_by('run_after').values_list(
+        'run_after', flat=True
+    ).first()
+    if next_at is not None:
+        schedule(delay=max((next_at - timezone.now()).total_seconds(), 0))
+    return sent
+
+
+@tasks.register(DISPATCH_SMS)
+def run_dispatch(payload):
+    dispatch()
@@ -1,18 +1,19 @@
-import requests
-import json
 from django.conf import settings
-from .models import SMSVerification, UserLastCode
+from django.db import transaction
+from .models import SMSOutbox, UserLastCode
 from django.contrib.auth.models import User
-from django.utils import timezone
+from . import sms_outbox, sms_transport, verification_store
 
 
 class SMSService:
     """Сервис для отправки SMS через smsc.ru"""
     
-    def __init__(self):
-        self.login = "magosss"
-        self.password = "77555577"
-        self.base_url = "https://smsc.ru/sys/send.php"
+    def __init__(self, transport=None, async_transport=None, store=None):
+        # Общий для процесса транспорт: пул соединений, повторы и предохранитель (ads.sms_transport)
+        self.transport = transport or sms_transport.get_transport()
+        self.async_transport = async_transport
+        # Хранилище кодов (ads.verification_store): БД или кеш
+        self.store = store or verification_store.get_store()
     
     def send_sms(self, phone: str, message: str) -> dict:
         """
@@ -26,32 +27,27 @@ class SMSService:
             dict: Ответ от API smsc.ru
         """
         try:
-            # Параметры для API smsc.ru
-            params = {
-                'login': self.login,
-                'psw': self.password,
-                'phones': phone,
-                'mes': message,
-                'fmt': 3,  # JSON формат ответа
-                'charset': 'utf-8'
-            }
-            
-            # Отправляем запрос
-            response = requests.get(self.base_url, params=params, timeout=10)
-            response.raise_for_status()
-            
-            # Парсим JSON ответ
-            result = response.json()
-            
+            result = self.transport.send(phone, message)
             print(f"SMS отправлено на {phone}: {result}")
             return result
-            
-        except requests.exceptions.RequestException as e:
+        except sms_transport.SMSTransportError as e:
+            print(f"Ошибка отправки SMS: {e}")
+            return {'error': str(e)}
+    
+    async def send_sms_async(self, phone: str, message: str) -> dict:
+        """
+        Асинхронная отправка (ASGI): то же, что send_sms, без блокировки цикла событий.
+        Транспорт создается при первом вызове и использует предохранитель общего транспорта
+        """
+        if self.async_transport is None:
+            self.async_transport = sms_transport.AsyncSMSTransport(breaker=self.transport.breaker)
+        try:
+            result = await self.async_transport.send(phone, message)
+            print(f"SMS отправлено на {phone}: {result}")
+            return result
+        except sms_transport.SMSTransportError as e:
             print(f"Ошибка отправки SMS: {e}")
             return {'error': str(e)}
-        except json.JSONDecodeError as e:
-            print(f"Ошибка парсинга JSON ответа: {e}")
-            return {'error': 'Invalid JSON response'}
     
     def send_verification_code(self, phone: str) -> dict:
         """
@@ -75,16 +71,8 @@ class SMSService:
             print(f"🧪 ТЕСТОВЫЙ РЕЖИМ: SMS не отправляется для {clean_phone}")
             print(f"🧪 Используйте код: 1234")
             
-            # Создаем фиктивную запись верификации для тестового номера
-            verification, created = SMSVerification.objects.get_or_create(
-                phone=clean_phone,
-                defaults={'code': '1234', 'expires_at': timezone.now() + timezone.timedelta(minutes=5)}
-            )
-            
-            # Обновляем код и время истечения
-            verification.code = '1234'
-            verification.expires_at = timezone.now() + timezone.timedelta(minutes=5)
-            verification.save()
+            # Сохраняем фиксированный код для тестового номера
+            self.store.issue(clean_phone, '1234')
             
             # Сохраняем код у пользователя, если он существует
             try:
@@ -102,41 +90,57 @@ class SMSService:
             }
         
         # Обычная логика для реальных номеров
-        # Создаем или получаем существующую запись верификации
-        verification, created = SMSVerification.objects.get_or_create(
-            phone=clean_phone,
-            defaults={'code': '', 'expires_at': timezone.now()}
-        )
-        
-        # Генерируем новый код
-        code = verification.generate_code()
-        
-        # Логируем код в консоль для разработки
-        print(f"🔢 SMS код для {clean_phone}: {code}")
-        
-        # Сохраняем код у пользователя, если он существует
-        try:
-            from .models import UserLastCode
-            user = User.objects.get(username=clean_phone)
-            UserLastCode.update_or_create_code(user, clean_phone, code)
-            print(f"💾 Код сохранен у пользователя {user.username}")
-        except User.DoesNotExist:
-            print(f"ℹ️ Пользователь {clean_phone} не найден, код будет сохранен при первом входе")
-        
-        # Формируем сообщение
-        message = f"Ваш код подтверждения: {code}. Код действителен 5 минут."
+        # Код и исходящее SMS сохраняются вместе; отправляет фоновый диспетчер (ads.sms_outbox)
+        with transaction.atomic():
+            # Новый код заменяет прежний и сбрасывает счетчик попыток
+            code = verification_store.generate_code()
+            expires_at = self.store.issue(clean_phone, code)
+            
+            # Логируем код в консоль для разработки
+            print(f"🔢 SMS код для {clean_phone}: {code}")
+            
+            # Сохраняем код у пользователя, если он существует
+            try:
+                user = User.objects.get(username=clean_phone)
+                UserLastCode.update_or_create_code(user, clean_phone, code)
+                print(f"💾 Код сохранен у пользователя {user.username}")
+            except User.DoesNotExist:
+                print(f"ℹ️ Пользователь {clean_phone} не найден, код будет сохранен при первом входе")
+            
+            # Формируем сообщение
+            message = f"Ваш код подтверждения: {code}. Код действителен {settings.SMS_CODE_TTL // 60} минут."
+            outgoing = sms_outbox.enqueue(clean_phone, message, expires_at=expires_at)
         
-        # Отправляем SMS
-        result = self.send_sms(clean_phone, message)
+        return {
+            'success': True,
+            'message': 'Код отправлен',
+            'phone': clean_phone,
+            'sms_id': outgoing.pk
+        }
+    
+    def delivery_status(self, phone: str, sms_id) -> dict:
+        """
+        Статус отправки SMS из outbox
         
-        if 'error' not in result:
-            return {
-                'success': True,
-                'message': 'Код отправлен',
-                'phone': clean_phone
-            }
-        else:
-            return result
+        Args:
+            phone: Номер телефона, на который отправлялось SMS
+            sms_id: Идентификатор из ответа send_verification_code
+            
+        Returns:
+            dict: Статус или ошибка
+        """
+        clean_phone = ''.join(filter(str.isdigit, phone))
+        outgoing = SMSOutbox.objects.filter(pk=sms_id, phone=clean_phone).only(
+            'status', 'attempts', 'sent_at'
+        ).first()
+        if outgoing is None:
+            return {'error': 'SMS не найдено'}
+        return {
+            'success': True,
+            'status': outgoing.status,
+            'attempts': outgoing.attempts,
+            'sent_at': outgoing.sent_at.isoformat() if outgoing.sent_at else None
+        }
     
     def verify_code(self, phone: str, code: str) -> dict:
         """
@@ -156,18 +160,6 @@ class SMSService:
         if clean_phone == '79999999999' and code == '1234':
             print(f"🧪 ТЕСТОВЫЙ РЕЖИМ: Код {code} принят для {clean_phone}")
             
-            # Создаем или обновляем запись верификации
-            verification, created = SMSVerification.objects.get_or_create(
-                phone=clean_phone,
-                defaults={'code': '1234', 'expires_at': timezone.now() + timezone.timedelta(minutes=5)}
-            )
-            
-            # Обновляем код и время истечения
-            verification.code = '1234'
-            verification.expires_at = timezone.now() + timezone.timedelta(minutes=5)
-            verification.is_verified = True
-            verification.save()
-            
             return {
                 'success': True,
                 'message': 'Код подтвержден (тестовый режим)',
@@ -176,27 +168,18 @@ class SMSService:
         
         # Обычная логика для реальных номеров
         try:
-            # Ищем запись верификации
-            verification = SMSVerification.objects.filter(
-                phone=clean_phone,
-                code=code
-            ).latest('created_at')
-            
-            # Проверяем, не истек ли код
-            if verification.is_expired():
-                return {'error': 'Код истек'}
-            
-            # Отмечаем как подтвержденный
-            verification.is_verified = True
-            verification.save()
-            
+            result = self.store.check(clean_phone, str(code))
+        except Exception as e:
+            return {'error': f'Ошибка проверки: {str(e)}'}
+        
+        if result == verification_store.OK:
             return {
                 'success': True,
                 'message': 'Код подтвержден',
                 'phone': clean_phone
             }
-            
-        except SMSVerification.DoesNotExist:
-            return {'error': 'Неверный код'}
-        except Exception as e:
-            return {'error': f'Ошибка проверки: {str(e)}'}
+        if result == verification_store.EXPIRED:
+            return {'error': 'Код истек'}
+        if result == verification_store.LOCKED:
+            return {'error': 'Превышено число попыток, запросите новый код'}
+        return {'error': 'Неверный код'}
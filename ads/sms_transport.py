@@ -0,0 +1,316 @@
+"""
+HTTP-транспорт SMS-шлюза smsc.ru.
+
+SMSTransport держит постоянную сессию requests с пулом соединений
+(SMS_POOL_SIZE), поэтому повторные отправки не открывают новое TLS-соединение.
+
+send.php не идемпотентен: запрос, который шлюз уже принял, при повторе
+отправит и оплатит SMS еще раз. Поэтому повторяются (до SMS_RETRIES раз
+с экспоненциальной задержкой и случайным разбросом - full jitter) только
+ошибки, при которых запрос точно не обработан: соединение не установлено,
+ответы 429 и 503. Таймаут ответа и остальные 5xx - UncertainError без повтора.
+Ошибки, которые вернул сам шлюз (неверный номер, нет денег), тоже не
+повторяются. Повтор начинается, только если он укладывается вместе
+с таймаутами в SMS_SEND_TIMEOUT секунд на отправку.
+
+Без SMS_GATEWAY_LOGIN и SMS_GATEWAY_PASSWORD отправка бросает ImproperlyConfigured.
+
+Автомат-предохранитель (CircuitBreaker) после SMS_BREAKER_THRESHOLD неудачных
+отправок подряд на SMS_BREAKER_RESET секунд отклоняет отправку сразу, не занимая
+рабочий процесс ожиданием недоступного шлюза; затем пропускает одну пробную.
+
+AsyncSMSTransport - вариант для asyncio (ASGI) с тем же предохранителем
+и повторами: каждый запрос выполняет синхронный транспорт в отдельном потоке
+(asyncio.to_thread), задержка между повторами не блокирует цикл событий.
+"""
+import asyncio
+import random
+import threading
+import time
+import requests
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+
+# Ответы, после которых запрос точно не обработан и его можно повторить
+RETRY_STATUSES = {429, 503}
+
+
+class SMSTransportError(Exception):
+    """Отправка не удалась"""
+
+
+class CircuitOpen(SMSTransportError):
+    """Шлюз недоступен: предохранитель разомкнут"""
+
+    def __init__(self, retry_after):
+        super().__init__(f'SMS-шлюз недоступен, повторите через {retry_after:.0f} с')
+        self.retry_after = retry_after
+
+
+class RetryableError(SMSTransportError):
+    """Временная ошибка, запрос не обработан: нет соединения, 429/503"""
+
+
+class UncertainError(SMSTransportError):
+    """Ответ не получен или это 5xx: шлюз мог принять запрос, повтор отправит SMS еще раз"""
+
+
+class CircuitBreaker:
+    """Предохранитель: closed -> open после threshold ошибок подряд -> half-open через reset_timeout"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold, reset_timeout, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def before_call(self):
+        """Разрешает вызов или бросает CircuitOpen; в half-open пропускает один пробный вызов"""
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            retry_after = max(self.reset_timeout - (self.clock() - self.opened_at), 0)
+            raise CircuitOpen(retry_after)
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.threshold:
+                self.opened_at = self.clock()
+            self._probing = False
+
+
+def backoff(attempt, base, cap=30.0):
+    """Задержка перед повтором номер attempt (с 1): случайная в [0, base * 2^(attempt-1)]"""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+def parse_result(status_code, payload):
+    """Разбирает ответ шлюза: словарь результата или исключение"""
+    if status_code in RETRY_STATUSES:
+        raise RetryableError(f'SMS-шлюз ответил {status_code}')
+    if status_code >= 500:
+        raise UncertainError(f'SMS-шлюз ответил {status_code}')
+    if status_code >= 400:
+        raise SMSTransportError(f'SMS-шлюз ответил {status_code}')
+    if not isinstance(payload, dict):
+        raise SMSTransportError('Invalid JSON response')
+    if 'error' in payload:
+        # Ошибка самого шлюза (fmt=3): повтор не поможет
+        raise SMSTransportError(f"{payload['error']} (код {payload.get('error_code')})")
+    return payload
+
+
+class BaseTransport:
+    def __init__(self, url=None, login=None, password=None, retries=None, backoff_base=None, breaker=None):
+        self.url = url or settings.SMS_GATEWAY_URL
+        self.login = login if login is not None else settings.SMS_GATEWAY_LOGIN
+        self.password = password if password is not None else settings.SMS_GATEWAY_PASSWORD
+        self.retries = settings.SMS_RETRIES if retries is None else retries
+        self.backoff_base = settings.SMS_RETRY_BACKOFF if backoff_base is None else backoff_base
+        self.breaker = breaker or CircuitBreaker(settings.SMS_BREAKER_THRESHOLD, settings.SMS_BREAKER_RESET)
+        self.timeout = (settings.SMS_CONNECT_TIMEOUT, settings.SMS_READ_TIMEOUT)
+        self.send_timeout = settings.SMS_SEND_TIMEOUT
+
+    def check_credentials(self):
+        if not self.login or not self.password:
+            raise ImproperlyConfigured('Не заданы SMS_GATEWAY_LOGIN и SMS_GATEWAY_PASSWORD')
+
+    def retry_delay(self, attempt, started):
+        """Задержка перед повтором или None, если повтор не уложится в SMS_SEND_TIMEOUT"""
+        if attempt > self.retries:
+            return None
+        delay = backoff(attempt, self.backoff_base)
+        if time.monotonic() - started + delay + sum(self.timeout) > self.send_timeout:
+            return None
+        return delay
+
+    def params(self, phone, message):
+        return {
+            'login': self.login,
+            'psw': self.password,
+            'phones': phone,
+            'mes': message,
+            'fmt': 3,  # JSON формат ответа
+            'charset': 'utf-8',
+        }
+
+    def list_params(self, messages):
+        """
+        Несколько сообщений одним запросом: параметр list ("телефон:текст" по строке),
+        op=1 - результат по каждому номеру в поле phones ответа
+        """
+        return {
+            'login': self.login,
+            'psw': self.password,
+            'list': '\n'.join(f"{phone}:{message.replace(chr(10), ' ')}" for phone, message in messages),
+            'op': 1,
+            'fmt': 3,
+            'charset': 'utf-8',
+        }
+
+
+class SMSTransport(BaseTransport):
+    """Синхронный транспорт с пулом соединений, повторами и предохранителем"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.SMS_POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, params):
+        """Один запрос к шлюзу без повторов"""
+        try:
+            response = self.session.get(self.url, params=params, timeout=self.timeout)
+        except requests.exceptions.ConnectTimeout as e:
+            raise RetryableError(str(e))
+        except requests.exceptions.ConnectionError as e:
+            reason = getattr(e.args[0], 'reason', None) if e.args else None
+            if isinstance(reason, NewConnectionError):
+                # Соединение не установлено: запрос до шлюза не дошел
+                raise RetryableError(str(e))
+            raise UncertainError(str(e))
+        except requests.exceptions.RequestException as e:
+            raise UncertainError(str(e))
+        try:
+            payload = response.json()
+        except ValueError:
+            payload = None
+        return parse_result(response.status_code, payload)
+
+    def send(self, phone, message):
+        """Отправляет SMS; возвращает ответ шлюза или бросает SMSTransportError"""
+        return self.call(self.params(phone, message))
+
+    def send_list(self, messages):
+        """Отправляет список пар (телефон, текст) одним запросом"""
+        return self.call(self.list_params(messages))
+
+    def call(self, params):
+        """Запрос с повторами и предохранителем"""
+        self.check_credentials()
+        self.breaker.before_call()
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                result = self.request(params)
+            except RetryableError:
+                attempt += 1
+                delay = self.retry_delay(attempt, started)
+                if delay is None:
+                    self.breaker.record_failure()
+                    raise
+                time.sleep(delay)
+                continue
+            except UncertainError:
+                self.breaker.record_failure()
+                raise
+            except SMSTransportError:
+                # Шлюз доступен и ответил: предохранитель не размыкается
+                self.breaker.record_success()
+                raise
+            self.breaker.record_success()
+            return result
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncSMSTransport(BaseTransport):
+    """Асинхронный транспорт: те же повторы и предохранитель, ожидание без блокировки цикла событий"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Пул соединений синхронного транспорта; повторы и предохранитель - здесь
+        self.sync = SMSTransport(self.url, self.login, self.password, retries=0, breaker=self.breaker)
+
+    async def request(self, params):
+        return await asyncio.to_thread(self.sync.request, params)
+
+    async def send(self, phone, message):
+        return await self.call(self.params(phone, message))
+
+    async def send_list(self, messages):
+        return await self.call(self.list_params(messages))
+
+    async def call(self, params):
+        self.check_credentials()
+        self.breaker.before_call()
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                result = await self.request(params)
+            except RetryableError:
+                attempt += 1
+                delay = self.retry_delay(attempt, started)
+                if delay is None:
+                    self.breaker.record_failure()
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            except UncertainError:
+                self.breaker.record_failure()
+                raise
+            except SMSTransportError:
+                self.breaker.record_success()
+                raise
+            self.breaker.record_success()
+            return result
+
+    async def aclose(self):
+        self.sync.close()
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """Общий для процесса транспорт (одна сессия и один предохранитель на процесс)"""
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = SMSTransport()
+    return _transport
+
+
+def reset_transport():
+    """Закрывает общий транспорт; следующий вызов get_transport создаст новый (после смены настроек)"""
+    global _transport
+    with _transport_lock:
+        if _transport is not None:
+            _transport.close()
+        _transport = None
@@ -0,0 +1,398 @@
+"""
+Подсказки при вводе и исправление опечаток в поисковых запросах.
+
+Названия активных объявлений, категорий и городов хранятся в памяти процесса:
+слова приводятся к общему латинскому «фонетическому» виду (транслитерация и
+упрощение написания), поэтому «айфон» и «iphone» оказываются рядом. Для слов
+строится отсортированный список (поиск по префиксу) и триграммный индекс
+(похожие слова с опечатками).
+
+Индекс строится в фоновом потоке: при первом обращении и раз в
+SUGGEST_INDEX_TTL секунд. Запросы не ждут построения - до его конца
+отвечает прежний индекс (при первом построении - пустой), затем ссылка на
+индекс заменяется новым. Изменения моделей применяются к индексу после
+фиксации транзакции; пришедшие во время построения повторяются на новом
+индексе перед заменой. SUGGEST_BUILD_IN_BACKGROUND=False строит индекс
+в запросе (тесты, команды).
+"""
+import bisect
+import heapq
+import re
+import threading
+import time
+from collections import Counter, defaultdict, namedtuple
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+
+WORD_RE = re.compile(r'[0-9a-zа-я]+')
+
+TRANSLIT = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ж': 'zh', 'з': 'z',
+    'и': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p',
+    'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch',
+    'ш': 'sh', 'щ': 'sh', 'ъ': '', 'ы': 'i', 'ь': '', 'э': 'e', 'ю': 'iu', 'я': 'ia',
+}
+
+# Упрощение латинского написания, чтобы транслит и оригинал совпадали
+PHONETIC_RULES = [
+    ('ph', 'f'), ('ck', 'k'), ('q', 'k'), ('x', 'ks'), ('w', 'v'), ('y', 'i'),
+    ('j', 'i'), ('c', 'k'),
+]
+
+SIMILARITY_THRESHOLD = 0.3
+
+# Более короткие слова ищем только по префиксу
+MIN_FUZZY_LENGTH = 4
+
+# Приоритет типов подсказок при равной похожести
+KIND_WEIGHTS = {
+    'category': 0.2,
+    'city': 0.15,
+    'title': 0.0,
+}
+
+Entry = namedtuple('Entry', ['kind', 'id', 'text', 'words'])
+
+
+def phonetic(word):
+    """Приводит слово к латинскому фонетическому ключу"""
+    word = word.lower().replace('ё', 'е')
+    word = ''.join(TRANSLIT.get(char, char) for char in word)
+    for source, target in PHONETIC_RULES:
+        word = word.replace(source, target)
+    # Схлопываем двойные буквы и немую «e» на конце
+    word = re.sub(r'([a-z])\1+', r'\1', word)
+    if len(word) > 3 and word.endswith('e') and word[-2] not in 'aeiou':
+        word = word[:-1]
+    return word
+
+
+def split_words(text):
+    return WORD_RE.findall((text or '').lower().replace('ё', 'е'))
+
+
+def trigrams(word):
+    padded = f'  {word} '
+    return {padded[index:index + 3] for index in range(len(padded) - 2)}
+
+
+class SuggestIndex:
+    """
+    Префиксный и триграммный индекс слов названий. Для каждого слова хранится
+    список записей, отсортированный по длине текста, поэтому лучшие подсказки
+    по одному слову берутся слиянием начал списков без перебора всех записей.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.names = set()
+        self.word_entries = {}
+        self.word_trigrams = defaultdict(set)
+        self.trigram_counts = {}
+        self.surface = {}
+        self.sorted_words = []
+        self.built_at = time.monotonic()
+        self.lock = threading.RLock()
+
+    # Обновление
+
+    def add(self, kind, entry_id, text):
+        with self.lock:
+            self.remove(kind, entry_id)
+            entry = Entry(kind, entry_id, text, tuple(
+                word for word in (phonetic(surface) for surface in split_words(text)) if word
+            ))
+            key = (kind, entry_id)
+            self.entries[key] = entry
+            if kind != 'title':
+                self.names.add(key)
+            surfaces = dict(zip(entry.words, split_words(text)))
+            for word in set(entry.words):
+                if word not in self.word_entries:
+                    self._add_word(word, surfaces.get(word, word))
+                bisect.insort(self.word_entries[word], self.sort_key(entry))
+
+    def remove(self, kind, entry_id):
+        with self.lock:
+            entry = self.entries.pop((kind, entry_id), None)
+            if entry is None:
+                return
+            self.names.discard((kind, entry_id))
+            sort_key = self.sort_key(entry)
+            for word in set(entry.words):
+                postings = self.word_entries.get(word)
+                if postings is None:
+                    continue
+                index = bisect.bisect_left(postings, sort_key)
+                if index < len(postings) and postings[index] == sort_key:
+                    del postings[index]
+                if not postings:
+                    self._remove_word(word)
+
+    @staticmethod
+    def sort_key(entry):
+        return (len(entry.text), entry.text.lower(), entry.kind, entry.id)
+
+    def _add_word(self, word, surface):
+        self.word_entries[word] = []
+        bisect.insort(self.sorted_words, word)
+        word_trigrams = trigrams(word)
+        self.trigram_counts[word] = len(word_trigrams)
+        for trigram in word_trigrams:
+            self.word_trigrams[trigram].add(word)
+        self.surface[word] = surface
+
+    def _remove_word(self, word):
+        del self.word_entries[word]
+        index = bisect.bisect_left(self.sorted_words, word)
+        if index < len(self.sorted_words) and self.sorted_words[index] == word:
+            del self.sorted_words[index]
+        for trigram in trigrams(word):
+            words = self.word_trigrams.get(trigram)
+            if words is not None:
+                words.discard(word)
+                if not words:
+                    del self.word_trigrams[trigram]
+        self.trigram_counts.pop(word, None)
+        self.surface.pop(word, None)
+
+    # Поиск
+
+    def prefix_words(self, prefix, limit=200):
+        index = bisect.bisect_left(self.sorted_words, prefix)
+        result = []
+        while index < len(self.sorted_words) and len(result) < limit:
+            word = self.sorted_words[index]
+            if not word.startswith(prefix):
+                break
+            result.append(word)
+            index += 1
+        return result
+
+    def similar_words(self, word, threshold=SIMILARITY_THRESHOLD):
+        """Слова словаря, похожие на word по триграммам: {слово: похожесть}"""
+        word_trigrams = trigrams(word)
+        shared = Counter()
+        for trigram in word_trigrams:
+            shared.update(self.word_trigrams.get(trigram, ()))
+        result = {}
+        for candidate, common in shared.items():
+            similarity = common / (len(word_trigrams) + self.trigram_counts[candidate] - common)
+            if similarity >= threshold:
+                result[candidate] = similarity
+        return result
+
+    def candidates(self, word, is_prefix):
+        """Варианты слова из словаря с оценкой совпадения"""
+        scores = self.similar_words(word) if len(word) >= MIN_FUZZY_LENGTH else {}
+        if is_prefix:
+            for candidate in self.prefix_words(word):
+                scores[candidate] = max(scores.get(candidate, 0), 0.9)
+        if word in self.word_entries:
+            scores[word] = 1.0
+        return scores
+
+    @staticmethod
+    def entry_score(entry, candidates):
+        """Сумма лучших совпадений слов запроса со словами записи (None - не все нашлись)"""
+        total = 0
+        for word_candidates in candidates:
+            best = max((word_candidates.get(word, 0) for word in entry.words), default=0)
+            if not best:
+                return None
+            total += best
+        return total / len(candidates)
+
+    def suggest(self, query, limit=10):
+        words = [phonetic(word) for word in split_words(query)]
+        words = [word for word in words if word]
+        if not words:
+            return []
+        is_prefix = not query[-1:].isspace()
+
+        with self.lock:
+            candidates = [
+                self.candidates(word, is_prefix and index == len(words) - 1)
+                for index, word in enumerate(words)
+            ]
+            if not all(candidates):
+                return []
+
+            # Категорий и городов немного - оцениваем все
+            scored = []
+            for key in self.names:
+                entry = self.entries[key]
+                score = self.entry_score(entry, candidates)
+                if score is not None:
+                    scored.append((score + KIND_WEIGHTS[entry.kind], self.sort_key(entry)))
+
+            scored.extend(self.best_titles(candidates, limit))
+
+            scored.sort(key=lambda item: (-item[0], item[1]))
+            result = []
+            seen_texts = set()
+            for score, sort_key in scored:
+                length, text, kind, entry_id = sort_key
+                if (kind, text) in seen_texts:
+                    continue
+                seen_texts.add((kind, text))
+                result.append({
+                    'type': kind,
+                    'id': entry_id,
+                    'text': self.entries[(kind, entry_id)].text,
+                    'score': round(score, 3),
+                })
+                if len(result) >= limit:
+                    break
+            return result
+
+    def best_titles(self, candidates, limit):
+        """
+        Лучшие объявления без перебора всех совпадений. Ведущим берется самое
+        редкое слово запроса; его варианты обходятся от более похожих к менее
+        похожим, списки записей сливаются по длине текста. Обход прекращается,
+        когда limit найденных записей не может обогнать уже ни одна следующая.
+        """
+        driver_index = min(
+            range(len(candidates)),
+            key=lambda index: sum(len(self.word_entries[word]) for word in candidates[index]),
+        )
+        others = sum(max(item.values()) for index, item in enumerate(candidates) if index != driver_index)
+        by_similarity = defaultdict(list)
+        for word, similarity in candidates[driver_index].items():
+            by_similarity[similarity].append(self.word_entries[word])
+
+        best = {}
+        seen = set()
+        for similarity in sorted(by_similarity, reverse=True):
+            bound = (similarity + others) / len(candidates)
+            confident = sum(1 for score, sort_key in best.values() if score >= bound)
+            if confident >= limit:
+                break
+            for sort_key in heapq.merge(*by_similarity[similarity]):
+                if sort_key[2] != 'title' or sort_key in seen:
+                    continue
+                seen.add(sort_key)
+                score = self.entry_score(self.entries[(sort_key[2], sort_key[3])], candidates)
+                if score is None:
+                    continue
+                previous = best.get(sort_key[1])
+                if previous is None or score > previous[0]:
+                    best[sort_key[1]] = (score, sort_key)
+                    if score >= bound and (previous is None or previous[0] < bound):
+                        confident += 1
+                        if confident >= limit:
+                            return list(best.values())
+        return list(best.values())
+
+    def correct(self, query):
+        """
+        Исправляет опечатки: каждое слово запроса, которого нет в словаре,
+        заменяется самым похожим словом. Возвращает None, если исправлять нечего.
+        """
+        corrected = []
+        changed = False
+        with self.lock:
+            for surface in split_words(query):
+                word = phonetic(surface)
+                if not word or word in self.word_entries:
+                    corrected.append(surface)
+                    continue
+                similar = self.similar_words(word)
+                if not similar:
+                    corrected.append(surface)
+                    continue
+                best = max(similar.items(), key=lambda item: (item[1], len(self.word_entries[item[0]])))[0]
+                corrected.append(self.surface[best])
+                changed = True
+        return ' '.join(corrected) if changed else None
+
+
+_index = None
+_build_lock = threading.Lock()
+# Изменения, пришедшие во время построения (None - построение не идет)
+_pending = None
+
+
+def build_index():
+    from .models import Advertisement, Category, City
+
+    index = SuggestIndex()
+    for advertisement_id, title in Advertisement.objects.filter(status='active').values_list('id', 'title').iterator():
+        index.add('title', advertisement_id, title)
+    for category_id, name in Category.objects.values_list('id', 'name'):
+        index.add('category', category_id, name)
+    for city_id, name in City.objects.filter(is_active=True).values_list('id', 'name'):
+        index.add('city', city_id, name)
+    return index
+
+
+def get_index():
+    """Индекс подсказок процесса; устаревший перестраивается в фоне, не задерживая запрос"""
+    index = _index
+    if index is not None and time.monotonic() - index.built_at < settings.SUGGEST_INDEX_TTL:
+        return index
+    if not settings.SUGGEST_BUILD_IN_BACKGROUND:
+        rebuild()
+        return _index if _index is not None else SuggestIndex()
+    if _pending is None:
+        threading.Thread(target=_rebuild_in_background, name='suggest-index', daemon=True).start()
+    # Пока строится новый, отвечает прежний индекс
+    return index if index is not None else SuggestIndex()
+
+
+def rebuild():
+    """Строит индекс и заменяет им текущий; параллельный вызов ничего не делает"""
+    global _index, _pending
+    with _build_lock:
+        if _pending is not None:
+            return
+        _pending = []
+    try:
+        index = build_index()
+    except Exception:
+        with _build_lock:
+            _pending = None
+        raise
+    with _build_lock:
+        # Изменения, которых могло не быть в прочитанных данных
+        for change in _pending:
+            _apply(index, *change)
+        _index = index
+        _pending = None
+
+
+def _rebuild_in_background():
+    try:
+        rebuild()
+    except Exception as e:
+        print(f"Ошибка построения индекса подсказок: {e}")
+    finally:
+        close_old_connections()
+
+
+def _apply(index, kind, entry_id, text, visible):
+    if visible:
+        index.add(kind, entry_id, text)
+    else:
+        index.remove(kind, entry_id)
+
+
+def _apply_change(kind, entry_id, text, visible):
+    with _build_lock:
+        if _pending is not None:
+            _pending.append((kind, entry_id, text, visible))
+        index = _index
+    if index is not None:
+        _apply(index, kind, entry_id, text, visible)
+
+
+def update(kind, entry_id, text, visible=True):
+    """Обновляет запись после фиксации транзакции, если индекс построен или строится"""
+    transaction.on_commit(lambda: _apply_change(kind, entry_id, text, visible))
+
+
+def reset():
+    global _index
+    _index = None
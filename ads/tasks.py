@@ -0,0 +1,171 @@
+"""
+Фоновая очередь задач в БД, без внешнего брокера.
+
+Задачи - строки BackgroundTask. Обработчик забирает задачу условным UPDATE
+(status = 'pending' -> 'running'), поэтому несколько потоков и процессов могут
+разбирать одну очередь: задачу получит ровно один из них. Успешно выполненная
+задача удаляется; при ошибке она возвращается в очередь с задержкой, а после
+TASK_MAX_ATTEMPTS попыток остается со статусом failed. Задачи, зависшие
+в running дольше TASK_LOCK_TIMEOUT (например, процесс упал), снова попадают
+в очередь.
+
+Разбирать очередь можно командой process_tasks или потоками внутри
+веб-процесса (TASK_WORKER_THREADS > 0).
+"""
+import os
+import socket
+import threading
+import traceback
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import BackgroundTask
+
+
+# Тип задачи -> (функция(payload), функция(payload, error) после последней неудачной попытки)
+HANDLERS = {}
+
+_wakeup = threading.Event()
+_workers = []
+_workers_lock = threading.Lock()
+
+
+def register(kind, on_failure=None):
+    """Регистрирует обработчик задач типа kind"""
+    def decorator(function):
+        HANDLERS[kind] = (function, on_failure)
+        return function
+    return decorator
+
+
+def enqueue(kind, payload=None, delay=0):
+    """Ставит задачу в очередь; запись попадает в БД вместе с текущей транзакцией"""
+    task = BackgroundTask.objects.create(
+        kind=kind,
+        payload=payload or {},
+        run_after=timezone.now() + timedelta(seconds=delay),
+    )
+    transaction.on_commit(notify)
+    return task
+
+
+def notify():
+    """Будит потоки-обработчики текущего процесса (и запускает их при первой задаче)"""
+    start_workers()
+    _wakeup.set()
+
+
+def worker_name(suffix=''):
+    return f'{socket.gethostname()}:{os.getpid()}:{suffix or threading.get_ident()}'
+
+
+def release_stale():
+    """Возвращает в очередь задачи, которые слишком долго висят в работе"""
+    deadline = timezone.now() - timedelta(seconds=settings.TASK_LOCK_TIMEOUT)
+    return BackgroundTask.objects.filter(
+        status=BackgroundTask.STATUS_RUNNING, locked_at__lt=deadline
+    ).update(status=BackgroundTask.STATUS_PENDING, locked_by='', locked_at=None)
+
+
+def claim(worker, batch=10):
+    """Забирает следующую готовую задачу; None - очередь пуста"""
+    now = timezone.now()
+    candidates = BackgroundTask.objects.filter(
+        status=BackgroundTask.STATUS_PENDING, run_after__lte=now
+    ).order_by('run_after', 'id').values_list('id', flat=True)[:batch]
+    for task_id in candidates:
+        # Задачу получает тот, чей UPDATE изменил строку
+        claimed = BackgroundTask.objects.filter(
+            pk=task_id, status=BackgroundTask.STATUS_PENDING
+        ).update(
+            status=BackgroundTask.STATUS_RUNNING,
+            locked_by=worker,
+            locked_at=now,
+            attempts=F('attempts') + 1,
+        )
+        if claimed:
+            return BackgroundTask.objects.get(pk=task_id)
+    return None
+
+
+def execute(task):
+    """Выполняет задачу и записывает результат; True - успешно"""
+    function, on_failure = HANDLERS.get(task.kind, (None, None))
+    try:
+        if function is None:
+            raise LookupError(f'Неизвестный тип задачи: {task.kind}')
+        function(task.payload)
+    except Exception as e:
+        error = traceback.format_exc()
+        print(f"Ошибка в фоновой задаче {task.kind} #{task.pk}: {e}")
+        if function is not None and task.attempts < settings.TASK_MAX_ATTEMPTS:
+            # Экспоненциальная задержка перед следующей попыткой
+            delay = min(settings.TASK_RETRY_DELAY * 2 ** (task.attempts - 1), 3600)
+            BackgroundTask.objects.filter(pk=task.pk).update(
+                status=BackgroundTask.STATUS_PENDING,
+                run_after=timezone.now() + timedelta(seconds=delay),
+                locked_by='',
+                locked_at=None,
+                last_error=error,
+            )
+        else:
+            BackgroundTask.objects.filter(pk=task.pk).update(
+                status=BackgroundTask.STATUS_FAILED, last_error=error
+            )
+            if on_failure is not None:
+                try:
+                    on_failure(task.payload, e)
+                except Exception as failure_error:
+                    print(f"Ошибка при обработке сбоя задачи {task.kind} #{task.pk}: {failure_error}")
+        return False
+    BackgroundTask.objects.filter(pk=task.pk).delete()
+    return True
+
+
+def run_pending(worker=None, limit=None):
+    """Выполняет готовые задачи, пока очередь не опустеет; возвращает их количество"""
+    worker = worker or worker_name()
+    release_stale()
+    processed = 0
+    while limit is None or processed < limit:
+        task = claim(worker)
+        if task is None:
+            break
+        execute(task)
+        processed += 1
+    return processed
+
+
+def work_loop(worker=None, stop=None):
+    """Цикл обработчика: разбирает очередь и ждет новых задач"""
+    worker = worker or worker_name()
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        try:
+            processed = run_pending(worker)
+        except Exception as e:
+            print(f"Ошибка обработчика фоновых задач: {e}")
+            processed = 0
+        finally:
+            close_old_connections()
+        if not processed:
+            _wakeup.wait(settings.TASK_POLL_INTERVAL)
+            _wakeup.clear()
+
+
+def start_workers():
+    """Запускает TASK_WORKER_THREADS потоков-обработчиков в текущем процессе (однократно)"""
+    count = settings.TASK_WORKER_THREADS
+    if _workers or count <= 0:
+        return
+    with _workers_lock:
+        if _workers:
+            return
+        for index in range(count):
+            thread = threading.Thread(
+                target=work_loop, args=(worker_name(f'thread-{index}'),), name=f'task-worker-{index}', daemon=True
+            )
+            thread.start()
+            _workers.append(thread)
@@ -1,9 +1,58 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock
+from PIL import Image
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.core.cache import cache, caches
+from django.core.cache.backends.db import DatabaseCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Prefetch
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
 from django.urls import reverse
-from rest_framework.test import APITestCase
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, APITestCase
 from rest_framework import status
-from .models import Category, Advertisement
+from .models import (
+    City, Category, Advertisement, AdvertisementImage, AdvertisementCounter, BackgroundTask, Favorite, ImageUpload,
+    MediaBlob, SearchDocument, SearchPosting, SearchStats, SMSOutbox, SMSVerification
+)
+from .serializers import AdvertisementDetailSerializer, AdvertisementListSerializer, FavoriteSerializer
+from . import (
+    chunked_upload, counters, expiration, fast_serializers, field_selection, image_processing, image_variants, media_store, search,
+    rate_limit, sms_outbox, sms_transport, suggest, tasks, verification_store, versions, view_counter
+)
+from .category_tree import get_tree
+from .renderers import FastJSONRenderer, stream_json_list
+from .sms_fake_gateway import FakeSMSGateway
+from .sms_service import SMSService
+
+
+# Тесты числа SQL-запросов: кеш в памяти, чтобы обращения к кешу (по умолчанию - таблица в БД) не считались
+MEMORY_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests'}}
+
+
+def response_json(response):
+    """Разбирает JSON ответа, в том числе потокового"""
+    if response.streaming:
+        return json.loads(b''.join(response.streaming_content))
+    return json.loads(response.content)
 
 
 class CategoryModelTest(TestCase):
@@ -154,3 +203,2248 @@ class CategoryAPITest(APITestCase):
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data['name'], 'Тестовая категория')
+
+
+@override_settings(CACHES=MEMORY_CACHES)
+class AdvertisementListQueryCountTest(APITestCase):
+    """Количество запросов на страницу списка не зависит от числа объявлений"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='lister', password='testpass123')
+        self.moscow = City.objects.create(name='Москва', slug='moscow')
+        self.kazan = City.objects.create(name='Казань', slug='kazan')
+        self.parent = Category.objects.create(name='Транспорт', slug='transport')
+        self.cars = Category.objects.create(name='Автомобили', slug='cars', parent=self.parent)
+        self.bikes = Category.objects.create(name='Велосипеды', slug='bikes', parent=self.parent)
+        self.bikes.cities.add(self.moscow, self.kazan)
+        # Снимок дерева категорий строится один раз на процесс, а не на запрос
+        get_tree()
+
+    def create_ads(self, count):
+        categories = [self.cars, self.bikes]
+        cities = [self.moscow, self.kazan]
+        for index in range(count):
+            ad = Advertisement.objects.create(
+                title=f'Велосипед {index}',
+                description='Описание',
+                price=1000 + index,
+                category=categories[index % 2],
+                city=cities[index % 2],
+                author=self.user,
+                status='active',
+                is_featured=True,
+            )
+            AdvertisementImage.objects.create(advertisement=ad, image=f'advertisements/{index}.jpg', is_primary=True)
+            AdvertisementImage.objects.create(advertisement=ad, image=f'advertisements/{index}-2.jpg')
+            Favorite.objects.create(user=self.user, advertisement=ad)
+
+    def assertConstantQueries(self, url, num, params=None):
+        self.create_ads(2)
+        with self.assertNumQueries(num):
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.create_ads(10)
+        with self.assertNumQueries(num):
+            response = self.client.get(url, params)
+        self.assertEqual(len(response.data['results']), 12)
+        return response
+
+    def test_list(self):
+        response = self.assertConstantQueries(reverse('advertisement-list'), 6)
+        item = response.data['results'][0]
+        self.assertEqual(item['images_count'], 2)
+        self.assertTrue(item['primary_image']['is_primary'])
+        self.assertEqual(item['category']['advertisements_count'], 6)
+        self.assertEqual(item['category']['level'], 1)
+        self.assertEqual(item['city']['advertisements_count'], 6)
+
+    def test_featured(self):
+        self.assertConstantQueries(reverse('advertisement-featured'), 6)
+
+    def test_search(self):
+        # Ранжирование: статистика индекса, частоты терминов и вхождения; без COUNT страницы
+        self.assertConstantQueries(reverse('advertisement-search'), 8, {'q': 'Велосипед'})
+
+    def test_by_city(self):
+        self.client.force_authenticate(user=self.user)
+        self.create_ads(2)
+        url = reverse('advertisement-by-city')
+        with self.assertNumQueries(6):
+            self.client.get(url, {'city_id': self.moscow.id})
+        self.create_ads(10)
+        with self.assertNumQueries(6):
+            response = self.client.get(url, {'city_id': self.moscow.id})
+        self.assertEqual(len(response.data['results']), 6)
+
+    def test_my_advertisements(self):
+        self.client.force_authenticate(user=self.user)
+        self.assertConstantQueries(reverse('advertisement-my-advertisements'), 6)
+
+    def test_favorites(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.assertConstantQueries(reverse('favorite-list'), 7)
+        self.assertEqual(response.data['results'][0]['advertisement']['images_count'], 2)
+
+    def test_sparse_fields(self):
+        # Подсчет страницы, объявления, города и главные изображения - без категорий и авторов
+        params = {'fields': 'id,title,price,primary_image,city.name'}
+        response = self.assertConstantQueries(reverse('advertisement-list'), 4, params)
+        item = response.data['results'][0]
+        # Порядок ключей - как в полном ответе
+        self.assertEqual(list(item), ['id', 'title', 'price', 'city', 'primary_image'])
+        self.assertEqual(item['city'], {'name': 'Казань'})
+        self.assertTrue(item['primary_image']['is_primary'])
+
+    def test_expand(self):
+        # Не перечисленные в expand связи отдаются идентификаторами
+        response = self.assertConstantQueries(reverse('advertisement-list'), 4, {'expand': 'city'})
+        item = response.data['results'][0]
+        self.assertEqual(item['category'], self.bikes.id)
+        self.assertEqual(item['author'], self.user.id)
+        self.assertEqual(item['city']['name'], 'Казань')
+
+        url = reverse('advertisement-detail', args=[item['id']])
+        detail = self.client.get(url, {'fields': 'title,images,is_favorited', 'expand': ''}).data
+        self.assertEqual(list(detail), ['title', 'images', 'is_favorited'])
+        self.assertEqual(len(detail['images']), 2)
+        self.assertIsInstance(detail['images'][0], int)
+
+    def test_sparse_favorites(self):
+        self.client.force_authenticate(user=self.user)
+        params = {'fields': 'id,advertisement.title,advertisement.category.name'}
+        response = self.assertConstantQueries(reverse('favorite-list'), 4, params)
+        item = response.data['results'][0]
+        self.assertEqual(list(item), ['id', 'advertisement'])
+        self.assertEqual(list(item['advertisement']), ['title', 'category'])
+        self.assertEqual(list(item['advertisement']['category']), ['name'])
+        response = self.client.get(reverse('favorite-list'), {'expand': ''})
+        self.assertIsInstance(response.data['results'][0]['advertisement'], int)
+
+    def test_sparse_categories(self):
+        response = self.client.get(reverse('category-hierarchy'), {'fields': 'name,children.slug'})
+        self.assertEqual(
+            response_json(response),
+            [{'name': 'Транспорт', 'children': [{'slug': 'cars'}, {'slug': 'bikes'}]}]
+        )
+        response = self.client.get(reverse('category-detail', args=['bikes']), {'expand': ''})
+        self.assertEqual(response.data['cities'], [self.kazan.id, self.moscow.id])
+        self.assertEqual(response.data['available_cities_display'], 'Казань, Москва')
+
+
+class AdvertisementCounterTest(TestCase):
+    """Счетчики активных объявлений поддерживаются при изменении объявлений"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='counter', password='testpass123')
+        self.moscow = City.objects.create(name='Москва', slug='moscow')
+        self.kazan = City.objects.create(name='Казань', slug='kazan')
+        self.parent = Category.objects.create(name='Транспорт', slug='transport')
+        self.cars = Category.objects.create(name='Автомобили', slug='cars', parent=self.parent)
+        self.bikes = Category.objects.create(name='Велосипеды', slug='bikes', parent=self.parent)
+
+    def create_ad(self, **kwargs):
+        data = {
+            'title': 'Объявление',
+            'description': 'Описание',
+            'price': 100,
+            'category': self.cars,
+            'city': self.moscow,
+            'author': self.user,
+            'status': 'active',
+        }
+        data.update(kwargs)
+        return Advertisement.objects.create(**data)
+
+    def test_create_and_delete(self):
+        ad = self.create_ad()
+        self.create_ad(status='pending')
+        self.assertEqual(counters.category_count(self.cars.id), 1)
+        self.assertEqual(counters.city_count(self.moscow.id), 1)
+        ad.delete()
+        self.assertEqual(counters.category_count(self.cars.id), 0)
+
+    def test_status_category_and_city_changes(self):
+        ad = self.create_ad(status='pending')
+        self.assertEqual(counters.category_count(self.cars.id), 0)
+        ad.status = 'active'
+        ad.save()
+        self.assertEqual(counters.category_count(self.cars.id, self.moscow.id), 1)
+
+        ad = Advertisement.objects.get(pk=ad.pk)
+        ad.category = self.bikes
+        ad.city = self.kazan
+        ad.save()
+        self.assertEqual(counters.category_count(self.cars.id), 0)
+        self.assertEqual(counters.category_count(self.bikes.id, self.kazan.id), 1)
+        self.assertEqual(counters.city_count(self.moscow.id), 0)
+
+        ad.city = None
+        ad.save()
+        self.assertEqual(counters.category_count(self.bikes.id), 1)
+        self.assertEqual(counters.city_count(self.kazan.id), 0)
+
+    def test_queryset_delete_and_parent_rollup(self):
+        self.create_ad()
+        self.create_ad(category=self.bikes, city=self.kazan)
+        self.create_ad(category=self.bikes)
+        self.assertEqual(self.parent.get_unviewed_count_for_user(self.user), 3)
+        self.assertEqual(self.parent.get_unviewed_count_for_user(self.user, str(self.kazan.id)), 1)
+        self.assertEqual(self.parent.get_unviewed_count_for_user(self.user, 'all'), 3)
+
+        Advertisement.objects.filter(category=self.bikes).delete()
+        self.assertEqual(self.parent.get_unviewed_count_for_user(self.user), 1)
+
+    def test_drift_is_clamped_and_reported(self):
+        self.create_ad()
+        self.create_ad()
+        AdvertisementCounter.objects.update(active_count=1)
+        output = StringIO()
+        with redirect_stdout(output):
+            counters.apply_deltas({(self.cars.id, self.moscow.id): -2})
+        self.assertEqual(counters.category_count(self.cars.id), 0)
+        self.assertIn('rebuild_ad_counters', output.getvalue())
+
+    def test_rebuild_command(self):
+        self.create_ad()
+        self.create_ad(category=self.bikes, city=None)
+        Advertisement.objects.update(status='active')
+        AdvertisementCounter.objects.all().delete()
+        call_command('rebuild_ad_counters', stdout=open(os.devnull, 'w'))
+        self.assertEqual(counters.category_count(self.cars.id), 1)
+        self.assertEqual(counters.category_count(self.bikes.id), 1)
+        self.assertEqual(AdvertisementCounter.objects.count(), 2)
+
+
+@override_settings(CACHES=MEMORY_CACHES)
+class CategoryTreeTest(APITestCase):
+    """Материализованный путь и снимок дерева категорий"""
+
+    def setUp(self):
+        cache.clear()
+        self.transport = Category.objects.create(name='Транспорт', slug='transport')
+        self.cars = Category.objects.create(name='Автомобили', slug='cars', parent=self.transport)
+        self.sedans = Category.objects.create(name='Седаны', slug='sedans', parent=self.cars)
+        self.realty = Category.objects.create(name='Недвижимость', slug='realty')
+
+    def test_path_and_level(self):
+        self.assertEqual(self.transport.path, f'/{self.transport.id}/')
+        self.assertEqual(self.sedans.path, f'/{self.transport.id}/{self.cars.id}/{self.sedans.id}/')
+        self.assertEqual(self.sedans.level, 2)
+        self.assertEqual(self.sedans.get_ancestor_ids(), [self.cars.id, self.transport.id])
+        self.assertEqual(self.sedans.get_all_parents(), [self.cars, self.transport])
+
+    def test_move_subtree(self):
+        self.cars.parent = self.realty
+        self.cars.save()
+        self.sedans.refresh_from_db()
+        self.assertEqual(self.sedans.path, f'/{self.realty.id}/{self.cars.id}/{self.sedans.id}/')
+        self.assertEqual(self.sedans.depth, 2)
+        self.assertEqual(self.realty.get_all_children(), [self.cars, self.sedans])
+        self.assertFalse(self.transport.is_parent)
+
+        self.cars.parent = None
+        self.cars.save()
+        self.sedans.refresh_from_db()
+        self.assertEqual(self.sedans.level, 1)
+
+    def test_cycle_is_rejected(self):
+        self.transport.parent = self.sedans
+        with self.assertRaises(ValueError):
+            self.transport.save()
+
+    def test_tree_answers_without_queries(self):
+        get_tree()
+        with self.assertNumQueries(0):
+            self.assertTrue(self.transport.is_parent)
+            self.assertFalse(self.sedans.is_parent)
+            self.assertEqual(self.transport.get_descendant_ids(), [self.cars.id, self.sedans.id])
+            self.assertEqual(get_tree().leaf_descendants(self.transport.id), [self.sedans.id])
+
+    def test_hierarchy_queries_do_not_grow(self):
+        get_tree()
+        url = reverse('category-hierarchy')
+        with self.assertNumQueries(4):
+            data = response_json(self.client.get(url))
+        self.assertEqual(data[1]['children'][0]['level'], 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            for index in range(5):
+                Category.objects.create(name=f'Раздел {index}', slug=f'section-{index}', parent=self.realty)
+        get_tree()
+        with self.assertNumQueries(4):
+            response_json(self.client.get(url))
+
+
+class AdvertisementCursorPaginationTest(APITestCase):
+    """Курсорная пагинация лент объявлений"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='scroller', password='testpass123')
+        self.category = Category.objects.create(name='Электроника', slug='electronics')
+        self.city = City.objects.create(name='Москва', slug='moscow')
+        for index in range(45):
+            Advertisement.objects.create(
+                title=f'Телефон {index}',
+                description='Описание',
+                price=100 * (index % 7),
+                category=self.category,
+                city=self.city,
+                author=self.user,
+                status='active',
+                is_featured=index % 2 == 0,
+            )
+
+    def collect(self, url, params):
+        ids = []
+        response = self.client.get(url, params)
+        pages = [response.data]
+        while response.data['next']:
+            self.assertNotIn('count', response.data)
+            response = self.client.get(response.data['next'])
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            pages.append(response.data)
+        for page in pages:
+            ids.extend(item['id'] for item in page['results'])
+        return ids, pages
+
+    def test_created_at_order_covers_all_ads(self):
+        ids, pages = self.collect(reverse('advertisement-list'), {'pagination': 'cursor'})
+        expected = list(
+            Advertisement.objects.order_by('-created_at', '-id').values_list('id', flat=True)
+        )
+        self.assertEqual(ids, expected)
+        self.assertEqual(len(pages), 3)
+        self.assertIsNone(pages[0]['previous'])
+
+    def test_price_order_with_ties(self):
+        for ordering in ['price', '-price']:
+            ids, pages = self.collect(
+                reverse('advertisement-list'), {'pagination': 'cursor', 'ordering': ordering}
+            )
+            expected = list(
+                Advertisement.objects.order_by(ordering, ordering.replace('price', 'id'))
+                .values_list('id', flat=True)
+            )
+            self.assertEqual(ids, expected)
+
+    def test_previous_link_returns_same_page(self):
+        url = reverse('advertisement-list')
+        first = self.client.get(url, {'pagination': 'cursor'}).data
+        second = self.client.get(first['next']).data
+        back = self.client.get(second['previous']).data
+        self.assertEqual(
+            [item['id'] for item in back['results']],
+            [item['id'] for item in first['results']]
+        )
+
+    def test_other_feeds_and_no_count_query(self):
+        url = reverse('advertisement-featured')
+        ids, pages = self.collect(url, {'pagination': 'cursor'})
+        self.assertEqual(len(ids), 23)
+        ids, pages = self.collect(
+            reverse('advertisement-by-category-and-city'),
+            {'pagination': 'cursor', 'category_id': self.category.id, 'city_id': self.city.id}
+        )
+        self.assertEqual(len(ids), 45)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('advertisement-by-city'), {'pagination': 'cursor', 'city_id': self.city.id})
+        # Пагинатор по номеру страницы выполняет SELECT COUNT(*) AS "__count"
+        self.assertFalse(any('__count' in query['sql'] for query in queries.captured_queries))
+
+    def test_page_number_mode_is_default(self):
+        response = self.client.get(reverse('advertisement-list'))
+        self.assertEqual(response.data['count'], 45)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('advertisement-list'), {'cursor': 'broken'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class AdvertisementIndexUsageTest(APITestCase):
+    """Запросы лент объявлений используют индексы, а не полный просмотр таблицы"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='indexer', password='testpass123')
+        self.category = Category.objects.create(name='Электроника', slug='electronics')
+        self.city = City.objects.create(name='Москва', slug='moscow')
+        Advertisement.objects.create(
+            title='Телефон', description='Описание', price=100, category=self.category,
+            city=self.city, author=self.user, status='active', is_featured=True,
+        )
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute('EXPLAIN ' + sql)
+            else:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            return '\n'.join(str(row[-1]) for row in cursor.fetchall())
+
+    def assertUsesIndexes(self, url, params=None, sorted_by_index=True):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        plans = [
+            self.explain(query['sql']) for query in queries.captured_queries
+            if 'FROM "ads_advertisement" ' in query['sql']
+        ]
+        self.assertTrue(plans)
+        for plan in plans:
+            if connection.vendor == 'postgresql':
+                self.assertNotIn('Seq Scan on ads_advertisement ', plan, plan)
+            else:
+                self.assertNotRegex(plan, r'SCAN ads_advertisement(?! USING)', plan)
+                if sorted_by_index:
+                    self.assertNotIn('USE TEMP B-TREE FOR ORDER BY', plan, plan)
+        return plans
+
+    def test_list(self):
+        self.assertUsesIndexes(reverse('advertisement-list'))
+        self.assertUsesIndexes(reverse('advertisement-list'), {'pagination': 'cursor'})
+        self.assertUsesIndexes(reverse('advertisement-list'), {'category': self.category.id})
+        self.assertUsesIndexes(reverse('advertisement-list'), {'city_id': self.city.id})
+        # Диапазон по цене с сортировкой по дате требует досортировки найденных строк
+        self.assertUsesIndexes(reverse('advertisement-list'), {'min_price': 10, 'max_price': 500}, sorted_by_index=False)
+        self.assertUsesIndexes(reverse('advertisement-list'), {'pagination': 'cursor', 'ordering': 'price'})
+
+    def test_featured(self):
+        self.assertUsesIndexes(reverse('advertisement-featured'))
+
+    def test_by_city(self):
+        self.assertUsesIndexes(reverse('advertisement-by-city'), {'city_id': self.city.id})
+
+    def test_by_category_and_city(self):
+        self.assertUsesIndexes(
+            reverse('advertisement-by-category-and-city'),
+            {'category_id': self.category.id, 'city_id': self.city.id}
+        )
+
+    def test_my_advertisements(self):
+        self.client.force_authenticate(user=self.user)
+        self.assertUsesIndexes(reverse('advertisement-my-advertisements'))
+
+
+@override_settings(SUGGEST_BUILD_IN_BACKGROUND=False)
+class SearchIndexTest(APITestCase):
+    """Поиск по инвертированному индексу"""
+
+    def setUp(self):
+        suggest.reset()
+        self.addCleanup(suggest.reset)
+        self.user = User.objects.create_user(username='searcher', password='testpass123')
+        self.moscow = City.objects.create(name='Москва', slug='moscow')
+        self.kazan = City.objects.create(name='Казань', slug='kazan')
+        self.transport = Category.objects.create(name='Велосипеды', slug='bikes')
+        self.phones = Category.objects.create(name='Телефоны', slug='phones')
+
+    def create_ad(self, title, description='Описание', **kwargs):
+        data = {
+            'title': title,
+            'description': description,
+            'price': 1000,
+            'category': self.transport,
+            'city': self.moscow,
+            'author': self.user,
+            'status': 'active',
+        }
+        data.update(kwargs)
+        return Advertisement.objects.create(**data)
+
+    def search(self, query, **params):
+        params['q'] = query
+        response = self.client.get(reverse('advertisement-search'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [item['id'] for item in response.data['results']]
+
+    def test_stemmer(self):
+        self.assertEqual(search.stem('велосипеды'), 'велосипед')
+        self.assertEqual(search.stem('квартиру'), search.stem('квартира'))
+        self.assertEqual(search.stem('красивая'), 'красив')
+        self.assertEqual(search.analyze('Продаю новый iPhone и чехол'), ['прода', 'нов', 'iphone', 'чехол'])
+
+    def test_ranking_and_word_forms(self):
+        in_description = self.create_ad('Продам самокат', 'Отдам вместе с велосипедом')
+        in_title = self.create_ad('Горный велосипед', 'Отличное состояние')
+        self.create_ad('Смартфон', 'Почти новый', category=self.phones)
+        self.assertEqual(self.search('велосипеды'), [in_title.id, in_description.id])
+
+    def test_combines_with_filters(self):
+        moscow_ad = self.create_ad('Велосипед детский', price=500)
+        kazan_ad = self.create_ad('Велосипед взрослый', city=self.kazan, price=5000)
+        self.assertEqual(self.search('велосипед', city_id=self.kazan.id), [kazan_ad.id])
+        self.assertEqual(self.search('велосипед', max_price=1000), [moscow_ad.id])
+        self.assertEqual(self.search('велосипед', category=self.phones.id), [])
+        # Все слова запроса должны найтись, включая категорию и город
+        self.assertEqual(self.search('велосипед казань'), [kazan_ad.id])
+
+    def test_prefix_for_last_word(self):
+        ad = self.create_ad('Телефон Samsung', category=self.phones)
+        # Кириллический префикс находит латинское слово через исправление опечаток
+        self.assertEqual(self.search('самс'), [ad.id])
+        self.assertEqual(self.search('тел'), [ad.id])
+        self.assertEqual(self.search('samsung тел'), [ad.id])
+
+    def test_incremental_updates(self):
+        ad = self.create_ad('Велосипед')
+        ad.title = 'Самокат'
+        ad.save()
+        self.assertEqual(self.search('велосипед'), [ad.id])  # осталось название категории
+        self.transport.name = 'Самокаты'
+        self.transport.save()
+        self.assertEqual(self.search('велосипед'), [])
+        self.assertEqual(self.search('самокаты'), [ad.id])
+        ad.delete()
+        self.assertFalse(SearchPosting.objects.exists())
+
+    def test_search_filter_and_rebuild(self):
+        ad = self.create_ad('Велосипед')
+        self.create_ad('Самокат', category=self.phones)
+        SearchPosting.objects.all().delete()
+        call_command('rebuild_search_index', stdout=open(os.devnull, 'w'))
+        response = self.client.get(reverse('advertisement-list'), {'search': 'велосипед'})
+        self.assertEqual([item['id'] for item in response.data['results']], [ad.id])
+
+    def test_only_stopwords(self):
+        self.create_ad('Велосипед')
+        self.assertEqual(self.search('и в на'), [])
+
+    def assertStatsMatchIndex(self):
+        stats = SearchStats.objects.get(pk=search.STATS_ID)
+        lengths = list(SearchDocument.objects.values_list('length', flat=True))
+        self.assertEqual(stats.documents, len(lengths))
+        self.assertAlmostEqual(stats.total_length, sum(lengths))
+
+    def test_corpus_stats_are_incremental(self):
+        ad = self.create_ad('Велосипед', 'Горный, почти новый')
+        self.create_ad('Самокат')
+        self.assertStatsMatchIndex()
+        ad.description = 'Короткое'
+        ad.save()
+        self.assertStatsMatchIndex()
+        ad.delete()
+        self.assertStatsMatchIndex()
+        Advertisement.objects.all().delete()
+        self.assertStatsMatchIndex()
+
+    def test_ranks_only_best_candidates(self):
+        in_description = self.create_ad('Продам самокат', 'Отдам вместе с велосипедом')
+        in_title = self.create_ad('Горный велосипед', 'Отличное состояние')
+        twice = self.create_ad('Велосипед велосипед', 'Велосипед')
+        queryset = Advertisement.objects.all()
+        self.assertEqual(list(search.rank(queryset, 'велосипед')), [twice.id, in_title.id, in_description.id])
+        ranking = search.rank(queryset, 'велосипед', limit=2)
+        self.assertEqual(ranking.ranked, [twice.id, in_title.id])
+        # Объявления за пределами кандидатов не теряются: они идут следом
+        self.assertEqual(len(ranking), 3)
+        self.assertEqual(ranking[2:4], [in_description.id])
+        self.assertEqual(list(ranking), [twice.id, in_title.id, in_description.id])
+
+    @override_settings(SEARCH_MAX_CANDIDATES=5)
+    def test_pages_past_candidates(self):
+        ads = [self.create_ad(f'Велосипед {number}') for number in range(22)]
+        first = self.client.get(reverse('advertisement-search'), {'q': 'велосипед'}).data
+        second = self.client.get(reverse('advertisement-search'), {'q': 'велосипед', 'page': 2}).data
+        self.assertEqual((first['count'], second['count']), (22, 22))
+        found = [item['id'] for item in first['results'] + second['results']]
+        self.assertEqual(sorted(found), sorted(ad.id for ad in ads))
+
+
+@override_settings(SUGGEST_BUILD_IN_BACKGROUND=False)
+class SuggestTest(APITestCase):
+    """Подсказки при вводе и исправление опечаток"""
+
+    def setUp(self):
+        suggest.reset()
+        self.user = User.objects.create_user(username='suggester', password='testpass123')
+        self.moscow = City.objects.create(name='Москва', slug='moscow')
+        self.bikes = Category.objects.create(name='Велосипеды', slug='bikes')
+        self.phones = Category.objects.create(name='Телефоны', slug='phones')
+        self.iphone = self.create_ad('Apple iPhone 13 Pro', self.phones)
+        self.bike = self.create_ad('Горный велосипед Stels', self.bikes)
+
+    def tearDown(self):
+        suggest.reset()
+
+    def create_ad(self, title, category, **kwargs):
+        return Advertisement.objects.create(
+            title=title, description='Описание', price=1000, category=category,
+            city=self.moscow, author=self.user, status='active', **kwargs
+        )
+
+    def suggestions(self, query):
+        response = self.client.get(reverse('advertisement-suggest'), {'q': query})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [(item['type'], item['text']) for item in response.data['suggestions']]
+
+    def test_prefix_completion(self):
+        self.assertIn(('title', 'Горный велосипед Stels'), self.suggestions('горный вел'))
+        self.assertEqual(self.suggestions('моск')[0], ('city', 'Москва'))
+
+    def test_typos_and_transliteration(self):
+        self.assertIn(('title', 'Горный велосипед Stels'), self.suggestions('велосепед '))
+        self.assertIn(('title', 'Apple iPhone 13 Pro'), self.suggestions('айфон '))
+
+    def test_incremental_updates(self):
+        self.suggestions('тел')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.iphone.status = 'sold'
+            self.iphone.save()
+        self.assertNotIn(('title', 'Apple iPhone 13 Pro'), self.suggestions('iphone'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bikes.name = 'Самокаты'
+            self.bikes.save()
+        self.assertIn(('category', 'Самокаты'), self.suggestions('самок'))
+        self.assertNotIn(('category', 'Велосипеды'), self.suggestions('велосипеды'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ad = self.create_ad('Самокат Xiaomi', self.bikes)
+        self.assertIn(('title', 'Самокат Xiaomi'), self.suggestions('xiaomi'))
+        with self.captureOnCommitCallbacks(execute=True):
+            ad.delete()
+        self.assertEqual(self.suggestions('xiaomi'), [])
+
+    def test_rolled_back_change_is_not_indexed(self):
+        self.suggestions('тел')
+        try:
+            with transaction.atomic():
+                self.create_ad('Самокат Xiaomi', self.bikes)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self.suggestions('xiaomi'), [])
+
+    def test_requires_query(self):
+        response = self.client.get(reverse('advertisement-suggest'))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_search_corrects_typos(self):
+        response = self.client.get(reverse('advertisement-search'), {'q': 'велосепед'})
+        self.assertEqual([item['id'] for item in response.data['results']], [self.bike.pk])
+
+        response = self.client.get(reverse('advertisement-search'), {'q': 'айфон', 'ordering': '-price'})
+        self.assertEqual([item['id'] for item in response.data['results']], [self.iphone.pk])
+
+
+@override_settings(
+    VIEW_COUNTER_BACKEND='ads.view_counter.LocalViewBuffer',
+    VIEW_COUNTER_JOURNAL_DIR='',
+    VIEW_COUNTER_FLUSH_INTERVAL=0,
+)
+class ViewCounterTest(APITestCase):
+    """Буферизованный учет просмотров"""
+
+    def setUp(self):
+        view_counter.reset()
+        self.user = User.objects.create_user(username='viewer', password='testpass123')
+        self.city = City.objects.create(name='Москва', slug='moscow')
+        self.category = Category.objects.create(name='Электроника', slug='electronics')
+        self.ads = [
+            Advertisement.objects.create(
+                title=f'Объявление {index}', description='Описание', price=100,
+                category=self.category, city=self.city, author=self.user, status='active'
+            )
+            for index in range(3)
+        ]
+        self.client.force_authenticate(user=self.user)
+
+    def tearDown(self):
+        view_counter.reset()
+
+    def view(self, advertisement):
+        url = reverse('advertisement-increment-views', args=[advertisement.pk])
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['views_count']
+
+    def test_views_are_buffered(self):
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.view(self.ads[0]), 1)
+            self.assertEqual(self.view(self.ads[0]), 2)
+        self.assertFalse([q for q in context.captured_queries if q['sql'].startswith('UPDATE')])
+        self.ads[0].refresh_from_db()
+        self.assertEqual(self.ads[0].views_count, 0)
+
+    def test_flush_groups_updates_by_increment(self):
+        for advertisement in self.ads[:2]:
+            self.view(advertisement)
+            self.view(advertisement)
+        self.view(self.ads[2])
+
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(view_counter.flush(), 3)
+        updates = [q for q in context.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 2)
+
+        views = dict(Advertisement.objects.values_list('id', 'views_count'))
+        self.assertEqual([views[ad.pk] for ad in self.ads], [2, 2, 1])
+        self.assertEqual(view_counter.pending(self.ads[0].pk), 0)
+        self.assertEqual(self.view(self.ads[0]), 3)
+
+    def test_journal_survives_crash(self):
+        with tempfile.TemporaryDirectory() as journal_dir:
+            # Журнал процесса, упавшего до сброса
+            with open(os.path.join(journal_dir, 'views-999999999.log'), 'w') as journal:
+                journal.write(f'{self.ads[0].pk}\n{self.ads[0].pk}\n{self.ads[1].pk}\n{self.ads[1].pk}')
+
+            with override_settings(VIEW_COUNTER_JOURNAL_DIR=journal_dir):
+                view_counter.reset()
+                self.view(self.ads[2])
+                owner = view_counter.get_buffer().journal_owner()
+                self.assertTrue(os.path.exists(os.path.join(journal_dir, f'views-{owner}.log')))
+                call_command('flush_view_counts', stdout=open(os.devnull, 'w'))
+                self.assertEqual(self.journals(journal_dir), [])
+
+        views = dict(Advertisement.objects.values_list('id', 'views_count'))
+        # Недописанная последняя строка упавшего процесса не учитывается
+        self.assertEqual([views[ad.pk] for ad in self.ads], [2, 1, 1])
+
+    def journals(self, journal_dir):
+        # Остается только файл блокировки этого процесса
+        names = os.listdir(journal_dir)
+        self.assertEqual(len([name for name in names if name.endswith('.lock')]), 1)
+        return [name for name in names if not name.endswith('.lock')]
+
+    def write_journal(self, journal_dir, name, *ads):
+        with open(os.path.join(journal_dir, name), 'w') as journal:
+            journal.write(''.join(f'{advertisement.pk}\n' for advertisement in ads))
+
+    def test_recover_ignores_reused_pid(self):
+        with tempfile.TemporaryDirectory() as journal_dir:
+            # pid упавшего процесса теперь занят живым процессом (этим)
+            self.write_journal(journal_dir, f'views-{os.getpid()}-dead.log', self.ads[0])
+            with override_settings(VIEW_COUNTER_JOURNAL_DIR=journal_dir):
+                view_counter.reset()
+                self.assertEqual(view_counter.recover(), 1)
+                self.assertEqual(self.journals(journal_dir), [])
+        self.ads[0].refresh_from_db()
+        self.assertEqual(self.ads[0].views_count, 1)
+
+    def test_recover_resumes_after_crash(self):
+        with tempfile.TemporaryDirectory() as journal_dir:
+            # Процесс забрал журнал упавшего процесса и сам упал до записи в БД
+            self.write_journal(journal_dir, 'views-1-dead.log.2-dead.recovering', self.ads[0], self.ads[0])
+            with override_settings(VIEW_COUNTER_JOURNAL_DIR=journal_dir):
+                view_counter.reset()
+                self.assertEqual(view_counter.recover(), 1)
+                self.assertEqual(self.journals(journal_dir), [])
+        self.ads[0].refresh_from_db()
+        self.assertEqual(self.ads[0].views_count, 2)
+
+    def test_recover_retries_failed_write(self):
+        with tempfile.TemporaryDirectory() as journal_dir:
+            self.write_journal(journal_dir, 'views-1-dead.1.flushing', self.ads[1])
+            with override_settings(VIEW_COUNTER_JOURNAL_DIR=journal_dir):
+                view_counter.reset()
+                with mock.patch.object(view_counter, 'apply_counts', side_effect=DatabaseError('БД недоступна')):
+                    with self.assertRaises(DatabaseError):
+                        view_counter.recover()
+                [claimed] = self.journals(journal_dir)
+                self.assertTrue(claimed.endswith('.recovering'))
+                self.assertEqual(view_counter.recover(), 1)
+                self.assertEqual(self.journals(journal_dir), [])
+        self.ads[1].refresh_from_db()
+        self.assertEqual(self.ads[1].views_count, 1)
+
+
+class SuggestBackgroundBuildTest(TransactionTestCase):
+    """Перестройка индекса подсказок не задерживает запросы"""
+
+    def setUp(self):
+        suggest.reset()
+        self.addCleanup(suggest.reset)
+        user = User.objects.create_user(username='suggester', password='testpass123')
+        category = Category.objects.create(name='Телефоны', slug='phones')
+        Advertisement.objects.create(
+            title='Apple iPhone 13 Pro', description='Описание', price=1000, category=category,
+            author=user, status='active'
+        )
+
+    def wait_for_swap(self, previous):
+        deadline = time.monotonic() + 10
+        while suggest._index is previous or suggest._pending is not None:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        return suggest._index
+
+    def test_stale_index_is_served_while_rebuilding(self):
+        # Первое построение: пока оно идет, подсказок нет, но запрос не ждет
+        self.assertEqual(suggest.get_index().suggest('iphone'), [])
+        index = self.wait_for_swap(None)
+        self.assertEqual(index.suggest('iphone')[0]['text'], 'Apple iPhone 13 Pro')
+
+        index.built_at -= settings.SUGGEST_INDEX_TTL
+        self.assertIs(suggest.get_index(), index)
+        fresh = self.wait_for_swap(index)
+        self.assertIsNot(fresh, index)
+        self.assertIs(suggest.get_index(), fresh)
+
+
+@override_settings(CACHES=MEMORY_CACHES)
+class CategoryResponseCacheTest(APITestCase):
+    """Кеш ответов для списков категорий"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='cached', password='testpass123')
+        self.moscow = City.objects.create(name='Москва', slug='moscow')
+        self.transport = Category.objects.create(name='Транспорт', slug='transport')
+        self.cars = Category.objects.create(name='Автомобили', slug='cars', parent=self.transport)
+        get_tree()
+
+    def get(self, name, **params):
+        response = self.client.get(reverse(name), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response_json(response)
+
+    def test_repeated_requests_are_cached(self):
+        for name, params in [
+            ('category-hierarchy', {}),
+            ('category-parents-only', {}),
+            ('category-subcategories-only', {}),
+            ('category-by-city', {'city_id': self.moscow.id}),
+        ]:
+            first = self.get(name, **params)
+            with self.assertNumQueries(0):
+                self.assertEqual(self.get(name, **params), first)
+
+    def test_key_includes_city_and_auth(self):
+        self.get('category-by-city', city_id=self.moscow.id)
+        with self.assertNumQueries(0):
+            self.get('category-by-city', city_id=self.moscow.id)
+        with CaptureQueriesContext(connection) as context:
+            self.get('category-by-city', city_id='all')
+        self.assertTrue(context.captured_queries)
+
+        self.client.force_authenticate(user=self.user)
+        data = self.get('category-parents-only')
+        self.assertEqual(data[0]['unviewed_count'], 0)
+        self.client.force_authenticate(user=None)
+        with CaptureQueriesContext(connection) as context:
+            self.get('category-parents-only')
+        self.assertTrue(context.captured_queries)
+
+    def test_invalidated_by_changes(self):
+        self.assertEqual(self.get('category-hierarchy')[0]['advertisements_count'], 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            advertisement = Advertisement.objects.create(
+                title='Седан', description='Описание', price=100, category=self.cars,
+                city=self.moscow, author=self.user, status='active'
+            )
+        self.assertEqual(self.get('category-hierarchy')[0]['children'][0]['advertisements_count'], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            advertisement.status = 'sold'
+            advertisement.save()
+        self.assertEqual(self.get('category-hierarchy')[0]['children'][0]['advertisements_count'], 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.transport.name = 'Авто и мото'
+            self.transport.save()
+        self.assertEqual(self.get('category-hierarchy')[0]['name'], 'Авто и мото')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.transport.cities.add(self.moscow)
+        self.assertEqual([city['id'] for city in self.get('category-hierarchy')[0]['cities']], [self.moscow.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.moscow.name = 'Москва и область'
+            self.moscow.save()
+        self.assertIn('Москва и область', self.get('category-hierarchy')[0]['available_cities_display'])
+
+
+class SharedCacheTest(TestCase):
+    """Версии данных должны быть общими для всех процессов"""
+
+    def test_default_cache_is_shared(self):
+        self.assertNotIsInstance(caches['default'], LocMemCache)
+
+    @override_settings(CACHES=MEMORY_CACHES)
+    def test_locmem_is_refused_for_several_workers(self):
+        os.environ['WEB_CONCURRENCY'] = '4'
+        self.addCleanup(os.environ.pop, 'WEB_CONCURRENCY')
+        with self.assertRaises(ImproperlyConfigured):
+            versions.check_shared_cache()
+        os.environ['WEB_CONCURRENCY'] = '1'
+        versions.check_shared_cache()
+
+
+@override_settings(CACHES=MEMORY_CACHES)
+class ConditionalGetTest(APITestCase):
+    """ETag и Last-Modified для списков и карточек"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='etag', password='testpass123')
+        self.city = City.objects.create(name='Москва', slug='moscow')
+        self.category = Category.objects.create(name='Электроника', slug='electronics')
+        self.advertisement = Advertisement.objects.create(
+            title='Ноутбук', description='Описание', price=100, category=self.category,
+            city=self.city, author=self.user, status='active'
+        )
+        get_tree()
+
+    def assertNotModified(self, url, etag, queries=0, **params):
+        with self.assertNumQueries(queries):
+            response = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def etag(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response['ETag']
+
+    def test_lists_short_circuit(self):
+        for name in ['city-list', 'category-list', 'category-hierarchy', 'advertisement-list']:
+            url = reverse(name)
+            etag = self.etag(url)
+            self.assertNotModified(url, etag)
+            # Другие параметры - другой ответ
+            self.assertNotEqual(self.etag(url, ordering='-created_at'), etag)
+
+    def test_city_and_category_changes(self):
+        cities_etag = self.etag(reverse('city-list'))
+        categories_etag = self.etag(reverse('category-list'))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.city.name = 'Москва и область'
+            self.city.save()
+        self.assertNotEqual(self.etag(reverse('city-list')), cities_etag)
+        self.assertNotEqual(self.etag(reverse('category-list')), categories_etag)
+
+    def test_list_changes_with_advertisements(self):
+        url = reverse('advertisement-list')
+        etag = self.etag(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.advertisement.title = 'Ноутбук Lenovo'
+            self.advertisement.save()
+        self.assertNotEqual(self.etag(url), etag)
+
+        etag = self.etag(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            view_counter.apply_counts({self.advertisement.pk: 3})
+        self.assertNotEqual(self.etag(url), etag)
+
+    def test_detail(self):
+        url = reverse('advertisement-detail', args=[self.advertisement.pk])
+        response = self.client.get(url)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        # Один легкий запрос к строке объявления вместо выборки и сериализации
+        self.assertNotModified(url, etag, queries=1)
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        AdvertisementImage.objects.create(advertisement=self.advertisement, image='ads/photo.jpg')
+        image_etag = self.etag(url)
+        self.assertNotEqual(image_etag, etag)
+
+        # Отметка «в избранном» у каждого пользователя своя
+        self.client.force_authenticate(user=self.user)
+        user_etag = self.etag(url)
+        Favorite.objects.create(user=self.user, advertisement=self.advertisement)
+        self.assertNotEqual(self.etag(url), user_etag)
+
+
+class SharedVersionETagTest(APITestCase):
+    """ETag списков учитывает изменения, сделанные в другом процессе"""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_version_bumped_by_other_process(self):
+        url = reverse('advertisement-list')
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+        # Отдельный экземпляр кеша с теми же настройками - как в другом процессе gunicorn
+        other = DatabaseCache(settings.CACHES['default']['LOCATION'], {})
+        other.incr(versions.KEY_PREFIX + versions.ADVERTISEMENTS_NAMESPACE)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class FastSerializerTest(APITestCase):
+    """Быстрое представление совпадает с обычным выводом DRF байт в байт"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='fast', password='testpass123', first_name='Иван', email='fast@example.com'
+        )
+        self.moscow = City.objects.create(name='Москва', slug='moscow')
+        self.kazan = City.objects.create(name='Казань', slug='kazan', is_active=False)
+        self.parent = Category.objects.create(name='Электроника', slug='electronics', icon='📱')
+        self.category = Category.objects.create(name='Телефоны', slug='phones', parent=self.parent)
+        self.category.cities.add(self.moscow, self.kazan)
+        self.with_images = Advertisement.objects.create(
+            title='Телефон', description='Описание', price='99.5', category=self.category,
+            city=self.moscow, author=self.user, status='active', contact_email='a@b.ru'
+        )
+        AdvertisementImage.objects.create(advertisement=self.with_images, image='ads/1.jpg', caption='Фото')
+        AdvertisementImage.objects.create(advertisement=self.with_images, image='ads/2.jpg', is_primary=True)
+        self.without_city = Advertisement.objects.create(
+            title='Ноутбук', description='Описание', price=15000, category=self.parent,
+            city=None, author=self.user, status='active'
+        )
+        Advertisement.objects.filter(pk=self.without_city.pk).update(expires_at=None)
+        Favorite.objects.create(user=self.user, advertisement=self.with_images)
+
+    def render(self, serializer_class, instance, generic, many=False):
+        request = Request(APIRequestFactory().get('/api/advertisements/'))
+        request.user = self.user
+        context = {'request': request}
+        if generic:
+            context[fast_serializers.GENERIC_CONTEXT_KEY] = True
+        return JSONRenderer().render(serializer_class(instance, many=many, context=context).data)
+
+    def assertSameOutput(self, serializer_class, instance, many=False):
+        fast = self.render(serializer_class, instance, generic=False, many=many)
+        self.assertEqual(fast, self.render(serializer_class, instance, generic=True, many=many))
+        return fast
+
+    def test_list(self):
+        self.assertSameOutput(AdvertisementListSerializer, Advertisement.objects.for_listing(), many=True)
+        # Без предзагрузки и аннотаций тоже
+        self.assertSameOutput(AdvertisementListSerializer, Advertisement.objects.all(), many=True)
+
+    def test_detail(self):
+        queryset = Advertisement.objects.for_listing().prefetch_related('images')
+        for advertisement in queryset:
+            self.assertSameOutput(AdvertisementDetailSerializer, advertisement)
+
+    def test_field_selection(self):
+        request = Request(APIRequestFactory().get('/api/advertisements/', {
+            'fields': 'id,price,category.name,category.cities,city,primary_image.image',
+            'expand': 'category.cities',
+        }))
+        selection = field_selection.FieldSelection.from_request(request)
+        queryset = Advertisement.objects.for_listing(selection)
+        outputs = []
+        for generic in (False, True):
+            request.user = self.user
+            context = {'request': request, field_selection.CONTEXT_KEY: selection}
+            if generic:
+                context[fast_serializers.GENERIC_CONTEXT_KEY] = True
+            outputs.append(JSONRenderer().render(AdvertisementListSerializer(queryset, many=True, context=context).data))
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertIn(b'"cities":[{"id":', outputs[0])
+        self.assertNotIn(b'"title"', outputs[0])
+
+    def test_favorites(self):
+        favorites = Favorite.objects.filter(user=self.user).prefetch_related(
+            Prefetch('advertisement', queryset=Advertisement.objects.for_listing())
+        )
+        output = self.assertSameOutput(FavoriteSerializer, favorites, many=True)
+        self.assertIn(b'"price":"99.50"', output)
+
+
+@override_settings(CACHES=MEMORY_CACHES)
+class FastJSONRendererTest(APITestCase):
+    """Быстрый JSON-рендерер и потоковая выдача списков категорий"""
+
+    payload = {
+        'price': Decimal('99.50'),
+        'created_at': datetime(2024, 5, 1, 12, 30, 15, 123456, tzinfo=dt_timezone.utc),
+        'title': 'Телефон «Samsung» 📱\u2028новый',
+        'counts': {1: 2, 3: 4},
+        'items': [None, True, 1.5, 'строка'],
+    }
+
+    def setUp(self):
+        cache.clear()
+        self.moscow = City.objects.create(name='Москва', slug='moscow')
+        for index in range(3):
+            parent = Category.objects.create(name=f'Раздел {index}', slug=f'section-{index}')
+            parent.cities.add(self.moscow)
+            Category.objects.create(name=f'Подраздел {index}', slug=f'subsection-{index}', parent=parent)
+        get_tree()
+
+    def test_same_bytes_as_drf(self):
+        expected = JSONRenderer().render(self.payload)
+        self.assertEqual(FastJSONRenderer().render(self.payload), expected)
+        self.assertIn(b'\\u2028', expected)
+        with override_settings(JSON_RENDERER_BACKEND='stdlib'):
+            self.assertEqual(FastJSONRenderer().render(self.payload), expected)
+
+    def test_stream_matches_full_render(self):
+        items = self.payload['items']
+        self.assertEqual(b''.join(stream_json_list(items, lambda item: item)), JSONRenderer().render(items))
+        self.assertEqual(b''.join(stream_json_list([], lambda item: item)), b'[]')
+
+    def test_category_lists_are_streamed(self):
+        for name, params in [
+            ('category-hierarchy', {}),
+            ('category-subcategories-only', {}),
+            ('category-by-city', {'city_id': self.moscow.id}),
+        ]:
+            response = self.client.get(reverse(name), params)
+            self.assertTrue(response.streaming)
+            self.assertEqual(response['Content-Type'], 'application/json')
+            self.assertEqual(len(response_json(response)), 3)
+            # Из кеша - готовыми байтами
+            with self.assertNumQueries(0):
+                cached = self.client.get(reverse(name), params)
+            self.assertFalse(cached.streaming)
+            self.assertEqual(len(response_json(cached)), 3)
+
+        # Браузерный API по-прежнему получает обычный ответ
+        response = self.client.get(reverse('category-hierarchy'), {'format': 'api'})
+        self.assertFalse(response.streaming)
+        self.assertEqual(len(response.data), 3)
+
+
+@override_settings(TASK_WORKER_THREADS=0)
+class ImageVariantsTest(APITestCase):
+    """Уменьшенные копии фотографий объявлений"""
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.override = override_settings(MEDIA_ROOT=self.media.name)
+        self.override.enable()
+        user = User.objects.create_user(username='photos', password='testpass123')
+        category = Category.objects.create(name='Электроника', slug='electronics')
+        self.advertisement = Advertisement.objects.create(
+            title='Фотоаппарат', description='Описание', price=100, category=category,
+            author=user, status='active'
+        )
+
+    def tearDown(self):
+        self.override.disable()
+        self.media.cleanup()
+
+    def upload(self, size=(3000, 2000), mode='RGB', is_primary=True):
+        buffer = BytesIO()
+        Image.new(mode, size, 'red').save(buffer, 'PNG')
+        image = AdvertisementImage(advertisement=self.advertisement, is_primary=is_primary)
+        with self.captureOnCommitCallbacks(execute=True):
+            image.image.save('photo.png', ContentFile(buffer.getvalue()))
+        # Копии строит обработчик фоновой очереди
+        tasks.run_pending()
+        image.refresh_from_db()
+        return image
+
+    def test_generated_on_upload(self):
+        image = self.upload(mode='RGBA')
+        self.assertTrue(image_variants.is_current(image))
+        self.assertEqual((image.variants['thumbnail']['width'], image.variants['thumbnail']['height']), (240, 240))
+        self.assertEqual((image.variants['card']['width'], image.variants['card']['height']), (640, 480))
+        self.assertEqual((image.variants['full']['width'], image.variants['full']['height']), (1600, 1067))
+        for variant in image_variants.VARIANTS:
+            for key, pillow_format, _ in image_variants.FORMATS:
+                path = os.path.join(self.media.name, image.variants[variant][key])
+                with Image.open(path) as rendered:
+                    self.assertEqual(rendered.format, pillow_format)
+
+        item = self.client.get(reverse('advertisement-list')).data['results'][0]
+        card = item['primary_image']['variants']['card']
+        self.assertTrue(card['webp'].startswith('http://testserver/media/'))
+        self.assertTrue(card['jpeg'].endswith('__card.jpg'))
+        detail = self.client.get(reverse('advertisement-detail', args=[self.advertisement.pk])).data
+        self.assertEqual(detail['images'][0]['variants']['card'], card)
+
+    def test_small_image_is_not_enlarged(self):
+        image = self.upload(size=(800, 600))
+        self.assertEqual((image.variants['full']['width'], image.variants['full']['height']), (800, 600))
+
+    def test_backfill_command(self):
+        with override_settings(IMAGE_VARIANTS_ON_UPLOAD=False):
+            image = self.upload()
+        self.assertEqual(image.variants, {})
+        call_command('generate_image_variants', workers=1, stdout=StringIO())
+        image.refresh_from_db()
+        self.assertTrue(image_variants.is_current(image))
+
+        # Замена файла: строятся новые копии, прежние удаляются вместе с файлом без ссылок
+        old_card = os.path.join(self.media.name, image.variants['card']['webp'])
+        with override_settings(IMAGE_VARIANTS_ON_UPLOAD=False):
+            buffer = BytesIO()
+            Image.new('RGB', (1000, 1000), 'blue').save(buffer, 'JPEG')
+            image.image.save('other.jpg', ContentFile(buffer.getvalue()))
+        self.assertFalse(image_variants.is_current(image))
+        call_command('generate_image_variants', workers=1, stdout=StringIO())
+        image.refresh_from_db()
+        self.assertTrue(image.variants['card']['webp'].endswith('__card.webp'))
+        self.assertEqual(image.variants['source'], image.image.name)
+        self.assertEqual(media_store.collect(grace=0), 1)
+        self.assertFalse(os.path.exists(old_card))
+
+
+@override_settings(TASK_WORKER_THREADS=0)
+class BackgroundTaskTest(APITestCase):
+    """Фоновая очередь задач и обработка загруженных фотографий"""
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.override = override_settings(MEDIA_ROOT=self.media.name)
+        self.override.enable()
+        self.user = User.objects.create_user(username='uploader', password='testpass123')
+        self.category = Category.objects.create(name='Электроника', slug='electronics')
+        self.calls = []
+
+    def tearDown(self):
+        self.override.disable()
+        self.media.cleanup()
+        tasks.HANDLERS.pop('test', None)
+
+    def photo(self, name='photo.jpg'):
+        buffer = BytesIO()
+        Image.new('RGB', (1200, 900), 'green').save(buffer, 'JPEG')
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/jpeg')
+
+    def test_upload_is_processed_in_background(self):
+        self.client.force_authenticate(user=self.user)
+        broken = SimpleUploadedFile('broken.jpg', b'not an image', content_type='image/jpeg')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('advertisement-list'), {
+                'title': 'Телефон', 'description': 'Описание', 'price': 100,
+                'category': self.category.id, 'images': [self.photo(), broken],
+            }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([image['status'] for image in response.data['images']], ['processing', 'processing'])
+        self.assertTrue(all('/staging/' in image['image_url'] for image in response.data['images']))
+        self.assertEqual(BackgroundTask.objects.count(), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(tasks.run_pending(), 2)
+        self.assertFalse(BackgroundTask.objects.exists())
+        photo, failed = AdvertisementImage.objects.order_by('id')
+        self.assertEqual(photo.status, AdvertisementImage.STATUS_READY)
+        self.assertTrue(media_store.is_blob(photo.image.name))
+        self.assertTrue(image_variants.is_current(photo))
+        self.assertEqual(failed.status, AdvertisementImage.STATUS_FAILED)
+        self.assertEqual(default_storage.listdir(image_processing.STAGING_DIR)[1], [])
+
+        Advertisement.objects.filter(pk=response.data['id']).update(status='active')
+        detail = self.client.get(reverse('advertisement-detail', args=[response.data['id']])).data
+        self.assertEqual(detail['images'][0]['status'], 'ready')
+        self.assertIn('card', detail['images'][0]['variants'])
+
+    def test_retry_after_interrupted_placement(self):
+        self.client.force_authenticate(user=self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('advertisement-list'), {
+                'title': 'Телефон', 'description': 'Описание', 'price': 100,
+                'category': self.category.id, 'images': [self.photo()],
+            }, format='multipart')
+        staged = AdvertisementImage.objects.get().image.name
+
+        # Файл уже в хранилище, но сбой случился до записи нового имени в БД
+        with mock.patch.object(media_store, 'acquire', side_effect=OSError('сбой')):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(tasks.run_pending(), 1)
+        image = AdvertisementImage.objects.get()
+        self.assertEqual((image.image.name, image.status), (staged, AdvertisementImage.STATUS_PROCESSING))
+        self.assertTrue(default_storage.exists(staged))
+
+        BackgroundTask.objects.update(run_after=timezone.now())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(tasks.run_pending(), 1)
+        image.refresh_from_db()
+        self.assertEqual(image.status, AdvertisementImage.STATUS_READY)
+        self.assertTrue(default_storage.exists(image.image.name))
+        self.assertFalse(default_storage.exists(staged))
+        self.assertEqual(MediaBlob.objects.get(name=image.image.name).refcount, 1)
+
+        # Повтор уже выполненной задачи ничего не меняет
+        image_processing.process_image({'image_id': image.pk})
+        self.assertEqual(MediaBlob.objects.get(name=image.image.name).refcount, 1)
+
+    def test_upload_validation(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post(reverse('advertisement-list'), {
+            'title': 'Телефон', 'description': 'Описание', 'price': 100, 'category': self.category.id,
+            'images': [SimpleUploadedFile('notes.txt', b'text')],
+        }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        with override_settings(IMAGE_UPLOAD_MAX_SIZE=10):
+            response = self.client.post(reverse('advertisement-list'), {
+                'title': 'Телефон', 'description': 'Описание', 'price': 100, 'category': self.category.id,
+                'images': [self.photo()],
+            }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_claim_is_exclusive(self):
+        first = tasks.enqueue('test', {'n': 1})
+        second = tasks.enqueue('test', {'n': 2})
+        self.assertEqual(tasks.claim('a').pk, first.pk)
+        self.assertEqual(tasks.claim('b').pk, second.pk)
+        self.assertIsNone(tasks.claim('c'))
+        self.assertEqual(BackgroundTask.objects.get(pk=first.pk).locked_by, 'a')
+
+        # Зависшая задача возвращается в очередь
+        BackgroundTask.objects.filter(pk=first.pk).update(locked_at=timezone.now() - timezone.timedelta(hours=1))
+        self.assertEqual(tasks.release_stale(), 1)
+        self.assertEqual(tasks.claim('c').pk, first.pk)
+
+    @override_settings(TASK_MAX_ATTEMPTS=2, TASK_RETRY_DELAY=60)
+    def test_retry_and_failure(self):
+        def handler(payload):
+            self.calls.append(payload)
+            raise IOError('диск недоступен')
+        tasks.register('test', on_failure=lambda payload, error: self.calls.append(str(error)))(handler)
+        task = tasks.enqueue('test', {'n': 1})
+
+        self.assertEqual(tasks.run_pending(), 1)
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), (BackgroundTask.STATUS_PENDING, 1))
+        self.assertGreater(task.run_after, timezone.now())
+        self.assertIn('диск недоступен', task.last_error)
+        # До срока повтора задача не выполняется
+        self.assertEqual(tasks.run_pending(), 0)
+
+        BackgroundTask.objects.filter(pk=task.pk).update(run_after=timezone.now())
+        self.assertEqual(tasks.run_pending(), 1)
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), (BackgroundTask.STATUS_FAILED, 2))
+        self.assertEqual(self.calls, [{'n': 1}, {'n': 1}, 'диск недоступен'])
+
+
+@override_settings(TASK_WORKER_THREADS=0)
+class ChunkedUploadTest(APITestCase):
+    """Загрузка фотографий по частям"""
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.override = override_settings(MEDIA_ROOT=self.media.name)
+        self.override.enable()
+        self.user = User.objects.create_user(username='uploader', password='testpass123')
+        self.category = Category.objects.create(name='Электроника', slug='electronics')
+        buffer = BytesIO()
+        Image.new('RGB', (800, 600), 'blue').save(buffer, 'JPEG')
+        self.content = buffer.getvalue()
+        self.client.force_authenticate(user=self.user)
+
+    def tearDown(self):
+        self.override.disable()
+        self.media.cleanup()
+
+    def put_chunk(self, upload_id, offset, data):
+        return self.client.put(
+            reverse('image-upload-chunk', args=[upload_id]), data,
+            content_type='application/octet-stream', HTTP_UPLOAD_OFFSET=str(offset),
+        )
+
+    def upload(self):
+        response = self.client.post(reverse('image-upload-list'), {'filename': 'photo.jpg', 'size': len(self.content)})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        upload_id = response.data['id']
+        middle = len(self.content) // 2
+        self.assertEqual(self.put_chunk(upload_id, 0, self.content[:middle]).data['offset'], middle)
+        # Повтор уже полученной части: сервер сообщает, с какого места продолжать
+        conflict = self.put_chunk(upload_id, 0, self.content[:middle])
+        self.assertEqual(conflict.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(conflict.data['offset'], middle)
+        self.assertEqual(self.put_chunk(upload_id, middle, self.content[middle:]).status_code, status.HTTP_200_OK)
+        response = self.client.post(reverse('image-upload-finalize', args=[upload_id]))
+        self.assertEqual(response.data['status'], ImageUpload.STATUS_COMPLETE)
+        return upload_id
+
+    def test_upload_and_attach(self):
+        upload_id = self.upload()
+        with open(chunked_upload.part_path(ImageUpload.objects.get(pk=upload_id)), 'rb') as part:
+            self.assertEqual(part.read(), self.content)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('advertisement-list'), {
+                'title': 'Телефон', 'description': 'Описание', 'price': 100,
+                'category': self.category.id, 'uploads': [upload_id],
+            }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data['images']), 1)
+        self.assertTrue(response.data['images'][0]['is_primary'])
+        self.assertFalse(ImageUpload.objects.exists())
+        self.assertEqual(os.listdir(chunked_upload.upload_dir()), [])
+
+        self.assertEqual(tasks.run_pending(), 1)
+        image = AdvertisementImage.objects.get()
+        self.assertEqual(image.status, AdvertisementImage.STATUS_READY)
+        with default_storage.open(image.image.name, 'rb') as file:
+            self.assertEqual(file.read(), self.content)
+
+        # Загрузку нельзя прикрепить повторно
+        response = self.client.post(reverse('advertisement-list'), {
+            'title': 'Телефон', 'description': 'Описание', 'price': 100,
+            'category': self.category.id, 'uploads': [upload_id],
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_concurrent_chunks_with_same_offset(self):
+        upload = chunked_upload.start(self.user, 'photo.jpg', len(self.content))
+        winner = self.content[:100]
+
+        class RacingStream(BytesIO):
+            # Пока часть читается, тот же диапазон успевает записать другой запрос
+            raced = False
+
+            def read(stream, size=-1):
+                if not stream.raced:
+                    stream.raced = True
+                    chunked_upload.write_chunk(ImageUpload.objects.get(pk=upload.pk), 0, BytesIO(winner))
+                return super().read(size)
+
+        with self.assertRaises(chunked_upload.OffsetMismatch) as raised:
+            chunked_upload.write_chunk(upload, 0, RacingStream(b'x' * 200))
+        self.assertEqual(raised.exception.offset, 100)
+        with open(chunked_upload.part_path(upload), 'rb') as part:
+            self.assertEqual(part.read(), winner)
+        self.assertEqual(os.listdir(chunked_upload.upload_dir()), [f'{upload.pk}.part'])
+
+    def test_duplicate_upload_creates_nothing(self):
+        upload_id = self.upload()
+        response = self.client.post(reverse('advertisement-list'), {
+            'title': 'Телефон', 'description': 'Описание', 'price': 100,
+            'category': self.category.id, 'uploads': [upload_id, upload_id],
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Advertisement.objects.exists())
+        self.assertEqual(ImageUpload.objects.get().status, ImageUpload.STATUS_COMPLETE)
+
+    def test_rollback_keeps_upload_and_removes_staged_files(self):
+        upload = ImageUpload.objects.get(pk=self.upload())
+        advertisement = Advertisement.objects.create(
+            title='Телефон', description='Описание', price=100, category=self.category, author=self.user
+        )
+        with self.assertRaises(ValueError):
+            with image_processing.staging_atomic():
+                image_processing.stage(advertisement, SimpleUploadedFile('photo.png', b'png'))
+                chunked_upload.attach(advertisement, upload)
+                raise ValueError
+        self.assertFalse(advertisement.images.exists())
+        self.assertEqual(default_storage.listdir(image_processing.STAGING_DIR), ([], []))
+        # Загрузку можно прикрепить снова
+        self.assertEqual(ImageUpload.objects.get().status, ImageUpload.STATUS_COMPLETE)
+        self.assertTrue(os.path.exists(chunked_upload.part_path(upload)))
+
+    def test_incomplete_and_foreign_uploads(self):
+        response = self.client.post(reverse('image-upload-list'), {'filename': 'photo.jpg', 'size': len(self.content)})
+        upload_id = response.data['id']
+        self.put_chunk(upload_id, 0, self.content[:100])
+        self.assertEqual(self.client.get(reverse('image-upload-detail', args=[upload_id])).data['offset'], 100)
+        self.assertEqual(
+            self.client.post(reverse('image-upload-finalize', args=[upload_id])).status_code,
+            status.HTTP_400_BAD_REQUEST
+        )
+        # Часть длиннее объявленного размера
+        too_long = self.put_chunk(upload_id, 100, self.content[100:] + b'extra')
+        self.assertEqual(too_long.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('advertisement-list'), {
+            'title': 'Телефон', 'description': 'Описание', 'price': 100,
+            'category': self.category.id, 'uploads': [upload_id],
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        other = User.objects.create_user(username='other', password='testpass123')
+        self.client.force_authenticate(user=other)
+        self.assertEqual(
+            self.client.get(reverse('image-upload-detail', args=[upload_id])).status_code,
+            status.HTTP_404_NOT_FOUND
+        )
+        self.assertEqual(
+            self.client.post(reverse('image-upload-list'), {'filename': 'notes.txt', 'size': 10}).status_code,
+            status.HTTP_400_BAD_REQUEST
+        )
+
+
+@override_settings(TASK_WORKER_THREADS=0)
+class MediaStoreTest(APITestCase):
+    """Хранение фотографий по содержимому со счетчиком ссылок"""
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.override = override_settings(MEDIA_ROOT=self.media.name)
+        self.override.enable()
+        self.user = User.objects.create_user(username='seller', password='testpass123')
+        self.category = Category.objects.create(name='Электроника', slug='electronics')
+        buffer = BytesIO()
+        Image.new('RGB', (800, 600), 'yellow').save(buffer, 'JPEG')
+        self.content = buffer.getvalue()
+        self.client.force_authenticate(user=self.user)
+
+    def tearDown(self):
+        self.override.disable()
+        self.media.cleanup()
+
+    def photo(self):
+        return SimpleUploadedFile('photo.jpg', self.content, content_type='image/jpeg')
+
+    def post_ad(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('advertisement-list'), {
+                'title': 'Телефон', 'description': 'Описание', 'price': 100,
+                'category': self.category.id, 'status': 'active', 'images': [self.photo()],
+            }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        with self.captureOnCommitCallbacks(execute=True):
+            tasks.run_pending()
+        return response.data['id']
+
+    def test_identical_uploads_share_file(self):
+        first_id = self.post_ad()
+        second_id = self.post_ad()
+        first, second = AdvertisementImage.objects.order_by('id')
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertEqual(second.status, AdvertisementImage.STATUS_READY)
+        self.assertEqual(second.variants, first.variants)
+        blob = MediaBlob.objects.get()
+        self.assertEqual(blob.refcount, 2)
+
+        # Повторная отправка той же фотографии при редактировании: без записи на диск и без обработки
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(reverse('advertisement-detail', args=[second_id]), {
+                'title': 'Телефон', 'description': 'Описание', 'price': 150,
+                'category': self.category.id, 'status': 'active', 'images': [self.photo()],
+            }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(BackgroundTask.objects.exists())
+        self.assertEqual(default_storage.listdir(image_processing.STAGING_DIR)[1], [])
+        self.assertEqual(AdvertisementImage.objects.get(advertisement_id=second_id).image.name, blob.name)
+        blob.refresh_from_db()
+        self.assertEqual(blob.refcount, 2)
+
+        # Файл удаляется только после того, как на него не осталось ссылок
+        Advertisement.objects.get(pk=first_id).delete()
+        self.assertEqual(media_store.collect(grace=0), 0)
+        Advertisement.objects.get(pk=second_id).delete()
+        blob.refresh_from_db()
+        self.assertEqual(blob.refcount, 0)
+        card = first.variants['card']['webp']
+        self.assertEqual(media_store.collect(grace=0), 1)
+        self.assertFalse(default_storage.exists(blob.name))
+        self.assertFalse(default_storage.exists(card))
+        self.assertFalse(MediaBlob.objects.exists())
+
+    def test_recount(self):
+        self.post_ad()
+        MediaBlob.objects.update(refcount=0)
+        # Файл с изображениями не удаляется даже при неверном счетчике
+        self.assertEqual(media_store.collect(grace=0), 0)
+        call_command('gc_media', recount=True, grace=0, stdout=StringIO())
+        self.assertEqual(MediaBlob.objects.get().refcount, 1)
+
+
+@override_settings(TASK_WORKER_THREADS=0)
+class ImageOperationsTest(APITestCase):
+    """Обновление изображений объявления изменениями, без полной замены"""
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.override = override_settings(MEDIA_ROOT=self.media.name)
+        self.override.enable()
+        self.user = User.objects.create_user(username='seller', password='testpass123')
+        category = Category.objects.create(name='Электроника', slug='electronics')
+        self.advertisement = Advertisement.objects.create(
+            title='Телефон', description='Описание', price=100, category=category,
+            author=self.user, status='active'
+        )
+        self.images = [
+            AdvertisementImage.objects.create(
+                advertisement=self.advertisement, image=f'advertisements/{name}.jpg',
+                is_primary=index == 0, position=index
+            )
+            for index, name in enumerate('abc')
+        ]
+        self.client.force_authenticate(user=self.user)
+
+    def tearDown(self):
+        self.override.disable()
+        self.media.cleanup()
+
+    def patch(self, data, format='json'):
+        return self.client.patch(reverse('advertisement-detail', args=[self.advertisement.pk]), data, format=format)
+
+    def test_remove_reorder_and_primary(self):
+        first, second, third = self.images
+        with CaptureQueriesContext(connection) as queries:
+            response = self.patch({'image_operations': {
+                'remove': [second.pk], 'order': [third.pk, first.pk], 'primary': third.pk,
+            }})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([image['id'] for image in response.data['images']], [third.pk, first.pk])
+        self.assertTrue(response.data['images'][0]['is_primary'])
+        self.assertEqual(list(self.advertisement.images.values_list('id', 'position')), [(third.pk, 0), (first.pk, 1)])
+        # Оставшиеся изображения не пересоздаются, порядок и главное меняются одним запросом
+        self.assertEqual(AdvertisementImage.objects.filter(pk=first.pk).count(), 1)
+        updates = [query['sql'] for query in queries.captured_queries
+                   if query['sql'].startswith('UPDATE "ads_advertisementimage"')]
+        self.assertEqual(len(updates), 1)
+
+    def test_remove_is_one_bulk_change(self):
+        blob = MediaBlob.objects.create(name='blobs/aa/bb/photo.jpg', digest='a' * 64, size=1)
+        shared = [
+            AdvertisementImage.objects.create(advertisement=self.advertisement, image=blob.name, position=3 + index)
+            for index in range(2)
+        ]
+        blob.refresh_from_db()
+        self.assertEqual(blob.refcount, 2)
+        first, second, third = self.images
+        with CaptureQueriesContext(connection) as queries:
+            response = self.patch({'image_operations': {
+                'remove': [second.pk, shared[0].pk, shared[1].pk], 'order': [third.pk, first.pk],
+            }})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(self.advertisement.images.order_by('position').values_list('id', flat=True)), [third.pk, first.pk])
+        blob.refresh_from_db()
+        self.assertEqual(blob.refcount, 0)
+        sql = [query['sql'] for query in queries.captured_queries]
+        # Ссылки на файлы - одним UPDATE, объявление обновляется один раз и не переиндексируется
+        self.assertEqual(len([query for query in sql if query.startswith('UPDATE "ads_mediablob"')]), 1)
+        self.assertEqual(len([query for query in sql if query.startswith('UPDATE "ads_advertisement"')]), 1)
+        self.assertFalse([query for query in sql if 'ads_searchposting' in query])
+
+    def test_add_keeps_existing_images(self):
+        first, second, third = self.images
+        buffer = BytesIO()
+        Image.new('RGB', (400, 300), 'green').save(buffer, 'JPEG')
+        photo = SimpleUploadedFile('new.jpg', buffer.getvalue(), content_type='image/jpeg')
+        response = self.patch({
+            'images': [photo], 'image_operations': json.dumps({'remove': [first.pk]}),
+        }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        ids = [image['id'] for image in response.data['images']]
+        self.assertEqual(ids[:2], [second.pk, third.pk])
+        self.assertEqual(len(ids), 3)
+        # Главное изображение удалили: главным становится первое по порядку
+        self.assertTrue(response.data['images'][0]['is_primary'])
+
+    def test_invalid_operations(self):
+        other = Advertisement.objects.create(
+            title='Другое', description='Описание', price=1, category=self.advertisement.category, author=self.user
+        )
+        foreign = AdvertisementImage.objects.create(advertisement=other, image='advertisements/x.jpg')
+        response = self.patch({'image_operations': {'remove': [foreign.pk]}})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.patch({'image_operations': {'remove': [self.images[0].pk], 'primary': self.images[0].pk}})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.advertisement.images.count(), 3)
+
+
+class BulkAdvertisementTest(APITestCase):
+    """Пакетное создание и обновление объявлений"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='dealer', password='testpass123')
+        self.category = Category.objects.create(name='Автомобили', slug='cars')
+        self.city = City.objects.create(name='Москва', slug='moscow')
+        self.client.force_authenticate(user=self.user)
+
+    def item(self, number, **extra):
+        return {
+            'title': f'Автомобиль {number}', 'description': 'Описание', 'price': 1000 + number,
+            'category': self.category.id, 'city': self.city.id, 'status': 'active', **extra
+        }
+
+    def test_create_with_partial_failure(self):
+        items = [self.item(1), self.item(2, category=999), {'title': 'Без цены'}, 'строка', self.item(3)]
+        response = self.client.post(reverse('advertisement-bulk') + '?batch_size=2', items, format='json')
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual((response.data['created'], response.data['failed']), (2, 3))
+        self.assertEqual(
+            [result['status'] for result in response.data['results']],
+            ['created', 'error', 'error', 'error', 'created']
+        )
+        self.assertIn('category', response.data['results'][1]['errors'])
+        ads = Advertisement.objects.filter(author=self.user)
+        self.assertEqual(ads.count(), 2)
+        self.assertTrue(all(ad.expires_at for ad in ads))
+        # bulk_create не вызывает сигналы: счетчики и поиск обновляются пачкой
+        self.assertEqual(counters.category_count(self.category.id, self.city.id), 2)
+        self.assertTrue(SearchPosting.objects.filter(advertisement__in=ads, term=search.normalize('автомобиль')).exists())
+
+    def test_query_count_does_not_grow_with_items(self):
+        def queries_for(count):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(
+                    reverse('advertisement-bulk'), [self.item(number) for number in range(count)], format='json'
+                )
+            self.assertEqual(response.data['created'], count)
+            return len(queries)
+        # Первый запрос создает строку счетчика
+        queries_for(1)
+        self.assertEqual(queries_for(5), queries_for(40))
+
+    def test_update_and_ndjson(self):
+        own = Advertisement.objects.create(
+            title='Старое', description='Описание', price=10, category=self.category, author=self.user, status='pending'
+        )
+        other_user = User.objects.create_user(username='other', password='testpass123')
+        foreign = Advertisement.objects.create(
+            title='Чужое', description='Описание', price=10, category=self.category, author=other_user
+        )
+        lines = [
+            json.dumps({'id': own.pk, 'title': 'Новое', 'status': 'active'}, ensure_ascii=False),
+            json.dumps({'id': foreign.pk, 'title': 'Взлом'}, ensure_ascii=False),
+            '{не json',
+            json.dumps(self.item(1), ensure_ascii=False),
+        ]
+        response = self.client.post(
+            reverse('advertisement-bulk'), '\n'.join(lines).encode(), content_type='application/x-ndjson'
+        )
+        self.assertEqual(
+            [result['status'] for result in response.data['results']], ['updated', 'error', 'error', 'created']
+        )
+        own.refresh_from_db()
+        self.assertEqual((own.title, own.status), ('Новое', 'active'))
+        foreign.refresh_from_db()
+        self.assertEqual(foreign.title, 'Чужое')
+        self.assertEqual(counters.category_count(self.category.id), 2)
+
+    def test_duplicate_id_in_batch_is_item_error(self):
+        own = Advertisement.objects.create(
+            title='Старое', description='Описание', price=10, category=self.category, city=self.city,
+            author=self.user, status='active'
+        )
+        items = [{'id': own.pk, 'title': 'Первое'}, {'id': own.pk, 'title': 'Второе'}, self.item(1)]
+        response = self.client.post(reverse('advertisement-bulk'), items, format='json')
+        self.assertEqual(
+            [result['status'] for result in response.data['results']], ['updated', 'error', 'created']
+        )
+        own.refresh_from_db()
+        self.assertEqual(own.title, 'Первое')
+        self.assertEqual(counters.category_count(self.category.id, self.city.id), 2)
+
+    def test_body_must_be_list(self):
+        for body in (5, None, 'строка', {'title': 'Объект'}):
+            response = self.client.post(
+                reverse('advertisement-bulk'), json.dumps(body), content_type='application/json'
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class CatalogExportImportTest(TestCase):
+    """Выгрузка и загрузка каталога командами export_ads и import_ads"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='seller', password='testpass123')
+        self.city = City.objects.create(name='Москва', slug='moscow')
+        self.parent = Category.objects.create(name='Транспорт', slug='transport')
+        self.category = Category.objects.create(name='Автомобили', slug='cars', parent=self.parent)
+        self.category.cities.add(self.city)
+        self.ad = Advertisement.objects.create(
+            title='Продам автомобиль', description='Описание', price=Decimal('1500.50'), category=self.category,
+            city=self.city, author=self.user, status='active', views_count=7
+        )
+        self.draft = Advertisement.objects.create(
+            title='Черновик', description='Описание', price=10, category=self.parent, author=self.user
+        )
+        self.image = AdvertisementImage.objects.create(
+            advertisement=self.ad, image='blobs/aa/bb/photo.jpg', caption='Вид спереди', is_primary=True,
+            variants={'webp': {'400': 'variants/photo_400.webp'}}
+        )
+
+    def snapshot(self):
+        return {
+            'cities': list(City.objects.values_list('slug', 'name', 'is_active', 'created_at')),
+            'categories': sorted(
+                (category.slug, category.parent.slug if category.parent else None, category.depth,
+                 sorted(category.cities.values_list('slug', flat=True)))
+                for category in Category.objects.all()
+            ),
+            'ads': list(Advertisement.objects.order_by('pk').values_list(
+                'id', 'title', 'price', 'category__slug', 'city__slug', 'author__username', 'status',
+                'views_count', 'created_at', 'updated_at', 'expires_at'
+            )),
+            'images': list(AdvertisementImage.objects.values_list(
+                'id', 'advertisement_id', 'image', 'caption', 'is_primary', 'variants', 'created_at'
+            )),
+        }
+
+    def roundtrip(self, fmt, path):
+        before = self.snapshot()
+        call_command('export_ads', output=path, format=fmt, stdout=StringIO())
+        Advertisement.objects.all().delete()
+        Category.objects.all().delete()
+        City.objects.all().delete()
+        User.objects.all().delete()
+
+        call_command('import_ads', path, format=fmt, batch_size=1, stdout=StringIO())
+        self.assertEqual(self.snapshot(), before)
+        self.assertFalse(User.objects.get(username='seller').has_usable_password())
+        # Производные данные пересобраны после загрузки
+        category = Category.objects.get(slug='cars')
+        self.assertEqual(counters.category_count(category.id, City.objects.get(slug='moscow').id), 1)
+        self.assertTrue(SearchPosting.objects.filter(term=search.normalize('автомобиль')).exists())
+
+        # Повторная загрузка обновляет те же строки
+        call_command('import_ads', path, format=fmt, stdout=StringIO())
+        self.assertEqual(self.snapshot(), before)
+
+    def test_ndjson_roundtrip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'catalog.ndjson')
+            self.roundtrip('ndjson', path)
+            with open(path, 'rb') as file:
+                kinds = [json.loads(line)['type'] for line in file]
+        self.assertEqual(kinds, ['city', 'category', 'category', 'advertisement', 'advertisement', 'image'])
+
+    def test_bad_rows_are_skipped_and_only_imported_ads_are_indexed(self):
+        records = [
+            {'type': 'advertisement', 'id': 100, 'title': 'Автомобиль новый', 'description': 'Описание',
+             'price': '200', 'category': 'cars', 'author': 'seller'},
+            {'type': 'advertisement', 'id': 101, 'title': 'Автомобиль битый', 'description': 'Описание',
+             'price': 'дорого', 'category': 'cars', 'author': 'seller'},
+            {'type': 'advertisement', 'id': 102, 'title': None, 'description': 'Описание',
+             'price': '300', 'category': 'cars', 'author': 'seller'},
+        ]
+        # Индекс остальных объявлений загрузка не пересобирает
+        SearchPosting.objects.filter(advertisement=self.ad).delete()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'catalog.ndjson')
+            with open(path, 'w', encoding='utf-8') as file:
+                file.writelines(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+            output = StringIO()
+            errors = StringIO()
+            call_command('import_ads', path, stdout=output, stderr=errors)
+        self.assertIn('Пропущено записей без категории, автора или объявления и с неверными значениями: 2', output.getvalue())
+        self.assertIn('advertisement 101: неверное число', errors.getvalue())
+        self.assertIn('advertisement 102: не заполнены обязательные поля: title', errors.getvalue())
+        self.assertEqual(Advertisement.objects.get(pk=100).price, Decimal('200'))
+        self.assertFalse(Advertisement.objects.filter(pk__in=[101, 102]).exists())
+        self.assertTrue(SearchPosting.objects.filter(advertisement_id=100).exists())
+        self.assertFalse(SearchPosting.objects.filter(advertisement=self.ad).exists())
+
+    def test_csv_roundtrip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.roundtrip('csv', directory)
+            self.assertEqual(
+                sorted(os.listdir(directory)), ['advertisements.csv', 'categories.csv', 'cities.csv', 'images.csv']
+            )
+
+
+@override_settings(TASK_WORKER_THREADS=0)
+class ExpirationTest(TestCase):
+    """Снятие объявлений с истекшим сроком"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='seller', password='testpass123')
+        self.category = Category.objects.create(name='Автомобили', slug='cars')
+        self.city = City.objects.create(name='Москва', slug='moscow')
+        past = timezone.now() - timezone.timedelta(days=1)
+        self.expired = [self.create(f'Истекшее {number}', expires_at=past) for number in range(3)]
+        self.current = self.create('Действующее')
+        self.pending = self.create('На модерации', status='pending', expires_at=past)
+
+    def create(self, title, status='active', expires_at=None):
+        advertisement = Advertisement.objects.create(
+            title=title, description='Описание', price=100, category=self.category, city=self.city,
+            author=self.user, status=status
+        )
+        if expires_at:
+            Advertisement.objects.filter(pk=advertisement.pk).update(expires_at=expires_at)
+        return advertisement
+
+    def test_sweep_in_batches(self):
+        self.assertEqual(counters.category_count(self.category.id, self.city.id), 4)
+        self.assertEqual(expiration.sweep(batch_size=2), 3)
+        statuses = dict(Advertisement.objects.values_list('title', 'status'))
+        self.assertEqual(statuses['Истекшее 0'], 'inactive')
+        self.assertEqual(statuses['Действующее'], 'active')
+        self.assertEqual(statuses['На модерации'], 'pending')
+        self.assertEqual(counters.category_count(self.category.id, self.city.id), 1)
+        # Повторный обход (или обход на другом узле) ничего не меняет
+        self.assertEqual(expiration.sweep(), 0)
+        self.assertEqual(counters.category_count(self.category.id, self.city.id), 1)
+
+    def test_reactivation_renews_term(self):
+        expiration.sweep()
+        first, second = (Advertisement.objects.get(pk=ad.pk) for ad in self.expired[:2])
+        first.status = 'active'
+        first.save()
+        second.status = 'active'
+        second.save(update_fields=['status'])
+        renewed = timezone.now() + timezone.timedelta(days=29)
+        for advertisement in (first, second):
+            advertisement.refresh_from_db()
+            self.assertGreater(advertisement.expires_at, renewed)
+        # Следующий обход не снимает их снова
+        self.assertEqual(expiration.sweep(), 0)
+        self.assertEqual(counters.category_count(self.category.id, self.city.id), 3)
+
+    def test_reactivation_response_shows_new_term(self):
+        expiration.sweep()
+        self.client.force_login(self.user)
+        response = self.client.patch(
+            reverse('advertisement-detail', args=[self.expired[0].pk]) + '?status=inactive',
+            {'status': 'active'}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.expired[0].refresh_from_db()
+        self.assertEqual(response.json()['expires_at'], self.expired[0].expires_at.isoformat())
+        self.assertFalse(response.json()['is_expired'])
+
+    def test_limit(self):
+        self.assertEqual(expiration.sweep(batch_size=10, limit=2), 2)
+        self.assertEqual(Advertisement.objects.filter(status='active').count(), 2)
+
+    def test_scheduled_task_reschedules_itself(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertIsNotNone(expiration.schedule())
+            # Вторая задача не ставится
+            self.assertIsNone(expiration.schedule())
+        tasks.run_pending()
+        self.assertEqual(Advertisement.objects.filter(status='inactive').count(), 3)
+        queued = BackgroundTask.objects.get(kind=expiration.EXPIRE_ADVERTISEMENTS)
+        self.assertEqual(queued.status, BackgroundTask.STATUS_PENDING)
+        self.assertGreater(queued.run_after, timezone.now())
+
+
+@override_settings(SMS_RETRY_BACKOFF=0, SMS_READ_TIMEOUT=1, SMS_GATEWAY_LOGIN='test', SMS_GATEWAY_PASSWORD='test')
+class SMSTransportTest(TestCase):
+    """Транспорт SMS-шлюза на локальном поддельном шлюзе"""
+
+    def setUp(self):
+        self.gateway = FakeSMSGateway().start()
+        self.addCleanup(self.gateway.stop)
+
+    def transport(self, **kwargs):
+        transport = sms_transport.SMSTransport(url=self.gateway.url, **kwargs)
+        self.addCleanup(transport.close)
+        return transport
+
+    def test_connection_is_reused(self):
+        transport = self.transport()
+        for number in range(3):
+            self.assertIn('id', transport.send('79991234567', f'Сообщение {number}'))
+        self.assertEqual(len(self.gateway.requests), 3)
+        self.assertEqual(len(self.gateway.clients), 1)
+        self.assertEqual(self.gateway.requests[0]['mes'], 'Сообщение 0')
+
+    def test_retries_temporary_errors(self):
+        self.gateway.fail(2)
+        self.assertIn('id', self.transport(retries=2).send('79991234567', 'Код'))
+        self.assertEqual(len(self.gateway.requests), 3)
+
+    @override_settings(SMS_READ_TIMEOUT=0.2)
+    def test_accepted_request_is_not_retried(self):
+        # Шлюз мог принять запрос: повтор отправил бы SMS второй раз
+        self.gateway.respond(delay=0.5)
+        self.gateway.respond(502)
+        transport = self.transport(retries=2)
+        for _ in range(2):
+            with self.assertRaises(sms_transport.UncertainError):
+                transport.send('79991234567', 'Код')
+        self.assertEqual(len(self.gateway.requests), 2)
+
+    def test_connection_error_is_retried(self):
+        transport = self.transport(retries=1)
+        transport.url = 'http://127.0.0.1:9/sys/send.php'
+        with self.assertRaises(sms_transport.RetryableError):
+            transport.send('79991234567', 'Код')
+
+    @override_settings(SMS_SEND_TIMEOUT=2)
+    def test_retries_fit_send_timeout(self):
+        self.gateway.fail(3)
+        with self.assertRaises(sms_transport.RetryableError):
+            self.transport(retries=3).send('79991234567', 'Код')
+        # Повтор с таймаутами (3 + 1 с) не укладывается в 2 с
+        self.assertEqual(len(self.gateway.requests), 1)
+
+    @override_settings(SMS_GATEWAY_LOGIN='', SMS_GATEWAY_PASSWORD='')
+    def test_credentials_are_required(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.transport().send('79991234567', 'Код')
+        self.assertEqual(self.gateway.requests, [])
+
+    def test_gateway_error_is_not_retried(self):
+        self.gateway.respond(200, {'error': 'invalid number', 'error_code': 7})
+        transport = self.transport(retries=3)
+        with self.assertRaisesMessage(sms_transport.SMSTransportError, 'invalid number'):
+            transport.send('79991234567', 'Код')
+        self.assertEqual(len(self.gateway.requests), 1)
+        self.assertEqual(transport.breaker.state, sms_transport.CircuitBreaker.CLOSED)
+
+    def test_circuit_breaker(self):
+        now = [0.0]
+        breaker = sms_transport.CircuitBreaker(threshold=2, reset_timeout=30, clock=lambda: now[0])
+        transport = self.transport(retries=0, breaker=breaker)
+        self.gateway.fail(3)
+        for _ in range(2):
+            with self.assertRaises(sms_transport.RetryableError):
+                transport.send('79991234567', 'Код')
+        # Шлюз недоступен: отказ сразу, без запроса
+        with self.assertRaises(sms_transport.CircuitOpen):
+            transport.send('79991234567', 'Код')
+        self.assertEqual(len(self.gateway.requests), 2)
+
+        # Пробный запрос после паузы; неудача снова размыкает предохранитель
+        now[0] = 31
+        with self.assertRaises(sms_transport.RetryableError):
+            transport.send('79991234567', 'Код')
+        self.assertEqual(breaker.state, sms_transport.CircuitBreaker.OPEN)
+        now[0] = 62
+        self.assertIn('id', transport.send('79991234567', 'Код'))
+        self.assertEqual(breaker.state, sms_transport.CircuitBreaker.CLOSED)
+
+    def test_async_transport(self):
+        self.gateway.fail(1)
+
+        async def send():
+            transport = sms_transport.AsyncSMSTransport(url=self.gateway.url, retries=1)
+            try:
+                return await transport.send('79991234567', 'Код')
+            finally:
+                await transport.aclose()
+
+        self.assertIn('id', asyncio.run(send()))
+        self.assertEqual(len(self.gateway.requests), 2)
+
+    def test_service_sends_through_transport(self):
+        service = SMSService(transport=self.transport(retries=0))
+        self.assertIn('id', service.send_sms('79991234567', 'Код'))
+        self.assertEqual(self.gateway.requests[0]['phones'], '79991234567')
+        self.gateway.respond(500)
+        self.assertIn('error', service.send_sms('79991234567', 'Код'))
+
+
+@override_settings(TASK_WORKER_THREADS=0, SMS_RETRY_BACKOFF=0, SMS_GATEWAY_LOGIN='test', SMS_GATEWAY_PASSWORD='test')
+class SMSOutboxTest(APITestCase):
+    """Отправка SMS через outbox и фоновый диспетчер"""
+
+    def setUp(self):
+        self.gateway = FakeSMSGateway().start()
+        self.addCleanup(self.gateway.stop)
+        self.transport = sms_transport.SMSTransport(url=self.gateway.url, retries=0)
+        self.addCleanup(self.transport.close)
+
+    def test_send_code_returns_before_gateway_call(self):
+        with override_settings(SMS_GATEWAY_URL=self.gateway.url):
+            sms_transport.reset_transport()
+            self.addCleanup(sms_transport.reset_transport)
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(reverse('auth-send-sms-code'), {'phone': '79991234567'}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(self.gateway.requests, [])
+            outgoing = SMSOutbox.objects.get(pk=response.data['sms_id'])
+            self.assertEqual(outgoing.status, SMSOutbox.STATUS_PENDING)
+            verification = SMSVerification.objects.get(phone='79991234567')
+            self.assertIn(verification.code, outgoing.message)
+            self.assertEqual(outgoing.expires_at, verification.expires_at)
+
+            tasks.run_pending()
+        self.assertEqual(len(self.gateway.requests), 1)
+        response = self.client.get(
+            reverse('auth-sms-status'), {'phone': '79991234567', 'sms_id': outgoing.pk}
+        )
+        self.assertEqual(response.data['status'], SMSOutbox.STATUS_SENT)
+        response = self.client.get(reverse('auth-sms-status'), {'phone': '79990000000', 'sms_id': outgoing.pk})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_rolled_back_code_is_not_sent(self):
+        try:
+            with transaction.atomic():
+                sms_outbox.enqueue('79991234567', 'Код 1234')
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertFalse(SMSOutbox.objects.exists())
+        self.assertEqual(sms_outbox.dispatch(transport=self.transport), 0)
+
+    def test_batch_is_sent_in_one_request(self):
+        self.gateway.rejected.add('79990000002')
+        for number in range(3):
+            sms_outbox.enqueue(f'7999000000{number}', f'Код {number}')
+        self.assertEqual(sms_outbox.dispatch(batch_size=10, transport=self.transport), 2)
+        self.assertEqual(len(self.gateway.requests), 1)
+        self.assertEqual(
+            self.gateway.requests[0]['list'].splitlines(),
+            ['79990000000:Код 0', '79990000001:Код 1', '79990000002:Код 2']
+        )
+        statuses = dict(SMSOutbox.objects.values_list('phone', 'status'))
+        self.assertEqual(statuses, {
+            '79990000000': SMSOutbox.STATUS_SENT, '79990000001': SMSOutbox.STATUS_SENT,
+            '79990000002': SMSOutbox.STATUS_FAILED,
+        })
+        self.assertTrue(SMSOutbox.objects.get(phone='79990000000').gateway_id)
+
+    @override_settings(SMS_OUTBOX_MAX_ATTEMPTS=2)
+    def test_gateway_outage_is_retried_later(self):
+        outgoing = sms_outbox.enqueue('79991234567', 'Код 1234')
+        # Диспетчер работает внутри задачи, которую уже забрали из очереди
+        BackgroundTask.objects.filter(kind=sms_outbox.DISPATCH_SMS).delete()
+        self.gateway.fail(2)
+        self.assertEqual(sms_outbox.dispatch(transport=self.transport), 0)
+        outgoing.refresh_from_db()
+        self.assertEqual((outgoing.status, outgoing.attempts), (SMSOutbox.STATUS_PENDING, 1))
+        self.assertGreater(outgoing.run_after, timezone.now())
+        # Диспетчер запланирован к моменту повтора
+        self.assertTrue(BackgroundTask.objects.filter(
+            kind=sms_outbox.DISPATCH_SMS, run_after__gte=outgoing.run_after
+        ).exists())
+
+        SMSOutbox.objects.filter(pk=outgoing.pk).update(run_after=timezone.now())
+        sms_outbox.dispatch(transport=self.transport)
+        outgoing.refresh_from_db()
+        self.assertEqual(outgoing.status, SMSOutbox.STATUS_FAILED)
+        self.assertIn('503', outgoing.last_error)
+
+    def test_open_circuit_postpones_without_spending_attempts(self):
+        for number in range(3):
+            sms_outbox.enqueue(f'7999000000{number}', f'Код {number}')
+        BackgroundTask.objects.filter(kind=sms_outbox.DISPATCH_SMS).delete()
+        self.transport.breaker = sms_transport.CircuitBreaker(threshold=1, reset_timeout=60)
+        self.transport.breaker.record_failure()
+        self.assertEqual(sms_outbox.dispatch(batch_size=2, transport=self.transport), 0)
+        self.assertEqual(self.gateway.requests, [])
+        for outgoing in SMSOutbox.objects.all():
+            self.assertEqual((outgoing.status, outgoing.attempts), (SMSOutbox.STATUS_PENDING, 0))
+        # Первая пачка отложена до пробного вызова, вторая не забиралась
+        self.assertEqual(SMSOutbox.objects.filter(run_after__gt=timezone.now()).count(), 2)
+        self.assertTrue(BackgroundTask.objects.filter(kind=sms_outbox.DISPATCH_SMS).exists())
+
+    def test_expired_code_is_not_sent(self):
+        stale = sms_outbox.enqueue('79990000000', 'Код 0', expires_at=timezone.now() - timezone.timedelta(seconds=1))
+        fresh = sms_outbox.enqueue('79990000001', 'Код 1', expires_at=timezone.now() + timezone.timedelta(minutes=5))
+        self.assertEqual(sms_outbox.dispatch(transport=self.transport), 1)
+        self.assertEqual([request['phones'] for request in self.gateway.requests], ['79990000001'])
+        stale.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertEqual(stale.status, SMSOutbox.STATUS_FAILED)
+        self.assertEqual(fresh.status, SMSOutbox.STATUS_SENT)
+
+
+SMS_TEST_LIMITS = {
+    'sms_send_phone': '2/m', 'sms_send_ip': '3/m', 'sms_send_global': '100/m',
+    'sms_verify_phone': '2/m', 'sms_verify_ip': '100/m',
+}
+
+
+@override_settings(RATE_LIMITS=SMS_TEST_LIMITS, TASK_WORKER_THREADS=0)
+class RateLimitTest(APITestCase):
+    """Ограничение частоты SMS-запросов корзинами токенов"""
+
+    def setUp(self):
+        rate_limit.reset()
+        self.addCleanup(rate_limit.reset)
+
+    def send(self, phone):
+        return self.client.post(reverse('auth-send-sms-code'), {'phone': phone}, format='json')
+
+    def test_parse_rate(self):
+        self.assertEqual(rate_limit.parse_rate('5/10m'), (5, 5 / 600))
+        self.assertEqual(rate_limit.parse_rate('10/h'), (10, 10 / 3600))
+        with self.assertRaises(ValueError):
+            rate_limit.parse_rate('10 в час')
+
+    def test_bucket_refills(self):
+        now = [0.0]
+        buckets = rate_limit.LocalTokenBuckets(clock=lambda: now[0])
+        bucket = rate_limit.Bucket('test', 'key', capacity=2, rate=1.0)
+        self.assertEqual(buckets.consume([bucket]), (True, 0))
+        self.assertEqual(buckets.consume([bucket]), (True, 0))
+        self.assertEqual(buckets.consume([bucket]), (False, 1.0))
+        now[0] = 0.5
+        self.assertEqual(buckets.consume([bucket]), (False, 0.5))
+        now[0] = 1.0
+        self.assertEqual(buckets.consume([bucket]), (True, 0))
+
+    def test_send_code_is_limited_per_phone(self):
+        self.assertEqual(self.send('79999999999').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.send('+7 999 999-99-99').status_code, status.HTTP_200_OK)
+        response = self.send('79999999999')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '30')
+
+    def test_rejected_request_does_not_spend_other_limits(self):
+        self.assertEqual(self.send('79990000001').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.send('79990000001').status_code, status.HTTP_200_OK)
+        # Отклонен по номеру: токен IP не расходуется
+        self.assertEqual(self.send('79990000001').status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(self.send('79990000002').status_code, status.HTTP_200_OK)
+        # Лимит IP исчерпан
+        self.assertEqual(self.send('79990000003').status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(SMSOutbox.objects.count(), 3)
+
+        stats = rate_limit.stats()
+        self.assertEqual(stats['sms_send_phone'], {'allowed': 3, 'denied': 1})
+        self.assertEqual(stats['sms_send_ip'], {'allowed': 3, 'denied': 1})
+
+    def test_verify_code_is_limited(self):
+        for _ in range(2):
+            response = self.client.post(
+                reverse('auth-verify-sms-code'), {'phone': '79991234567', 'code': '0000'}, format='json'
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(
+            reverse('auth-verify-sms-code'), {'phone': '79991234567', 'code': '0000'}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_stats_for_staff_only(self):
+        self.send('79999999999')
+        self.client.force_authenticate(user=User.objects.create_user(username='user', password='testpass123'))
+        self.assertEqual(self.client.get(reverse('auth-rate-limits')).status_code, status.HTTP_403_FORBIDDEN)
+        admin = User.objects.create_user(username='admin', password='testpass123', is_staff=True)
+        self.client.force_authenticate(user=admin)
+        response = self.client.get(reverse('auth-rate-limits'))
+        self.assertEqual(response.data['sms_send_global'], {'allowed': 1, 'denied': 0})
+        self.assertEqual(response.data['sms_verify_phone'], {'allowed': 0, 'denied': 0})
+
+
+@override_settings(SMS_CODE_MAX_ATTEMPTS=3, TASK_WORKER_THREADS=0)
+class VerificationStoreTest(APITestCase):
+    """Хранилища SMS-кодов: одна запись на номер, счетчик попыток, удаление истекших"""
+
+    def setUp(self):
+        cache.clear()
+        rate_limit.reset()
+        self.addCleanup(rate_limit.reset)
+
+    def check_store(self, store):
+        store.issue('79991234567', '1111')
+        store.issue('79991234567', '2222')
+        self.assertEqual(store.check('79991234567', '1111'), verification_store.INVALID)
+        self.assertEqual(store.check('79991234567', '2222'), verification_store.OK)
+        # Код одноразовый
+        self.assertEqual(store.check('79991234567', '2222'), verification_store.MISSING)
+
+        store.issue('79991234567', '3333')
+        for _ in range(3):
+            self.assertEqual(store.check('79991234567', '0000'), verification_store.INVALID)
+        # Попытки исчерпаны: не принимается и верный код
+        self.assertEqual(store.check('79991234567', '3333'), verification_store.LOCKED)
+        # Новый код сбрасывает счетчик
+        store.issue('79991234567', '4444')
+        self.assertEqual(store.check('79991234567', '4444'), verification_store.OK)
+        self.assertEqual(store.check('79990000000', '4444'), verification_store.MISSING)
+
+    def test_database_store(self):
+        store = verification_store.DatabaseVerificationStore()
+        self.check_store(store)
+        self.assertEqual(SMSVerification.objects.filter(phone='79991234567').count(), 1)
+
+        store.issue('79990000001', '1234', ttl=60)
+        SMSVerification.objects.filter(phone='79990000001').update(
+            expires_at=timezone.now() - timezone.timedelta(seconds=1)
+        )
+        self.assertEqual(store.check('79990000001', '1234'), verification_store.EXPIRED)
+
+    def test_purge_in_batches(self):
+        store = verification_store.DatabaseVerificationStore()
+        for number in range(5):
+            store.issue(f'7999000000{number}', '1234')
+        store.issue('79991234567', '1234')
+        SMSVerification.objects.exclude(phone='79991234567').update(
+            expires_at=timezone.now() - timezone.timedelta(minutes=1)
+        )
+        self.assertEqual(store.purge(batch_size=2), 5)
+        self.assertEqual(list(SMSVerification.objects.values_list('phone', flat=True)), ['79991234567'])
+        # Удаление ставится фоновой задачей при выдаче кодов, одна на все
+        self.assertEqual(
+            BackgroundTask.objects.filter(kind=verification_store.PURGE_SMS_VERIFICATIONS).count(), 1
+        )
+
+    @override_settings(SMS_VERIFICATION_STORE='ads.verification_store.CacheVerificationStore', CACHES=MEMORY_CACHES)
+    def test_cache_store_does_not_use_database(self):
+        store = verification_store.get_store()
+        self.assertIsInstance(store, verification_store.CacheVerificationStore)
+        with self.assertNumQueries(0):
+            self.check_store(store)
+
+    def test_verify_api_uses_store(self):
+        self.client.post(reverse('auth-send-sms-code'), {'phone': '79991234567'}, format='json')
+        code = SMSVerification.objects.get(phone='79991234567').code
+        url = reverse('auth-verify-sms-code')
+        response = self.client.post(url, {'phone': '79991234567', 'code': code}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.post(url, {'phone': '79991234567', 'code': code}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,61 @@
+"""
+Ограничения частоты SMS-запросов для DRF (корзины токенов из ads.rate_limit).
+
+Ограничения задаются в RATE_LIMITS; DRF по wait() отвечает 429 с заголовком
+Retry-After. Все корзины запроса проверяются одной операцией, поэтому
+отклоненный запрос не тратит токены номера, IP или общего лимита.
+"""
+from rest_framework.throttling import BaseThrottle
+from . import rate_limit
+
+
+def request_phone(request):
+    """Номер телефона из тела запроса (только цифры) или None"""
+    phone = request.data.get('phone') if hasattr(request.data, 'get') else None
+    digits = ''.join(filter(str.isdigit, str(phone or '')))
+    return digits or None
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Проверяет запрос по корзинам ограничений scopes. Ограничение вида
+    '<префикс>_phone' считается по номеру телефона, '_ip' - по адресу клиента,
+    '_global' - общее для всех запросов
+    """
+    scopes = ()
+
+    def get_buckets(self, request):
+        buckets = []
+        for scope in self.scopes:
+            if scope.endswith('_phone'):
+                key = request_phone(request)
+                if key is None:
+                    # Без номера запрос отклонит сама проверка данных
+                    continue
+            elif scope.endswith('_ip'):
+                key = self.get_ident(request)
+            else:
+                key = 'all'
+            buckets.append(rate_limit.bucket(scope, key))
+        return buckets
+
+    def allow_request(self, request, view):
+        self.retry_after = None
+        buckets = self.get_buckets(request)
+        if not buckets:
+            return True
+        allowed, wait = rate_limit.consume(buckets)
+        if not allowed:
+            self.retry_after = wait
+        return allowed
+
+    def wait(self):
+        return self.retry_after
+
+
+class SendSMSCodeThrottle(TokenBucketThrottle):
+    scopes = ('sms_send_phone', 'sms_send_ip', 'sms_send_global')
+
+
+class VerifySMSCodeThrottle(TokenBucketThrottle):
+    scopes = ('sms_verify_phone', 'sms_verify_ip')
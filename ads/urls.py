@@ -2,7 +2,7 @@ from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from .views import (
     CityViewSet, CategoryViewSet, AdvertisementViewSet, 
-    AdvertisementImageViewSet, FavoriteViewSet,
+    AdvertisementImageViewSet, ImageUploadViewSet, FavoriteViewSet,
     AuthViewSet
 )
 
@@ -10,6 +10,8 @@ router = DefaultRouter()
 router.register(r'cities', CityViewSet)
 router.register(r'categories', CategoryViewSet)
 router.register(r'advertisements', AdvertisementViewSet, basename='advertisement')
+# Регистрируется раньше images, иначе images/<pk>/ перехватит uploads/
+router.register(r'images/uploads', ImageUploadViewSet, basename='image-upload')
 router.register(r'images', AdvertisementImageViewSet, basename='image')
 router.register(r'favorites', FavoriteViewSet, basename='favorite')
 router.register(r'auth', AuthViewSet, basename='auth')
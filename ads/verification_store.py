@@ -0,0 +1,167 @@
+"""
+Хранилище SMS-кодов подтверждения.
+
+На номер телефона - одна действующая запись: новый код заменяет прежний
+и сбрасывает счетчик попыток. Каждая проверка сначала расходует попытку
+(условным UPDATE или атомарным incr), затем сравнивает код, поэтому
+параллельные запросы не дают подобрать код сверх SMS_CODE_MAX_ATTEMPTS
+попыток. Верный код одноразовый.
+
+Реализация задается SMS_VERIFICATION_STORE:
+- DatabaseVerificationStore - таблица SMSVerification (уникальный номер);
+  истекшие записи удаляет фоновая задача пачками по
+  SMS_VERIFICATION_PURGE_BATCH_SIZE - она ставится при выдаче кода не чаще
+  раза в SMS_VERIFICATION_PURGE_INTERVAL секунд (и команда purge_sms_verifications);
+- CacheVerificationStore - кеш Django (SMS_VERIFICATION_CACHE: locmem в памяти
+  процесса или общий redis), вход по коду не обращается к основной БД,
+  истекшие коды удаляет сам кеш.
+"""
+import secrets
+import string
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.utils.module_loading import import_string
+from . import tasks
+from .models import BackgroundTask, SMSVerification
+
+
+# Результаты проверки кода
+OK = 'ok'
+INVALID = 'invalid'
+EXPIRED = 'expired'
+LOCKED = 'locked'
+MISSING = 'missing'
+
+PURGE_SMS_VERIFICATIONS = 'purge_sms_verifications'
+
+
+def generate_code(length=4):
+    return ''.join(secrets.choice(string.digits) for _ in range(length))
+
+
+class DatabaseVerificationStore:
+    """Коды в таблице SMSVerification"""
+
+    def issue(self, phone, code, ttl=None):
+        """Сохраняет новый код номера; возвращает время истечения"""
+        now = timezone.now()
+        values = {
+            'code': code,
+            'expires_at': now + timedelta(seconds=ttl or settings.SMS_CODE_TTL),
+            'attempts': 0,
+            'is_verified': False,
+            'created_at': now,
+        }
+        if not SMSVerification.objects.filter(phone=phone).update(**values):
+            try:
+                with transaction.atomic():
+                    SMSVerification.objects.create(phone=phone, **values)
+            except IntegrityError:
+                # Запись создал параллельный запрос
+                SMSVerification.objects.filter(phone=phone).update(**values)
+        schedule_purge()
+        return values['expires_at']
+
+    def check(self, phone, code):
+        """Проверяет код; верный код больше не принимается"""
+        now = timezone.now()
+        verification = SMSVerification.objects.filter(phone=phone, is_verified=False).values(
+            'pk', 'code', 'expires_at'
+        ).first()
+        if verification is None:
+            return MISSING
+        if verification['expires_at'] < now:
+            return EXPIRED
+        # Попытка расходуется до сравнения
+        reserved = SMSVerification.objects.filter(
+            pk=verification['pk'], is_verified=False, attempts__lt=settings.SMS_CODE_MAX_ATTEMPTS
+        ).update(attempts=F('attempts') + 1)
+        if not reserved:
+            return LOCKED
+        if not constant_time_compare(code, verification['code']):
+            return INVALID
+        used = SMSVerification.objects.filter(
+            pk=verification['pk'], code=verification['code'], is_verified=False
+        ).update(is_verified=True)
+        return OK if used else MISSING
+
+    def discard(self, phone):
+        SMSVerification.objects.filter(phone=phone).delete()
+
+    def purge(self, batch_size=None):
+        """Удаляет истекшие записи пачками; возвращает их количество"""
+        batch_size = batch_size or settings.SMS_VERIFICATION_PURGE_BATCH_SIZE
+        now = timezone.now()
+        total = 0
+        while True:
+            ids = list(SMSVerification.objects.filter(expires_at__lt=now).order_by('expires_at', 'id').values_list(
+                'id', flat=True
+            )[:batch_size])
+            if not ids:
+                return total
+            # Номеру могли выдать новый код, пока шел обход
+            deleted, _ = SMSVerification.objects.filter(pk__in=ids, expires_at__lt=now).delete()
+            total += deleted
+            if len(ids) < batch_size:
+                return total
+
+
+class CacheVerificationStore:
+    """Коды в кеше Django: без обращений к основной БД"""
+
+    def __init__(self, alias=None):
+        self.cache = caches[alias or settings.SMS_VERIFICATION_CACHE]
+
+    def keys(self, phone):
+        return f'sms:code:{phone}', f'sms:attempts:{phone}'
+
+    def issue(self, phone, code, ttl=None):
+        ttl = ttl or settings.SMS_CODE_TTL
+        code_key, attempts_key = self.keys(phone)
+        self.cache.set_many({code_key: code, attempts_key: 0}, timeout=ttl)
+        return timezone.now() + timedelta(seconds=ttl)
+
+    def check(self, phone, code):
+        code_key, attempts_key = self.keys(phone)
+        stored = self.cache.get(code_key)
+        if stored is None:
+            # Истекший код кеш уже удалил
+            return MISSING
+        try:
+            attempts = self.cache.incr(attempts_key)
+        except ValueError:
+            return MISSING
+        if attempts > settings.SMS_CODE_MAX_ATTEMPTS:
+            return LOCKED
+        if not constant_time_compare(code, stored):
+            return INVALID
+        # Код принимает тот запрос, который его удалил
+        return OK if self.cache.delete(code_key) else MISSING
+
+    def discard(self, phone):
+        self.cache.delete_many(self.keys(phone))
+
+    def purge(self, batch_size=None):
+        return 0
+
+
+def get_store():
+    return import_string(settings.SMS_VERIFICATION_STORE)()
+
+
+def schedule_purge():
+    """Ставит задачу удаления истекших кодов, если ее нет в очереди"""
+    if not BackgroundTask.objects.filter(
+        kind=PURGE_SMS_VERIFICATIONS, status=BackgroundTask.STATUS_PENDING
+    ).exists():
+        tasks.enqueue(PURGE_SMS_VERIFICATIONS, delay=settings.SMS_VERIFICATION_PURGE_INTERVAL)
+
+
+@tasks.register(PURGE_SMS_VERIFICATIONS)
+def run_purge(payload):
+    get_store().purge()
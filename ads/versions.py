@@ -0,0 +1,75 @@
+import os
+import time
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+
+
+KEY_PREFIX = 'ads:version:'
+CHANGED_SUFFIX = ':changed'
+
+# Пространства имен версий, у которых нет собственного модуля
+CITIES_NAMESPACE = 'cities'
+ADVERTISEMENTS_NAMESPACE = 'advertisements'
+
+
+def _initial_version():
+    # После очистки кеша версии не должны повторять уже выданные (ключи кеша, ETag)
+    return time.time_ns() // 1000
+
+
+def get_version(namespace):
+    """Текущая версия данных пространства имен (категории, города и т.д.)"""
+    return get_versions([namespace])[0]
+
+
+def get_versions(namespaces):
+    """Версии нескольких пространств имен одним обращением к кешу"""
+    keys = [KEY_PREFIX + namespace for namespace in namespaces]
+    found = cache.get_many(keys)
+    versions = []
+    for key in keys:
+        version = found.get(key)
+        if version is None:
+            cache.add(key, _initial_version(), timeout=None)
+            version = cache.get(key, 0)
+        versions.append(version)
+    return versions
+
+
+def get_changed_at(namespaces):
+    """Время последнего изменения (timestamp) данных пространств имен или None"""
+    found = cache.get_many([KEY_PREFIX + namespace + CHANGED_SUFFIX for namespace in namespaces])
+    return max(found.values()) if found else None
+
+
+def _incr(namespace):
+    key = KEY_PREFIX + namespace
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Ключа еще нет (или кеш очищен)
+        cache.add(key, _initial_version(), timeout=None)
+    cache.set(key + CHANGED_SUFFIX, time.time(), timeout=None)
+
+
+def bump_version(namespace):
+    """
+    Увеличивает версию после фиксации транзакции, чтобы другие процессы
+    не закешировали данные, которые еще не видны в БД.
+    """
+    transaction.on_commit(lambda: _incr(namespace))
+
+
+def check_shared_cache():
+    """
+    Версии хранятся в кеше, и изменение в одном процессе должны видеть все процессы:
+    с кешем в памяти процесса (locmem) остальные процессы отдавали бы
+    устаревшие ответы и 304. Число процессов - WEB_CONCURRENCY (gunicorn).
+    """
+    workers = int(os.environ.get('WEB_CONCURRENCY') or 1)
+    if workers > 1 and isinstance(caches['default'], LocMemCache):
+        raise ImproperlyConfigured(
+            f'CACHE_BACKEND=locmem не подходит для {workers} процессов: используйте db или redis'
+        )
@@ -0,0 +1,381 @@
+"""
+Буферизованный учет просмотров объявлений.
+
+Запрос на просмотр только увеличивает счетчик в буфере и в БД не пишет.
+Буфер периодически сбрасывается в БД пачками UPDATE ... SET
+views_count = views_count + n (объявления с одинаковым n - одним запросом),
+поэтому параллельные просмотры не теряются.
+
+Хранилище буфера задается VIEW_COUNTER_BACKEND:
+- LocalViewBuffer - память процесса; каждый просмотр дописывается в журнал
+  процесса в VIEW_COUNTER_JOURNAL_DIR (по умолчанию BASE_DIR/view_journal),
+  и несброшенные просмотры переживают падение процесса (их подбирает
+  flush_view_counts). С пустым VIEW_COUNTER_JOURNAL_DIR буфер только в памяти;
+- RedisViewBuffer - общий для всех процессов хеш в Redis.
+
+Сброс выполняет фоновый поток процесса раз в VIEW_COUNTER_FLUSH_INTERVAL
+секунд и команда flush_view_counts. Гарантия - «хотя бы один раз»: при
+падении между записью в БД и очисткой буфера пачка будет учтена повторно.
+"""
+import atexit
+import os
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils.module_loading import import_string
+
+# Без flock (Windows) живость владельца журнала проверяется по pid
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+UPDATE_BATCH_SIZE = 500
+
+
+def apply_counts(counts):
+    """Записывает накопленные просмотры в БД; возвращает число объявлений"""
+    from .models import Advertisement
+    from .versions import ADVERTISEMENTS_NAMESPACE, bump_version
+
+    by_increment = defaultdict(list)
+    for advertisement_id, increment in counts.items():
+        if increment > 0:
+            by_increment[increment].append(advertisement_id)
+    with transaction.atomic():
+        for increment, ids in by_increment.items():
+            for start in range(0, len(ids), UPDATE_BATCH_SIZE):
+                Advertisement.objects.filter(pk__in=ids[start:start + UPDATE_BATCH_SIZE]).update(
+                    views_count=F('views_count') + increment
+                )
+        if by_increment:
+            bump_version(ADVERTISEMENTS_NAMESPACE)
+    return sum(len(ids) for ids in by_increment.values())
+
+
+class LocalViewBuffer:
+    """
+    Буфер в памяти процесса с необязательным журналом на диске.
+
+    Файлы журнала называются по владельцу - «pid-uuid» процесса: uuid не
+    повторяется, даже если pid упавшего процесса достанется новому. Пока
+    владелец жив, он держит flock на файле views-<владелец>.lock; журналы
+    владельца без блокировки подбирает recover(). Файлы, которые забрал
+    recover(), переименовываются в *.<владелец>.recovering и тоже подбираются
+    повторно, если записать их в БД не удалось или recover() упал.
+    """
+
+    def __init__(self, journal_dir=None):
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.recover_lock = threading.Lock()
+        self.journal_dir = journal_dir
+        self.journal = None
+        self.owner = None
+        self.owner_pid = None
+        self.owner_lock = None
+        if journal_dir:
+            os.makedirs(journal_dir, exist_ok=True)
+
+    # Журнал
+
+    def journal_owner(self):
+        """Владелец журналов процесса; после fork у процесса-потомка свой"""
+        if self.owner_pid != os.getpid():
+            self.owner = f'{os.getpid()}-{uuid.uuid4().hex}'
+            self.owner_pid = os.getpid()
+            self.journal = None
+            self.owner_lock = open(os.path.join(self.journal_dir, f'views-{self.owner}.lock'), 'w')
+            if fcntl is not None:
+                fcntl.flock(self.owner_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return self.owner
+
+    def owner_alive(self, owner):
+        if owner == self.journal_owner():
+            return True
+        if '-' not in owner or fcntl is None:
+            # Журнал прежнего формата (views-<pid>.log) или ОС без flock
+            return process_alive(int(owner.split('-')[0]))
+        try:
+            descriptor = os.open(os.path.join(self.journal_dir, f'views-{owner}.lock'), os.O_RDWR)
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            # Закрытие снимает и нашу блокировку
+            os.close(descriptor)
+        return False
+
+    def journal_path(self):
+        return os.path.join(self.journal_dir, f'views-{self.journal_owner()}.log')
+
+    def write_journal(self, advertisement_id):
+        if self.journal is None:
+            self.journal = open(self.journal_path(), 'a', encoding='ascii')
+        self.journal.write(f'{advertisement_id}\n')
+        # Отдаем запись ОС: после падения процесса она останется в файле
+        self.journal.flush()
+
+    def rotate_journal(self):
+        """Переименовывает журнал процесса в файл, ожидающий записи в БД"""
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        path = self.journal_path()
+        if not os.path.exists(path):
+            return None
+        pending = f'{path[:-len(".log")]}.{time.time_ns()}.flushing'
+        os.rename(path, pending)
+        return pending
+
+    @staticmethod
+    def read_journal(path):
+        counts = Counter()
+        with open(path, encoding='ascii') as journal:
+            for line in journal:
+                # Строка без перевода строки могла быть недописана при падении
+                if line.endswith('\n') and line[:-1].isdigit():
+                    counts[int(line)] += 1
+        return counts
+
+    @staticmethod
+    def parse_name(name):
+        """Владелец и тот, кто забрал файл в recover() (или None); None - не файл журнала"""
+        if not name.startswith('views-') or not name.endswith(('.log', '.flushing', '.recovering')):
+            return None
+        parts = name[len('views-'):].split('.')
+        recoverer = parts[-2] if name.endswith('.recovering') else None
+        return parts[0], recoverer
+
+    def pending_journals(self, orphaned=False):
+        """
+        Файлы этого процесса, ожидающие записи, либо файлы завершившихся процессов
+        (в том числе забранные recover(), который не довел запись до конца)
+        """
+        owner = self.journal_owner()
+        result = []
+        for name in os.listdir(self.journal_dir):
+            parsed = self.parse_name(name)
+            if parsed is None:
+                continue
+            file_owner, recoverer = parsed
+            if orphaned:
+                if recoverer is not None:
+                    if recoverer == owner or not self.owner_alive(recoverer):
+                        result.append(os.path.join(self.journal_dir, name))
+                elif not self.owner_alive(file_owner):
+                    result.append(os.path.join(self.journal_dir, name))
+            elif file_owner == owner and name.endswith('.flushing'):
+                result.append(os.path.join(self.journal_dir, name))
+        return sorted(result)
+
+    def remove_dead_locks(self):
+        for name in os.listdir(self.journal_dir):
+            if not name.startswith('views-') or not name.endswith('.lock'):
+                continue
+            if not self.owner_alive(name[len('views-'):-len('.lock')]):
+                try:
+                    os.remove(os.path.join(self.journal_dir, name))
+                except FileNotFoundError:
+                    pass
+
+    # Интерфейс буфера
+
+    def add(self, advertisement_id):
+        with self.lock:
+            if self.journal_dir:
+                self.write_journal(advertisement_id)
+            self.counts[advertisement_id] += 1
+            return self.counts[advertisement_id]
+
+    def pending(self, advertisement_id):
+        return self.counts.get(advertisement_id, 0)
+
+    def flush(self):
+        with self.lock:
+            counts = self.counts
+            self.counts = Counter()
+            if self.journal_dir:
+                self.rotate_journal()
+        try:
+            if not self.journal_dir:
+                return apply_counts(counts)
+            # С журналом источник истины - файлы: в них есть и пачки неудачных сбросов
+            journals = self.pending_journals()
+            total = Counter()
+            for path in journals:
+                total.update(self.read_journal(path))
+            flushed = apply_counts(total)
+            for path in journals:
+                os.remove(path)
+            return flushed
+        except Exception:
+            with self.lock:
+                self.counts.update(counts)
+            raise
+
+    def recover(self):
+        """Записывает в БД журналы процессов, завершившихся без сброса"""
+        if not self.journal_dir:
+            return 0
+        with self.recover_lock:
+            owner = self.journal_owner()
+            suffix = f'.{owner}.recovering'
+            claimed = []
+            for path in self.pending_journals(orphaned=True):
+                if path.endswith(suffix):
+                    # Забран этим процессом раньше, но не записан
+                    claimed.append(path)
+                    continue
+                original = path.rsplit('.', 2)[0] if path.endswith('.recovering') else path
+                target = f'{original}{suffix}'
+                try:
+                    os.rename(path, target)
+                except FileNotFoundError:
+                    # Файл забрал другой процесс
+                    continue
+                claimed.append(target)
+            total = Counter()
+            for path in claimed:
+                total.update(self.read_journal(path))
+            flushed = apply_counts(total)
+            for path in claimed:
+                os.remove(path)
+            self.remove_dead_locks()
+            return flushed
+
+
+class RedisViewBuffer:
+    """Общий буфер всех процессов в хеше Redis"""
+    pending_key = 'ads:views:pending'
+    flushing_key = 'ads:views:flushing'
+    lock_key = 'ads:views:flush-lock'
+
+    def __init__(self, url):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.response_error = redis.ResponseError
+
+    def add(self, advertisement_id):
+        return self.client.hincrby(self.pending_key, advertisement_id, 1)
+
+    def pending(self, advertisement_id):
+        value = self.client.hget(self.pending_key, advertisement_id)
+        return int(value) if value else 0
+
+    def flush(self):
+        with self.client.lock(self.lock_key, timeout=300):
+            # Пачка прошлого неудачного сброса остается в flushing_key и пишется первой
+            if not self.client.exists(self.flushing_key):
+                try:
+                    self.client.rename(self.pending_key, self.flushing_key)
+                except self.response_error:
+                    # Новых просмотров не было
+                    return 0
+            counts = {
+                int(advertisement_id): int(value)
+                for advertisement_id, value in self.client.hgetall(self.flushing_key).items()
+            }
+            flushed = apply_counts(counts)
+            self.client.delete(self.flushing_key)
+            return flushed
+
+    def recover(self):
+        return 0
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+_flusher = None
+
+
+def create_buffer():
+    backend = import_string(settings.VIEW_COUNTER_BACKEND)
+    if backend is RedisViewBuffer:
+        return backend(settings.VIEW_COUNTER_REDIS_URL)
+    return backend(settings.VIEW_COUNTER_JOURNAL_DIR or None)
+
+
+def get_buffer():
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = create_buffer()
+    return _buffer
+
+
+def record(advertisement_id):
+    """Учитывает просмотр; возвращает число еще не записанных в БД просмотров"""
+    start_flusher()
+    return get_buffer().add(advertisement_id)
+
+
+def pending(advertisement_id):
+    return get_buffer().pending(advertisement_id)
+
+
+def flush():
+    """Сбрасывает буфер в БД; возвращает число обновленных объявлений"""
+    return get_buffer().flush()
+
+
+def recover():
+    """Подбирает просмотры из журналов завершившихся процессов"""
+    return get_buffer().recover()
+
+
+def flush_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            flush()
+        except Exception as e:
+            print(f"Ошибка при сбросе счетчиков просмотров: {e}")
+        finally:
+            close_old_connections()
+
+
+def start_flusher():
+    """Запускает фоновый сброс буфера процесса (однократно)"""
+    global _flusher
+    interval = settings.VIEW_COUNTER_FLUSH_INTERVAL
+    if _flusher is not None or interval <= 0:
+        return
+    with _buffer_lock:
+        if _flusher is not None:
+            return
+        _flusher = threading.Thread(target=flush_loop, args=(interval,), name='view-counter-flush', daemon=True)
+        _flusher.start()
+        atexit.register(flush_at_exit)
+
+
+def flush_at_exit():
+    try:
+        flush()
+    except Exception as e:
+        print(f"Ошибка при сбросе счетчиков просмотров: {e}")
+
+
+def reset():
+    global _buffer
+    _buffer = None
@@ -1,27 +1,48 @@
-from rest_framework import viewsets, status, filters
+from rest_framework import viewsets, mixins, status, filters
 from rest_framework.decorators import action
+from rest_framework.parsers import JSONParser
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly, AllowAny
+from rest_framework.permissions import IsAdminUser, IsAuthenticated, IsAuthenticatedOrReadOnly, AllowAny
 from rest_framework.authtoken.models import Token
 from django_filters.rest_framework import DjangoFilterBackend
-from django.db.models import Q, F, Sum
+from django.db.models import Exists, OuterRef, Q, F, Max, Sum, Prefetch
 from django.utils import timezone
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from django.views.decorators.http import require_http_methods
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
+from django.conf import settings
+from django.core.exceptions import ValidationError
 import json
-from .models import City, Category, Advertisement, AdvertisementImage, Favorite
+from collections import Counter
+from collections.abc import Iterator
+from .models import City, Category, Advertisement, AdvertisementImage, Favorite, ImageUpload
 from .serializers import (
     CitySerializer, CategorySerializer, AdvertisementListSerializer, AdvertisementDetailSerializer,
-    AdvertisementCreateSerializer, AdvertisementImageSerializer,
+    AdvertisementCreateSerializer, AdvertisementImageSerializer, ImageUploadSerializer,
     FavoriteSerializer, FavoriteCreateSerializer, CategoryWithUnviewedCountSerializer, 
     CategoryWithChildrenSerializer, UserSerializer
 )
 from .sms_service import SMSService
 from .permissions import IsOwnerOrReadOnly
+from .throttling import SendSMSCodeThrottle, VerifySMSCodeThrottle
+from .pagination import AdvertisementPagination
+from .filters import AdvertisementSearchFilter
+from . import (
+    bulk, category_tree, chunked_upload, counters, image_processing, rate_limit, search, suggest, verification_store
+)
+from .response_cache import cache_response
+from .conditional import ConditionalGetMixin, conditional_get, latest
+from .parsers import NDJSONParser
+from .renderers import FastJSONRenderer, stream_json_list
+from .field_selection import FieldSelectionViewMixin, child, expands, includes, restrict
+from .versions import ADVERTISEMENTS_NAMESPACE, CITIES_NAMESPACE
+
+
+# Данные, из которых собираются списки категорий: дерево, города и счетчики объявлений
+CATEGORY_LIST_NAMESPACES = (category_tree.NAMESPACE, CITIES_NAMESPACE, counters.NAMESPACE)
 
 
 @method_decorator(csrf_exempt, name='dispatch')
@@ -119,7 +140,7 @@ class AuthViewSet(viewsets.ViewSet):
                 'error': 'Пользователь не авторизован'
             }, status=status.HTTP_401_UNAUTHORIZED)
     
-    @action(detail=False, methods=['post'])
+    @action(detail=False, methods=['post'], throttle_classes=[SendSMSCodeThrottle])
     def send_sms_code(self, request):
         """Отправляет SMS код подтверждения"""
         phone = request.data.get('phone')
@@ -148,7 +169,8 @@ class AuthViewSet(viewsets.ViewSet):
             
             return Response({
                 'message': 'Код отправлен',
-                'phone': clean_phone
+                'phone': clean_phone,
+                'sms_id': result.get('sms_id')
             }, status=status.HTTP_200_OK)
             
         except Exception as e:
@@ -156,7 +178,35 @@ class AuthViewSet(viewsets.ViewSet):
                 'error': f'Ошибка отправки SMS: {str(e)}'
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     
-    @action(detail=False, methods=['post'])
+    @action(detail=False, methods=['get'], permission_classes=[IsAdminUser])
+    def rate_limits(self, request):
+        """Счетчики пропущенных и отклоненных SMS-запросов по ограничениям (для мониторинга)"""
+        return Response(rate_limit.stats())
+    
+    @action(detail=False, methods=['get'])
+    def sms_status(self, request):
+        """Статус отправки SMS с кодом (SMS уходит в фоне после ответа send_sms_code)"""
+        phone = request.query_params.get('phone')
+        sms_id = request.query_params.get('sms_id')
+        
+        if not all([phone, sms_id]) or not sms_id.isdigit():
+            return Response({
+                'error': 'Необходимо указать номер телефона и sms_id'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        result = SMSService().delivery_status(phone, int(sms_id))
+        if 'error' in result:
+            return Response({
+                'error': result['error']
+            }, status=status.HTTP_404_NOT_FOUND)
+        
+        return Response({
+            'status': result['status'],
+            'attempts': result['attempts'],
+            'sent_at': result['sent_at']
+        })
+    
+    @action(detail=False, methods=['post'], throttle_classes=[VerifySMSCodeThrottle])
     def verify_sms_code(self, request):
         """Проверяет SMS код и создает/авторизует пользователя"""
         phone = request.data.get('phone')
@@ -248,7 +298,7 @@ class AuthViewSet(viewsets.ViewSet):
         
         try:
             # Удаляем связанные данные пользователя
-            from .models import UserLastCode, SMSVerification, Favorite
+            from .models import UserLastCode, Favorite
             from django.contrib.auth.models import User
             
             user = request.user
@@ -257,7 +307,7 @@ class AuthViewSet(viewsets.ViewSet):
             UserLastCode.objects.filter(user=user).delete()
             
             # Удаляем SMS верификации пользователя
-            SMSVerification.objects.filter(phone=user.username).delete()
+            verification_store.get_store().discard(user.username)
             
             # Удаляем избранное пользователя
             Favorite.objects.filter(user=user).delete()
@@ -286,9 +336,10 @@ class AuthViewSet(viewsets.ViewSet):
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-class CityViewSet(viewsets.ReadOnlyModelViewSet):
+class CityViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     """Представление для городов"""
-    queryset = City.objects.filter(is_active=True)
+    queryset = City.objects.with_counts().filter(is_active=True)
+    conditional_namespaces = (CITIES_NAMESPACE, counters.NAMESPACE)
     serializer_class = CitySerializer
     lookup_field = 'slug'
     filter_backends = [filters.SearchFilter, filters.OrderingFilter]
@@ -297,9 +348,10 @@ class CityViewSet(viewsets.ReadOnlyModelViewSet):
     ordering = ['name']
 
 
-class CategoryViewSet(viewsets.ReadOnlyModelViewSet):
+class CategoryViewSet(FieldSelectionViewMixin, ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     """Представление для категорий с количеством непросмотренных"""
     queryset = Category.objects.all()
+    conditional_namespaces = CATEGORY_LIST_NAMESPACES
     serializer_class = CategoryWithUnviewedCountSerializer
     lookup_field = 'slug'
     filter_backends = [filters.SearchFilter, filters.OrderingFilter]
@@ -309,7 +361,11 @@ class CategoryViewSet(viewsets.ReadOnlyModelViewSet):
 
     def get_queryset(self):
         """Возвращает категории с фильтрацией по городам"""
-        queryset = Category.objects.all()
+        selection = self.get_field_selection()
+        if self.get_serializer_class() is CategoryWithChildrenSerializer:
+            queryset = Category.objects.with_children(selection)
+        else:
+            queryset = Category.objects.with_counts(selection)
         
         # Фильтр по уровню
         level = self.request.query_params.get('level')
@@ -344,50 +400,79 @@ class CategoryViewSet(viewsets.ReadOnlyModelViewSet):
         
         return queryset
 
+    def get_conditional_validators(self, request, *args, **kwargs):
+        parts, last_modified = super().get_conditional_validators(request, *args, **kwargs)
+        # Максимум updated_at берем из снимка дерева, без запроса к БД
+        return parts, latest(last_modified, category_tree.get_tree().updated_at)
+
     def get_serializer_class(self):
         """Выбирает сериализатор в зависимости от действия"""
+        if self.action == 'tree':
+            return CategoryWithChildrenSerializer
         if self.action == 'retrieve' and self.request.query_params.get('with_children') == 'true':
             return CategoryWithChildrenSerializer
         return CategoryWithUnviewedCountSerializer
 
+    def list_response(self, queryset, serializer_class):
+        """
+        Ответ со списком категорий без пагинации. В JSON список отдается
+        потоком: категории читаются из БД пачками и кодируются по одной.
+        """
+        context = self.get_serializer_context()
+        if not isinstance(self.request.accepted_renderer, FastJSONRenderer):
+            serializer = serializer_class(queryset, many=True, context=context)
+            return Response(serializer.data)
+        serializer = serializer_class(context=context)
+        items = queryset.iterator(chunk_size=settings.STREAMING_CHUNK_SIZE)
+        return StreamingHttpResponse(
+            stream_json_list(items, serializer.to_representation),
+            content_type=self.request.accepted_renderer.media_type,
+        )
+
     @action(detail=True, methods=['get'])
+    @conditional_get
     def children(self, request, slug=None):
         """Получает подкатегории конкретной категории"""
         category = self.get_object()
-        children = category.children.all()
-        serializer = CategoryWithUnviewedCountSerializer(children, many=True, context={'request': request})
-        return Response(serializer.data)
+        children = Category.objects.with_counts(self.get_field_selection()).filter(parent=category)
+        return self.list_response(children, CategoryWithUnviewedCountSerializer)
 
     @action(detail=True, methods=['get'])
+    @conditional_get
     def tree(self, request, slug=None):
         """Получает полное дерево категории с подкатегориями"""
         category = self.get_object()
-        serializer = CategoryWithChildrenSerializer(category, context={'request': request})
+        serializer = CategoryWithChildrenSerializer(category, context=self.get_serializer_context())
         return Response(serializer.data)
 
     @action(detail=False, methods=['get'])
+    @conditional_get
+    @cache_response(*CATEGORY_LIST_NAMESPACES)
     def hierarchy(self, request):
         """Получает полную иерархию всех категорий"""
         # Получаем только родительские категории
-        parent_categories = Category.objects.filter(parent__isnull=True)
-        serializer = CategoryWithChildrenSerializer(parent_categories, many=True, context={'request': request})
-        return Response(serializer.data)
+        parent_categories = Category.objects.with_children(self.get_field_selection()).filter(parent__isnull=True)
+        return self.list_response(parent_categories, CategoryWithChildrenSerializer)
 
     @action(detail=False, methods=['get'])
+    @conditional_get
+    @cache_response(*CATEGORY_LIST_NAMESPACES)
     def parents_only(self, request):
         """Получает только родительские категории"""
-        parent_categories = Category.objects.filter(parent__isnull=True)
-        serializer = CategoryWithUnviewedCountSerializer(parent_categories, many=True, context={'request': request})
-        return Response(serializer.data)
+        parent_categories = Category.objects.with_counts(self.get_field_selection()).filter(parent__isnull=True)
+        return self.list_response(parent_categories, CategoryWithUnviewedCountSerializer)
 
     @action(detail=False, methods=['get'])
+    @conditional_get
+    @cache_response(*CATEGORY_LIST_NAMESPACES)
     def subcategories_only(self, request):
         """Получает только подкатегории"""
-        subcategories = Category.objects.filter(parent__isnull=False)
-        serializer = CategoryWithUnviewedCountSerializer(subcategories, many=True, context={'request': request})
-        return Response(serializer.data)
+        subcategories = Category.objects.with_counts(self.get_field_selection()).filter(parent__isnull=False)
+        return self.list_response(subcategories, CategoryWithUnviewedCountSerializer)
 
     @action(detail=False, methods=['get'])
+    @conditional_get
+    @cache_response(*CATEGORY_LIST_NAMESPACES)
     def by_city(self, request):
         """Получает категории, доступные в указанном городе"""
         city_id = request.query_params.get('city_id')
@@ -400,11 +485,11 @@ class CategoryViewSet(viewsets.ReadOnlyModelViewSet):
         
         if city_id == 'all':
             # Показываем все категории
-            queryset = Category.objects.filter(parent__isnull=True)
+            queryset = Category.objects.with_counts(self.get_field_selection()).filter(parent__isnull=True)
         else:
             try:
                 # Фильтруем по конкретному городу
-                queryset = Category.objects.filter(
+                queryset = Category.objects.with_counts(self.get_field_selection()).filter(
                     parent__isnull=True
                 ).filter(
                     Q(cities__id=city_id) | Q(cities__isnull=True)
@@ -415,22 +500,53 @@ class CategoryViewSet(viewsets.ReadOnlyModelViewSet):
                     status=status.HTTP_400_BAD_REQUEST
                 )
         
-        serializer = CategoryWithUnviewedCountSerializer(queryset, many=True, context={'request': request})
-        return Response(serializer.data)
+        return self.list_response(queryset, CategoryWithUnviewedCountSerializer)
 
 
 @method_decorator(csrf_exempt, name='dispatch')
-class AdvertisementViewSet(viewsets.ModelViewSet):
+class AdvertisementViewSet(FieldSelectionViewMixin, ConditionalGetMixin, viewsets.ModelViewSet):
     """Представление для объявлений"""
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
+    filter_backends = [DjangoFilterBackend, AdvertisementSearchFilter, filters.OrderingFilter]
     filterset_fields = ['category', 'city', 'status', 'author', 'is_featured']
     search_fields = ['title', 'description', 'location', 'city__name']
     ordering_fields = ['price', 'created_at', 'title']
     ordering = ['-created_at']
     permission_classes = [IsAuthenticatedOrReadOnly, IsOwnerOrReadOnly]
+    pagination_class = AdvertisementPagination
+    conditional_namespaces = (ADVERTISEMENTS_NAMESPACE,) + CATEGORY_LIST_NAMESPACES
+
+    def get_conditional_namespaces(self):
+        if self.action == 'retrieve':
+            # Карточка зависит от своей строки (изменение фото обновляет updated_at),
+            # отметки «в избранном» и данных категорий и городов, но не от других объявлений
+            return CATEGORY_LIST_NAMESPACES
+        return super().get_conditional_namespaces()
+
+    def get_conditional_validators(self, request, *args, **kwargs):
+        parts, last_modified = super().get_conditional_validators(request, *args, **kwargs)
+        if self.action != 'retrieve':
+            return parts, last_modified
+        try:
+            pk = int(kwargs[self.lookup_url_kwarg or self.lookup_field])
+        except (KeyError, TypeError, ValueError):
+            return None
+        row = Advertisement.objects.filter(pk=pk).annotate(
+            is_favorited=Exists(Favorite.objects.filter(
+                advertisement=OuterRef('pk'), user_id=request.user.pk
+            ))
+        ).values_list('updated_at', 'views_count', 'is_favorited').first()
+        if row is None:
+            return None
+        return parts + list(row), latest(last_modified, row[0])
 
     def get_queryset(self):
-        queryset = Advertisement.objects.select_related('category', 'city', 'author').prefetch_related('images')
+        if self.action == 'increment_views':
+            # Для учета просмотра данные для списка не нужны
+            queryset = Advertisement.objects.all()
+        else:
+            queryset = Advertisement.objects.for_listing(self.get_field_selection())
+        if self.action == 'retrieve' and includes(self.get_field_selection(), 'images'):
+            queryset = queryset.prefetch_related('images')
         
         # Фильтрация по статусу (по умолчанию показываем только активные)
         status_filter = self.request.query_params.get('status', 'active')
@@ -492,6 +608,9 @@ class AdvertisementViewSet(viewsets.ModelViewSet):
         # Создаем копию данных без файлов
         data = {}
         for key, value in request.data.items():
+            if key == 'uploads' and hasattr(request.data, 'getlist'):
+                # Идентификаторы загрузок в multipart передаются повторяющимся ключом
+                value = request.data.getlist(key)
             if key != 'images':
                 data[key] = value
         
@@ -515,7 +634,7 @@ class AdvertisementViewSet(viewsets.ModelViewSet):
             return Response({'detail': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
         
         # Для my_advertisements возвращаем только активные объявления
-        queryset = Advertisement.objects.select_related('category', 'city', 'author').prefetch_related('images')
+        queryset = Advertisement.objects.for_listing(self.get_field_selection())
         queryset = queryset.filter(author=request.user, status='active')
         
         page = self.paginate_queryset(queryset)
@@ -533,7 +652,7 @@ class AdvertisementViewSet(viewsets.ModelViewSet):
             return Response({'detail': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
         
         # Для pending используем базовый queryset без фильтрации по статусу
-        queryset = Advertisement.objects.select_related('category', 'city', 'author').prefetch_related('images')
+        queryset = Advertisement.objects.for_listing(self.get_field_selection())
         queryset = queryset.filter(author=request.user, status='pending')
         
         page = self.paginate_queryset(queryset)
@@ -563,21 +682,52 @@ class AdvertisementViewSet(viewsets.ModelViewSet):
         if not query:
             return Response({'detail': 'Query parameter "q" is required'}, status=status.HTTP_400_BAD_REQUEST)
         
-        queryset = self.get_queryset().filter(
-            Q(title__icontains=query) |
-            Q(description__icontains=query) |
-            Q(location__icontains=query) |
-            Q(category__name__icontains=query)
-        )
-        
-        page = self.paginate_queryset(queryset)
-        if page is not None:
+        queryset = self.filter_queryset(self.get_queryset())
+
+        # При явной сортировке или курсорной пагинации порядок задает пагинатор
+        if request.query_params.get('ordering') or self.paginator.is_cursor_request(request):
+            found = search.filter_queryset(queryset, query)
+            if not found.exists():
+                # Ничего не нашли - пробуем запрос с исправленными опечатками
+                corrected = suggest.get_index().correct(query)
+                if corrected:
+                    found = search.filter_queryset(queryset, corrected)
+            page = self.paginate_queryset(found)
             serializer = self.get_serializer(page, many=True)
             return self.get_paginated_response(serializer.data)
-        
-        serializer = self.get_serializer(queryset, many=True)
+
+        # Иначе сортируем по релевантности и загружаем только объявления текущей страницы
+        ranked_ids = search.rank(queryset, query)
+        if not ranked_ids:
+            corrected = suggest.get_index().correct(query)
+            if corrected:
+                ranked_ids = search.rank(queryset, corrected)
+        page_ids = self.paginate_queryset(ranked_ids)
+        if page_ids is None:
+            page_ids = list(ranked_ids)
+        advertisements = {advertisement.pk: advertisement for advertisement in queryset.filter(pk__in=page_ids)}
+        results = [advertisements[pk] for pk in page_ids if pk in advertisements]
+
+        serializer = self.get_serializer(results, many=True)
+        if self.paginator is not None:
+            return self.get_paginated_response(serializer.data)
         return Response(serializer.data)
 
+    @action(detail=False, methods=['get'])
+    def suggest(self, request):
+        """Подсказки при вводе: названия объявлений, категории и города"""
+        query = request.query_params.get('q', '')
+        if not query.strip():
+            return Response({'detail': 'Query parameter "q" is required'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = min(max(int(request.query_params.get('limit', 10)), 1), 20)
+        except ValueError:
+            limit = 10
+        return Response({
+            'query': query,
+            'suggestions': suggest.get_index().suggest(query, limit=limit),
+        })
+
     @action(detail=False, methods=['get'])
     def by_city(self, request):
         """Получает объявления по городу"""
@@ -638,14 +788,40 @@ class AdvertisementViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
 
+    @action(detail=False, methods=['post'], parser_classes=[JSONParser, NDJSONParser],
+            permission_classes=[IsAuthenticated])
+    def bulk(self, request):
+        """
+        Пакетное создание и обновление объявлений: JSON-массив или NDJSON.
+        Элемент с id обновляет объявление автора, без id - создает новое.
+        """
+        items = request.data
+        # JSON - только массив; NDJSON разбирается потоком (итератор)
+        if not isinstance(items, (list, Iterator)):
+            return Response({'error': 'Ожидается массив объявлений'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            batch_size = int(request.query_params.get('batch_size', settings.ADVERTISEMENT_BULK_BATCH_SIZE))
+        except ValueError:
+            return Response({'error': 'batch_size должен быть числом'}, status=status.HTTP_400_BAD_REQUEST)
+        batch_size = max(1, min(batch_size, settings.ADVERTISEMENT_BULK_MAX_BATCH_SIZE))
+
+        results = bulk.save_all(items, request.user, batch_size)
+        summary = Counter(result['status'] for result in results)
+        return Response({
+            'created': summary['created'],
+            'updated': summary['updated'],
+            'failed': summary['error'],
+            'results': results,
+        }, status=status.HTTP_207_MULTI_STATUS if summary['error'] else status.HTTP_200_OK)
+
     @action(detail=True, methods=['post'])
     def increment_views(self, request, pk=None):
         """Увеличивает счетчик просмотров объявления"""
         advertisement = self.get_object()
-        advertisement.increment_views()
+        views_count = advertisement.increment_views()
         return Response({
             'status': 'success',
-            'views_count': advertisement.views_count
+            'views_count': views_count
         })
 
 
@@ -664,16 +840,82 @@ class AdvertisementImageViewSet(viewsets.ModelViewSet):
         advertisement = Advertisement.objects.get(id=advertisement_id)
         if advertisement.author != self.request.user:
             raise PermissionError("You can only add images to your own advertisements")
-        serializer.save()
+        # Новое изображение добавляется в конец
+        last_position = advertisement.images.aggregate(last=Max('position'))['last']
+        # Файл сохраняется во временную папку, обработка - в фоне
+        serializer.instance = image_processing.stage(
+            advertisement,
+            serializer.validated_data['image'],
+            is_primary=serializer.validated_data.get('is_primary', False),
+            caption=serializer.validated_data.get('caption', ''),
+            position=0 if last_position is None else last_position + 1,
+        )
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ImageUploadViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin,
+                         mixins.DestroyModelMixin, viewsets.GenericViewSet):
+    """
+    Загрузка фотографии по частям: POST создает загрузку, PUT .../chunk/
+    дописывает часть со смещения Upload-Offset, POST .../finalize/ завершает.
+    GET возвращает текущее смещение, с которого продолжать после обрыва.
+    """
+    serializer_class = ImageUploadSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        return ImageUpload.objects.filter(user=self.request.user)
+
+    def perform_create(self, serializer):
+        serializer.instance = chunked_upload.start(
+            self.request.user, serializer.validated_data['filename'], serializer.validated_data['size']
+        )
+
+    def perform_destroy(self, instance):
+        chunked_upload.discard(instance)
+
+    @action(detail=True, methods=['put'])
+    def chunk(self, request, pk=None):
+        """Тело запроса - байты части; читается потоком, без загрузки в память"""
+        upload = self.get_object()
+        offset = request.headers.get('Upload-Offset', request.query_params.get('offset'))
+        try:
+            offset = int(offset)
+        except (TypeError, ValueError):
+            return Response({'error': 'Укажите смещение части в заголовке Upload-Offset'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        length = request.META.get('CONTENT_LENGTH')
+        try:
+            chunked_upload.write_chunk(upload, offset, request.stream, int(length) if length else None)
+        except chunked_upload.OffsetMismatch as e:
+            return Response({'error': str(e), 'offset': e.offset}, status=status.HTTP_409_CONFLICT)
+        except ValidationError as e:
+            return Response({'error': e.messages[0], 'offset': upload.offset}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(self.get_serializer(upload).data)
+
+    @action(detail=True, methods=['post'])
+    def finalize(self, request, pk=None):
+        upload = self.get_object()
+        try:
+            chunked_upload.finalize(upload)
+        except ValidationError as e:
+            return Response({'error': e.messages[0], 'offset': upload.offset}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(self.get_serializer(upload).data)
 
 
 @method_decorator(csrf_exempt, name='dispatch')
-class FavoriteViewSet(viewsets.ModelViewSet):
+class FavoriteViewSet(FieldSelectionViewMixin, viewsets.ModelViewSet):
     """Представление для избранных объявлений"""
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        return Favorite.objects.filter(user=self.request.user).select_related('advertisement')
+        selection = self.get_field_selection()
+        queryset = restrict(Favorite.objects.filter(user=self.request.user), selection)
+        if includes(selection, 'advertisement') and expands(selection, 'advertisement'):
+            queryset = queryset.prefetch_related(Prefetch(
+                'advertisement', queryset=Advertisement.objects.for_listing(child(selection, 'advertisement'))
+            ))
+        return queryset
 
     def get_serializer_class(self):
         if self.action == 'create':
@@ -126,6 +126,10 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticatedOrReadOnly',
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'ads.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 20,
     'DEFAULT_FILTER_BACKENDS': [
@@ -144,3 +148,129 @@ CORS_ALLOWED_ORIGINS = [
 ]
 
 CORS_ALLOW_CREDENTIALS = True
+
+# Снимок дерева категорий в памяти процесса (секунды)
+CATEGORY_TREE_TTL = config('CATEGORY_TREE_TTL', default=300, cast=int)
+CATEGORY_TREE_CHECK_INTERVAL = config('CATEGORY_TREE_CHECK_INTERVAL', default=1, cast=int)
+
+# Индекс подсказок поиска в памяти процесса: полная перестройка (секунды)
+# и построение в фоновом потоке (False - в запросе)
+SUGGEST_INDEX_TTL = config('SUGGEST_INDEX_TTL', default=600, cast=int)
+SUGGEST_BUILD_IN_BACKGROUND = config('SUGGEST_BUILD_IN_BACKGROUND', default=True, cast=bool)
+
+# Поиск: сколько лучших по предварительной оценке объявлений ранжируется по BM25
+# (остальные идут за ними в порядке предварительной оценки)
+SEARCH_MAX_CANDIDATES = config('SEARCH_MAX_CANDIDATES', default=1000, cast=int)
+
+# Буфер просмотров объявлений
+VIEW_COUNTER_BACKEND = config('VIEW_COUNTER_BACKEND', default='ads.view_counter.LocalViewBuffer')
+VIEW_COUNTER_REDIS_URL = config('VIEW_COUNTER_REDIS_URL', default='redis://localhost:6379/0')
+# Журнал несброшенных просмотров для LocalViewBuffer: без него (пустое значение)
+# просмотры из буфера теряются при падении процесса
+VIEW_COUNTER_JOURNAL_DIR = config('VIEW_COUNTER_JOURNAL_DIR', default=os.path.join(BASE_DIR, 'view_journal'))
+VIEW_COUNTER_FLUSH_INTERVAL = config('VIEW_COUNTER_FLUSH_INTERVAL', default=10, cast=int)
+
+# Кеш (версии данных и кеш ответов API): db (таблица ads_cache, создается после migrate
+# или командой createcachetable),
+# redis, file или locmem. Версии данных должны быть общими для всех процессов:
+# locmem - только для одного процесса (с WEB_CONCURRENCY > 1 приложение не запустится)
+CACHE_BACKENDS = {
+    'db': 'django.core.cache.backends.db.DatabaseCache',
+    'locmem': 'django.core.cache.backends.locmem.LocMemCache',
+    'file': 'django.core.cache.backends.filebased.FileBasedCache',
+    'redis': 'django.core.cache.backends.redis.RedisCache',
+}
+CACHE_BACKEND = config('CACHE_BACKEND', default='db')
+CACHE_LOCATIONS = {
+    'db': 'ads_cache',
+    'locmem': 'ads',
+    'file': os.path.join(BASE_DIR, 'cache'),
+    'redis': 'redis://localhost:6379/1',
+}
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKENDS[CACHE_BACKEND],
+        'LOCATION': config('CACHE_LOCATION', default=CACHE_LOCATIONS[CACHE_BACKEND]),
+    }
+}
+
+# Время жизни закешированных ответов API (секунды); обычно ответ сбрасывается раньше по версии данных
+RESPONSE_CACHE_TIMEOUT = config('RESPONSE_CACHE_TIMEOUT', default=600, cast=int)
+
+# Кодирование JSON-ответов: orjson (если установлен) или stdlib
+JSON_RENDERER_BACKEND = config('JSON_RENDERER_BACKEND', default='orjson')
+# Сколько категорий загружается за раз при потоковой выдаче списков
+STREAMING_CHUNK_SIZE = config('STREAMING_CHUNK_SIZE', default=100, cast=int)
+
+# Размер пачки пакетной загрузки объявлений (/api/advertisements/bulk/) и верхняя граница для ?batch_size=
+ADVERTISEMENT_BULK_BATCH_SIZE = config('ADVERTISEMENT_BULK_BATCH_SIZE', default=200, cast=int)
+ADVERTISEMENT_BULK_MAX_BATCH_SIZE = config('ADVERTISEMENT_BULK_MAX_BATCH_SIZE', default=1000, cast=int)
+# Снятие истекших объявлений: размер пачки (одна транзакция) и период задачи в фоновой очереди (секунды)
+ADVERTISEMENT_EXPIRE_BATCH_SIZE = config('ADVERTISEMENT_EXPIRE_BATCH_SIZE', default=500, cast=int)
+ADVERTISEMENT_EXPIRE_INTERVAL = config('ADVERTISEMENT_EXPIRE_INTERVAL', default=5 * 60, cast=int)
+
+# Фотографии: строить ли копии при загрузке, качество WebP/JPEG и максимальный размер файла
+IMAGE_VARIANTS_ON_UPLOAD = config('IMAGE_VARIANTS_ON_UPLOAD', default=True, cast=bool)
+IMAGE_VARIANT_QUALITY = config('IMAGE_VARIANT_QUALITY', default=82, cast=int)
+IMAGE_UPLOAD_MAX_SIZE = config('IMAGE_UPLOAD_MAX_SIZE', default=20 * 1024 * 1024, cast=int)
+# Загрузка по частям: папка для частей (пусто - MEDIA_ROOT/uploads) и срок жизни незавершенной загрузки
+IMAGE_UPLOAD_SESSION_DIR = config('IMAGE_UPLOAD_SESSION_DIR', default='')
+IMAGE_UPLOAD_SESSION_TTL = config('IMAGE_UPLOAD_SESSION_TTL', default=24 * 60 * 60, cast=int)
+# Сколько секунд файл фотографии без ссылок хранится до удаления командой gc_media
+MEDIA_BLOB_GC_GRACE = config('MEDIA_BLOB_GC_GRACE', default=60 * 60, cast=int)
+
+# Фоновая очередь задач в БД (ads.tasks): потоки-обработчики в веб-процессе
+# (0 - только команда process_tasks), опрос очереди, повторы и таймаут зависших задач
+TASK_WORKER_THREADS = config('TASK_WORKER_THREADS', default=1, cast=int)
+TASK_POLL_INTERVAL = config('TASK_POLL_INTERVAL', default=5, cast=float)
+TASK_MAX_ATTEMPTS = config('TASK_MAX_ATTEMPTS', default=5, cast=int)
+TASK_RETRY_DELAY = config('TASK_RETRY_DELAY', default=30, cast=int)
+TASK_LOCK_TIMEOUT = config('TASK_LOCK_TIMEOUT', default=600, cast=int)
+
+# SMS-шлюз smsc.ru (ads.sms_transport): адрес и учетные данные (обязательны для отправки),
+# таймауты соединения и ответа, общий лимит времени на отправку с повторами,
+# размер пула соединений, повторы временных ошибок с задержкой (база, секунды)
+# и предохранитель: сколько неудач подряд размыкают его и на сколько секунд
+SMS_GATEWAY_URL = config('SMS_GATEWAY_URL', default='https://smsc.ru/sys/send.php')
+SMS_GATEWAY_LOGIN = config('SMS_GATEWAY_LOGIN', default='')
+SMS_GATEWAY_PASSWORD = config('SMS_GATEWAY_PASSWORD', default='')
+SMS_CONNECT_TIMEOUT = config('SMS_CONNECT_TIMEOUT', default=3, cast=float)
+SMS_READ_TIMEOUT = config('SMS_READ_TIMEOUT', default=5, cast=float)
+SMS_SEND_TIMEOUT = config('SMS_SEND_TIMEOUT', default=10, cast=float)
+SMS_POOL_SIZE = config('SMS_POOL_SIZE', default=10, cast=int)
+SMS_RETRIES = config('SMS_RETRIES', default=2, cast=int)
+SMS_RETRY_BACKOFF = config('SMS_RETRY_BACKOFF', default=0.5, cast=float)
+SMS_BREAKER_THRESHOLD = config('SMS_BREAKER_THRESHOLD', default=5, cast=int)
+SMS_BREAKER_RESET = config('SMS_BREAKER_RESET', default=30, cast=float)
+# Outbox исходящих SMS (ads.sms_outbox): сообщений в одном запросе к шлюзу, попытки,
+# базовая задержка повтора и через сколько секунд зависшая отправка повторяется
+SMS_OUTBOX_BATCH_SIZE = config('SMS_OUTBOX_BATCH_SIZE', default=50, cast=int)
+SMS_OUTBOX_MAX_ATTEMPTS = config('SMS_OUTBOX_MAX_ATTEMPTS', default=5, cast=int)
+SMS_OUTBOX_RETRY_DELAY = config('SMS_OUTBOX_RETRY_DELAY', default=10, cast=int)
+SMS_OUTBOX_LOCK_TIMEOUT = config('SMS_OUTBOX_LOCK_TIMEOUT', default=120, cast=int)
+
+# Ограничение частоты SMS-запросов (ads.rate_limit): хранилище корзин токенов
+# (LocalTokenBuckets - память процесса, RedisTokenBuckets - общее для всех серверов)
+# и ограничения "запросов/период" (s, m, h, d; например 5/10m): столько запросов
+# подряд, дальше - по мере пополнения
+RATE_LIMIT_BACKEND = config('RATE_LIMIT_BACKEND', default='ads.rate_limit.LocalTokenBuckets')
+RATE_LIMIT_REDIS_URL = config('RATE_LIMIT_REDIS_URL', default='redis://localhost:6379/0')
+RATE_LIMITS = {
+    'sms_send_phone': config('RATE_LIMIT_SMS_SEND_PHONE', default='3/10m'),
+    'sms_send_ip': config('RATE_LIMIT_SMS_SEND_IP', default='10/h'),
+    'sms_send_global': config('RATE_LIMIT_SMS_SEND_GLOBAL', default='300/m'),
+    'sms_verify_phone': config('RATE_LIMIT_SMS_VERIFY_PHONE', default='5/10m'),
+    'sms_verify_ip': config('RATE_LIMIT_SMS_VERIFY_IP', default='30/h'),
+}
+
+# Коды подтверждения (ads.verification_store): хранилище (DatabaseVerificationStore - таблица
+# SMSVerification, CacheVerificationStore - кеш SMS_VERIFICATION_CACHE), срок действия кода
+# (секунды), число попыток ввода и удаление истекших записей из БД: пачка и период (секунды)
+SMS_VERIFICATION_STORE = config(
+    'SMS_VERIFICATION_STORE', default='ads.verification_store.DatabaseVerificationStore'
+)
+SMS_VERIFICATION_CACHE = config('SMS_VERIFICATION_CACHE', default='default')
+SMS_CODE_TTL = config('SMS_CODE_TTL', default=5 * 60, cast=int)
+SMS_CODE_MAX_ATTEMPTS = config('SMS_CODE_MAX_ATTEMPTS', default=5, cast=int)
+SMS_VERIFICATION_PURGE_BATCH_SIZE = config('SMS_VERIFICATION_PURGE_BATCH_SIZE', default=500, cast=int)
+SMS_VERIFICATION_PURGE_INTERVAL = config('SMS_VERIFICATION_PURGE_INTERVAL', default=10 * 60, cast=int)